@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import sys
+
+from src.settings import settings
+from src.http_client import DashScopeClient
+from src.cache import ResponseCache
+from src.batch import CheckpointWriter, iter_products_file, load_checkpoint, run_content_batch
+
+
+async def run(input_path: str, output_path: str, concurrency: int, rate: float) -> int:
+    http = DashScopeClient(settings)
+    cache = ResponseCache(
+        max_entries=settings.content_cache_max_entries,
+        ttl_seconds=settings.content_cache_ttl_seconds,
+        disk_path=settings.content_cache_disk_path,
+        disk_max_entries=settings.content_cache_disk_max_entries,
+    )
+    # 输出文件同时作为断点：重新运行时跳过其中已成功的 SKU
+    done = await asyncio.to_thread(load_checkpoint, output_path)
+    if done:
+        print(f"Resuming: {len(done)} SKUs already completed", file=sys.stderr)
+
+    failed = 0
+    try:
+        async with CheckpointWriter(output_path) as out:
+            async for item in run_content_batch(http, cache, iter_products_file(input_path), concurrency, rate, skip=done):
+                await out.write(item.model_dump_json())
+                if item.status != "ok":
+                    failed += 1
+                    print(f"[{item.sku}] {item.error}", file=sys.stderr)
+    finally:
+        await http.aclose()
+        cache.close()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量为商品目录生成营销文案，结果以 JSONL 逐条写出")
+    parser.add_argument("input", help="商品文件，CSV（带表头）或 JSONL")
+    parser.add_argument("-o", "--output", required=True, help="结果 JSONL 文件，同时作为断点文件")
+    parser.add_argument("-c", "--concurrency", type=int, default=settings.batch_max_concurrency)
+    parser.add_argument("-r", "--rate", type=float, default=settings.batch_rate_per_second, help="初始每秒请求数")
+    args = parser.parse_args()
+
+    try:
+        failed = asyncio.run(run(args.input, args.output, args.concurrency, args.rate))
+    except KeyboardInterrupt:
+        print("\nInterrupted, rerun with the same --output to resume.", file=sys.stderr)
+        sys.exit(130)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
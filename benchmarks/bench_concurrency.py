@@ -0,0 +1,150 @@
+"""
+本地桩服务器基准：验证并发工具调用是否重叠执行，而不是逐个串行。
+
+启动一个模拟 DashScope 的本地桩服务（固定延迟），将 qwen/wanx 端点指向它，
+再通过 FastMCP 内存客户端并发调用三个工具。若事件循环未被阻塞，
+总耗时应接近单次上游延迟，而不是所有调用延迟之和。
+
+开始前先检查 single-flight 合并：发起计算的调用被取消后，等待同一结果的其他调用仍能拿到结果。
+
+用法:
+    uv run python -m benchmarks.bench_concurrency --calls 8 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_server(app: Starlette, port: int) -> uvicorn.Server:
+    """在独立线程中运行桩服务，避免被测服务阻塞事件循环时桩服务也一同停摆。"""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def stub_png(width: int = 512, height: int = 512) -> bytes:
+    """
+    生成一张纯灰色 PNG，作为图像编辑工具的原图（满足预取校验的尺寸要求）。
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def build_stub_app(latency: float) -> Starlette:
+    async def chat(request: Request) -> JSONResponse:
+        await asyncio.sleep(latency)
+        content = json.dumps({"copywriting": "stub", "key_elements": ["stub"], "image_prompt": "stub", "score": 8.0})
+        return JSONResponse({"choices": [{"message": {"content": content}}], "usage": {"prompt_tokens": 10, "completion_tokens": 10}})
+
+    async def image(request: Request) -> JSONResponse:
+        await asyncio.sleep(latency)
+        return JSONResponse({"output": {"choices": [{"message": {"content": [{"image": "http://stub/1.png"}, {"image": "http://stub/2.png"}]}}]}})
+
+    png = stub_png()
+
+    async def base_image(request: Request) -> Response:
+        return Response(png, media_type="image/png")
+
+    return Starlette(routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/image", image, methods=["POST"]),
+        Route("/base.png", base_image, methods=["GET"]),
+    ])
+
+
+async def check_single_flight(latency: float) -> None:
+    """
+    发起计算的调用被取消（如超过截止时间）时，合并到同一计算的调用应接手计算并拿到结果，而不是一起被取消。
+    """
+    from src.cache import ResponseCache
+
+    cache = ResponseCache()
+    computed = 0
+
+    async def compute() -> str:
+        nonlocal computed
+        computed += 1
+        await asyncio.sleep(latency)
+        return "value"
+
+    owner = asyncio.create_task(cache.get_or_compute("key", compute))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(cache.get_or_compute("key", compute))
+    await asyncio.sleep(latency / 2)
+    owner.cancel()
+    value, cached = await waiter
+    assert owner.cancelled(), "owner should be cancelled"
+    assert (value, cached, computed) == ("value", False, 2), (value, cached, computed)
+    print("single_flight_handoff=ok")
+
+
+async def run(calls: int, latency: float) -> None:
+    await check_single_flight(min(latency, 0.2))
+    port = _free_port()
+    os.environ["QWEN_API_ENDPOINT"] = f"http://127.0.0.1:{port}/chat"
+    os.environ["WANX_API_ENDPOINT"] = f"http://127.0.0.1:{port}/image"
+    os.environ["IMAGE_FETCH_ALLOW_PRIVATE"] = "true"
+    os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="bench_images_"))
+
+    # 端点需在导入 settings 之前写入环境变量
+    from fastmcp import Client
+    from src.server import create_mcp_server
+
+    stub = start_stub_server(build_stub_app(latency), port)
+    mcp = create_mcp_server()
+    tool_calls = [
+        ("generate_marketing_content", {"product_name": "耳机", "product_features": "降噪", "target_platform": "小红书", "target_audience": "学生党"}),
+        ("generate_product_image", {"base_image_url": f"http://127.0.0.1:{port}/base.png", "image_prompt": "studio shot"}),
+        ("get_launch_strategy", {"generated_copywriting": "文案", "target_platform": "抖音"}),
+    ]
+
+    try:
+        async with Client(mcp) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                client.call_tool(*tool_calls[i % len(tool_calls)]) for i in range(calls)
+            ))
+            elapsed = time.perf_counter() - start
+    finally:
+        stub.should_exit = True
+
+    serial = calls * latency
+    print(f"calls={calls} upstream_latency={latency:.2f}s")
+    print(f"wall_time={elapsed:.2f}s serial_estimate={serial:.2f}s overlap_ratio={serial / elapsed:.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="并发工具调用重叠基准")
+    parser.add_argument("--calls", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.run(run(args.calls, args.latency))
+
+
+if __name__ == "__main__":
+    main()
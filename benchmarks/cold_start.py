@@ -0,0 +1,121 @@
+"""
+冷启动测量：多次以子进程方式启动 main.py（DashScope 端点指向本地替身），记录每次从启动进程到
+端口可用、首个工具调用成功返回的耗时，以及服务端 /metrics 中 ecom_startup_seconds 的各阶段数值。
+
+用法:
+    uv run python -m benchmarks.cold_start --runs 5
+    uv run python -m benchmarks.cold_start --runs 5 --lazy --warmup --json cold_start.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+from fastmcp import Client
+
+from benchmarks.bench_concurrency import _free_port, start_stub_server
+from benchmarks.loadgen import call_failed, start_server
+from benchmarks.mock_dashscope import add_mock_arguments, build_mock_app, config_from_args
+
+
+def parse_startup_metrics(text: str) -> Dict[str, float]:
+    phases: Dict[str, float] = {}
+    for line in text.splitlines():
+        if line.startswith("ecom_startup_seconds{"):
+            name, _, value = line.rpartition(" ")
+            phases[name.split('phase="', 1)[1].split('"', 1)[0]] = float(value)
+    return phases
+
+
+async def measure_once(args: argparse.Namespace, mock_url: str) -> Dict[str, Any]:
+    extra_env = {
+        "SERVER_LAZY_STARTUP": str(args.lazy).lower(),
+        "SERVER_WARMUP_ENABLED": str(args.warmup).lower(),
+    }
+    started = time.perf_counter()
+    process, server_url = start_server(mock_url, tempfile.mkdtemp(prefix="cold_start_"), extra_env=extra_env)
+    result: Dict[str, Any] = {}
+    try:
+        async with httpx.AsyncClient(timeout=2) as http:
+            # 频繁轮询，尽量贴近端口实际可用的时刻
+            while "listening" not in result:
+                if process.poll() is not None:
+                    raise RuntimeError(f"服务进程已退出，返回码 {process.returncode}")
+                if time.perf_counter() - started > args.timeout:
+                    raise RuntimeError(f"服务在 {args.timeout:.0f} 秒内未就绪: {server_url}")
+                try:
+                    if (await http.get(f"{server_url}/metrics")).status_code == 200:
+                        result["listening"] = time.perf_counter() - started
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.01)
+
+            async with Client(f"{server_url}/sse") as client:
+                response = await client.call_tool("generate_marketing_content", {
+                    "product_name": "冷启动测试耳机",
+                    "product_features": f"主动降噪，续航30小时，编号 {time.time_ns()}",
+                    "target_platform": "小红书",
+                    "target_audience": "学生党",
+                }, raise_on_error=False)
+            error = call_failed(response)
+            if error:
+                raise RuntimeError(f"首个工具调用失败: {error}")
+            result["first_tool_call"] = time.perf_counter() - started
+            result["server"] = parse_startup_metrics((await http.get(f"{server_url}/metrics")).text)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return result
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    client = {key: statistics.median(r[key] for r in runs) for key in ("listening", "first_tool_call")}
+    phases = sorted({phase for r in runs for phase in r["server"]})
+    server = {phase: statistics.median(r["server"][phase] for r in runs if phase in r["server"]) for phase in phases}
+    return {"runs": len(runs), "client_median_seconds": client, "server_median_seconds": server}
+
+
+async def run(args: argparse.Namespace) -> int:
+    port = _free_port()
+    mock_server = start_stub_server(build_mock_app(config_from_args(args)), port)
+    runs = []
+    try:
+        for i in range(args.runs):
+            runs.append(await measure_once(args, f"http://127.0.0.1:{port}"))
+            print(f"run {i + 1}: listening {runs[-1]['listening']:.3f}s, first tool call {runs[-1]['first_tool_call']:.3f}s")
+    finally:
+        mock_server.should_exit = True
+
+    report = summarize(runs)
+    print(f"\n中位数（{report['runs']} 次）: 端口可用 {report['client_median_seconds']['listening']:.3f}s，"
+          f"首个工具调用完成 {report['client_median_seconds']['first_tool_call']:.3f}s")
+    for phase, seconds in report["server_median_seconds"].items():
+        print(f"  server {phase:<16} {seconds:.3f}s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="MCP 服务冷启动测量（本地 DashScope 替身）")
+    parser.add_argument("--runs", type=int, default=5, help="启动次数")
+    parser.add_argument("--lazy", action="store_true", help="开启 SERVER_LAZY_STARTUP")
+    parser.add_argument("--warmup", action="store_true", help="开启 SERVER_WARMUP_ENABLED")
+    parser.add_argument("--timeout", type=float, default=60.0, help="单次启动的最长等待秒数")
+    parser.add_argument("--json", default=None, help="将报告保存为 JSON")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+压测工具：启动本地 DashScope 替身与真实的 SSE 服务（main.py），用多个并发 MCP 客户端持续调用工具。
+
+报告各工具的 p50/p95/p99 延迟、吞吐、错误数，以及服务端 /metrics 中的事件循环延迟与内存。
+可保存为 JSON，并与基线对比：任一工具 p95 变慢或总吞吐下降超过容差时以非 0 退出，便于在 CI 中做回归检查。
+
+用法:
+    uv run python -m benchmarks.loadgen --clients 20 --duration 30 --json report.json
+    uv run python -m benchmarks.loadgen --clients 20 --duration 30 --baseline report.json --tolerance 0.2
+    # 压测已在运行的服务（其 DashScope 端点需已指向替身）
+    uv run python -m benchmarks.loadgen --server-url http://127.0.0.1:8080 --mock-url http://127.0.0.1:9000
+    # 多 worker 模式：Streamable HTTP 传输，共享状态使用本地 Redis 兼容替身
+    uv run python -m benchmarks.loadgen --workers 4 --clients 40 --duration 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from fastmcp import Client
+
+from benchmarks.bench_concurrency import _free_port, start_stub_server
+from benchmarks.mock_dashscope import add_mock_arguments, build_mock_app, config_from_args, mock_environment
+from benchmarks.mock_redis import MockRedis, start_mock_redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "generate_marketing_content=6,get_launch_strategy=3,generate_product_image=1"
+
+
+# --- 1. 统计 ---
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def histogram_quantile(buckets: List[Tuple[float, float]], q: float) -> float:
+    """
+    按 Prometheus 的方式由累计分桶估计分位数（桶内线性插值）。
+    """
+    if not buckets or buckets[-1][1] == 0:
+        return 0.0
+    target = q * buckets[-1][1]
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= target:
+            if bound == float("inf"):
+                return previous_bound
+            span = count - previous_count
+            return previous_bound + (bound - previous_bound) * ((target - previous_count) / span if span else 0.0)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+def parse_server_metrics(text: str) -> Dict[str, Any]:
+    lag_buckets: List[Tuple[float, float]] = []
+    values: Dict[str, float] = {}
+    for line in text.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        name, _, value = line.rpartition(" ")
+        if name.startswith("ecom_event_loop_lag_seconds_bucket"):
+            bound = name.split('le="', 1)[1].split('"', 1)[0]
+            lag_buckets.append((float("inf") if bound == "+Inf" else float(bound), float(value)))
+        elif name in ("ecom_event_loop_lag_seconds_sum", "ecom_event_loop_lag_seconds_count", "process_resident_memory_bytes"):
+            values[name] = float(value)
+    return {"lag_buckets": lag_buckets, **values}
+
+
+# --- 2. 负载 ---
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def tool_arguments(tool: str, n: int, base_image_url: str, cache_hit_ratio: float, stream_ratio: float,
+                   rng: random.Random) -> Dict[str, Any]:
+    # 默认每次调用输入不同，避免命中文案缓存；cache_hit_ratio 控制复用固定输入的比例
+    suffix = "" if rng.random() < cache_hit_ratio else f" #{n}"
+    stream = rng.random() < stream_ratio
+    product = {
+        "product_name": f"极光无线降噪耳机{suffix}",
+        "product_features": "轻至20g，主动降噪45dB，续航30小时",
+        "target_platform": "小红书",
+        "target_audience": "都市白领",
+    }
+    if tool == "generate_marketing_content":
+        return {**product, "stream": stream}
+    if tool == "generate_marketing_content_variants":
+        return {**product, "k": 3}
+    if tool == "get_launch_strategy":
+        return {"generated_copywriting": f"通勤路上一秒入静{suffix}", "target_platform": "抖音", "stream": stream}
+    if tool == "generate_product_image":
+        return {"base_image_url": base_image_url, "image_prompt": f"studio shot of earbuds{suffix}"}
+    if tool == "run_content_pipeline":
+        return {**product, "product_image_url": base_image_url}
+    if tool == "generate_marketing_content_batch":
+        return {"products": [{**product, "product_name": f"{product['product_name']}-{i}"} for i in range(5)]}
+    raise ValueError(f"未知工具: {tool}")
+
+
+def call_failed(result: Any) -> Optional[str]:
+    if result.is_error:
+        return "tool_error"
+    data = result.structured_content or {}
+    filename = str(data.get("filename", "")) if isinstance(data, dict) else ""
+    return "error_report" if filename.startswith("error") else None
+
+
+class LoadRun:
+    def __init__(self, args: argparse.Namespace, server_url: str, mock_url: str):
+        self.args = args
+        self.server_url = server_url
+        self.base_image_url = f"{mock_url}/base.png"
+        self.mix = parse_mix(args.mix)
+        self.rng = random.Random(args.seed)
+        self.counter = itertools.count()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.server_samples: List[Dict[str, Any]] = []
+
+    async def client_loop(self, deadline: float) -> None:
+        endpoint = "/mcp" if self.args.transport == "http" else "/sse"
+        async with Client(f"{self.server_url}{endpoint}") as client:
+            while time.monotonic() < deadline:
+                tool = self.rng.choices([t for t, _ in self.mix], [w for _, w in self.mix])[0]
+                arguments = tool_arguments(tool, next(self.counter), self.base_image_url,
+                                           self.args.cache_hit_ratio, self.args.stream_ratio, self.rng)
+                start = time.perf_counter()
+                try:
+                    result = await client.call_tool(tool, arguments, raise_on_error=False)
+                    error = call_failed(result)
+                except Exception as e:
+                    error = type(e).__name__
+                elapsed = time.perf_counter() - start
+                if error:
+                    self.errors[tool][error] += 1
+                else:
+                    self.latencies[tool].append(elapsed)
+
+    async def sample_server(self, stop: asyncio.Event) -> None:
+        async with httpx.AsyncClient(timeout=5) as http:
+            while not stop.is_set():
+                try:
+                    response = await http.get(f"{self.server_url}/metrics")
+                    self.server_samples.append(parse_server_metrics(response.text))
+                except httpx.HTTPError:
+                    pass
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run(self) -> Dict[str, Any]:
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(self.sample_server(stop))
+        # 先取一次服务端指标，报告中扣除压测开始前的样本
+        await asyncio.sleep(0.2)
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        await asyncio.gather(*(self.client_loop(deadline) for _ in range(self.args.clients)))
+        elapsed = time.monotonic() - start
+        stop.set()
+        await sampler
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        tools = {}
+        total_ok = 0
+        for tool, _ in self.mix:
+            samples = self.latencies.get(tool, [])
+            total_ok += len(samples)
+            tools[tool] = {
+                "ok": len(samples),
+                "errors": dict(self.errors.get(tool, {})),
+                "throughput_per_s": round(len(samples) / elapsed, 2),
+                "p50_ms": round(percentile(samples, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 1),
+            }
+
+        server: Dict[str, Any] = {}
+        if self.server_samples:
+            first, last = self.server_samples[0], self.server_samples[-1]
+            # 累计分桶相减得到压测期间的分布
+            first_counts = dict(first["lag_buckets"])
+            buckets = [(bound, count - first_counts.get(bound, 0.0)) for bound, count in last["lag_buckets"]]
+            count = last.get("ecom_event_loop_lag_seconds_count", 0.0) - first.get("ecom_event_loop_lag_seconds_count", 0.0)
+            total = last.get("ecom_event_loop_lag_seconds_sum", 0.0) - first.get("ecom_event_loop_lag_seconds_sum", 0.0)
+            memory = [s.get("process_resident_memory_bytes", 0.0) for s in self.server_samples]
+            server = {
+                "loop_lag_mean_ms": round(total / count * 1000, 2) if count else 0.0,
+                "loop_lag_p99_ms": round(histogram_quantile(buckets, 0.99) * 1000, 2),
+                "memory_start_mb": round(memory[0] / 2 ** 20, 1),
+                "memory_peak_mb": round(max(memory) / 2 ** 20, 1),
+            }
+
+        return {
+            "clients": self.args.clients,
+            "duration_s": round(elapsed, 1),
+            "throughput_per_s": round(total_ok / elapsed, 2),
+            "tools": tools,
+            "server": server,
+        }
+
+
+# --- 3. 进程编排 ---
+async def wait_until_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as http:
+        while time.monotonic() < deadline:
+            try:
+                if (await http.get(f"{url}/metrics")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务在 {timeout:.0f} 秒内未就绪: {url}")
+
+
+def start_server(mock_url: str, workdir: str, transport: str = "sse", workers: int = 1,
+                 state_url: Optional[str] = None,
+                 extra_env: Optional[Dict[str, str]] = None) -> Tuple[subprocess.Popen, str]:
+    """
+    以子进程方式启动 main.py（真实的网络传输），DashScope 端点指向替身，状态文件写入临时目录。
+    extra_env 为额外的服务配置（如 SERVER_LAZY_STARTUP）。
+    """
+    port = _free_port()
+    env = {
+        **os.environ,
+        **mock_environment(mock_url),
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "SERVER_TRANSPORT": transport,
+        "SERVER_WORKERS": str(workers),
+        "STATE_BACKEND_URL": state_url or "",
+        "LOG_LEVEL": "WARNING",
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "image_cache"),
+        "IMAGE_JOB_STORE_PATH": os.path.join(workdir, "image_jobs.db"),
+        "BATCH_CHECKPOINT_DIR": os.path.join(workdir, "batch_checkpoints"),
+        "SEMANTIC_CACHE_PATH": os.path.join(workdir, "semantic_index.db"),
+        "HISTORY_PATH": os.path.join(workdir, "generation_history.db"),
+        **(extra_env or {}),
+    }
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    与基线对比，返回所有超出容差的退化项。
+    """
+    regressions = []
+    if report["throughput_per_s"] < baseline["throughput_per_s"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput_per_s']} -> {report['throughput_per_s']}/s")
+    for tool, stats in report["tools"].items():
+        base = baseline.get("tools", {}).get(tool)
+        if base and base["p95_ms"] and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{tool} p95 {base['p95_ms']} -> {stats['p95_ms']} ms")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"clients={report['clients']} duration={report['duration_s']}s throughput={report['throughput_per_s']}/s")
+    print(f"{'tool':<34}{'ok':>6}{'err':>6}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for tool, stats in report["tools"].items():
+        errors = sum(stats["errors"].values())
+        print(f"{tool:<34}{stats['ok']:>6}{errors:>6}{stats['throughput_per_s']:>8}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+        if errors:
+            print(f"{'':<34}errors: {stats['errors']}")
+    if report["server"]:
+        s = report["server"]
+        print(f"event_loop_lag mean={s['loop_lag_mean_ms']}ms p99={s['loop_lag_p99_ms']}ms "
+              f"memory start={s['memory_start_mb']}MB peak={s['memory_peak_mb']}MB")
+
+
+async def run(args: argparse.Namespace) -> int:
+    mock_server = None
+    if args.mock_url:
+        mock_url = args.mock_url.rstrip("/")
+    else:
+        port = _free_port()
+        mock_server = start_stub_server(build_mock_app(config_from_args(args)), port)
+        mock_url = f"http://127.0.0.1:{port}"
+
+    process = None
+    state_server = None
+    workdir = tempfile.mkdtemp(prefix="loadgen_")
+    if args.workers > 1:
+        args.transport = "http"
+    if args.server_url:
+        server_url = args.server_url.rstrip("/")
+    else:
+        state_url = None
+        if args.workers > 1:
+            state_server = await start_mock_redis(MockRedis())
+            state_url = f"redis://127.0.0.1:{state_server.sockets[0].getsockname()[1]}/0"
+        process, server_url = start_server(mock_url, workdir, args.transport, args.workers, state_url)
+
+    try:
+        await wait_until_ready(server_url)
+        report = await LoadRun(args, server_url, mock_url).run()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if mock_server is not None:
+            mock_server.should_exit = True
+        if state_server is not None:
+            state_server.close()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION: {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="MCP SSE 压测工具（本地 DashScope 替身）")
+    parser.add_argument("--clients", type=int, default=20, help="并发 MCP 客户端数")
+    parser.add_argument("--duration", type=float, default=30.0, help="压测时长（秒）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="工具权重，如 generate_marketing_content=6,get_launch_strategy=3")
+    parser.add_argument("--cache-hit-ratio", type=float, default=0.0, help="复用固定输入（命中缓存）的调用比例")
+    parser.add_argument("--stream-ratio", type=float, default=0.0, help="文案与策略工具开启流式模式的比例")
+    parser.add_argument("--server-url", default=None, help="压测已运行的服务，不再启动 main.py")
+    parser.add_argument("--mock-url", default=None, help="使用已运行的 DashScope 替身")
+    parser.add_argument("--transport", choices=["sse", "http"], default="sse", help="服务传输协议")
+    parser.add_argument("--workers", type=int, default=1, help="服务 worker 进程数，大于 1 时使用 http 传输与 Redis 兼容替身")
+    parser.add_argument("--json", default=None, help="将报告保存为 JSON")
+    parser.add_argument("--baseline", default=None, help="与基线报告对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+本地 DashScope 替身：模拟通义千问（含 SSE 流式）、通义万相（同步与异步任务）与任务查询端点。
+
+延迟按分布随机抽样，并可按比例注入 5xx 错误与限流响应，用于压测与回归对比，不会访问线上接口。
+
+延迟分布写法:
+    fixed:0.5            固定 0.5 秒
+    uniform:0.2,1.0      0.2 ~ 1.0 秒均匀分布
+    lognormal:0.8,0.4    中位数 0.8 秒、sigma 0.4 的对数正态分布
+
+用法:
+    uv run python -m benchmarks.mock_dashscope --port 9000 --chat-latency lognormal:0.8,0.4 \\
+        --image-latency uniform:3,6 --error-rate 0.01 --throttle-rate 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+import uuid
+from typing import AsyncIterator, Callable, Dict, Optional, Set
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from benchmarks.bench_concurrency import stub_png
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    将 "kind:a,b" 形式的延迟描述解析为抽样函数。
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"无法解析延迟分布: {spec}")
+
+
+class MockConfig:
+    def __init__(self, chat_latency: str = "fixed:0.5", image_latency: str = "fixed:2.0",
+                 error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 stream_chunks: int = 20, seed: Optional[int] = None, ignore_n: bool = False,
+                 malformed_rate: float = 0.0):
+        self.chat_latency = parse_latency(chat_latency)
+        self.image_latency = parse_latency(image_latency)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.stream_chunks = max(1, stream_chunks)
+        self.ignore_n = ignore_n
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+
+
+COPY_VARIANTS = [
+    ("轻至20g的降噪耳机，通勤路上一秒入静。", 8.6),
+    ("轻至20g的降噪耳机，通勤路上一秒入静！", 8.4),
+    ("主动降噪45dB，地铁轰鸣瞬间消失，30小时续航陪你一整周。", 8.9),
+    ("戴上就忘了它的存在：20g 轻量机身，降噪开到最大也不闷耳。", 8.1),
+    ("打工人通勤神器｜降噪一开，世界只剩你喜欢的歌。", 7.8),
+]
+
+
+def deform(content: str, rng: random.Random) -> str:
+    """
+    模拟模型输出的常见缺陷：代码块包裹、对象后附加说明、被截断，或完全不是 JSON（需重问）。
+    """
+    kind = rng.randrange(4)
+    if kind == 0:
+        return f"```json\n{content}\n```"
+    if kind == 1:
+        return content + "\n以上方案仅供参考。"
+    if kind == 2:
+        return content[:len(content) * 3 // 4]
+    return "抱歉，我将为您生成营销方案。"
+
+
+def content_variant(index: int) -> str:
+    copy, score = COPY_VARIANTS[index % len(COPY_VARIANTS)]
+    return json.dumps({
+        "copywriting": copy,
+        "key_elements": ["主动降噪", "轻量", "长续航"],
+        "image_prompt": "minimalist studio shot of wireless earbuds on marble, soft daylight",
+        "score": score,
+    }, ensure_ascii=False)
+
+
+CONTENT = content_variant(0)
+
+STRATEGY = json.dumps({
+    "timing_suggestion": "工作日 20:00-22:00",
+    "visual_assessment": "主体清晰，建议增加使用场景",
+    "interaction_strategy": ["评论区提问引导", "#通勤好物"],
+    "compliance_risk": ["避免使用“最”等绝对化用语"],
+    "launch_checklist": ["核对价格", "检查图片版权"],
+}, ensure_ascii=False)
+
+
+def build_mock_app(config: MockConfig) -> Starlette:
+    """
+    构建 DashScope 替身应用；/stats 返回各端点的请求计数，便于核对重试与去重效果。
+    """
+    stats: Dict[str, int] = {"chat": 0, "stream": 0, "image": 0, "tasks": 0, "errors": 0, "throttled": 0}
+    tasks: Dict[str, float] = {}
+    seen_prefixes: Set[str] = set()
+    png = stub_png()
+    image_ids = itertools.count()
+
+    def injected_failure() -> Optional[JSONResponse]:
+        roll = config.rng.random()
+        if roll < config.throttle_rate:
+            stats["throttled"] += 1
+            return JSONResponse({"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded"}, status_code=429)
+        if roll < config.throttle_rate + config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"code": "InternalError", "message": "mock internal error"}, status_code=500)
+        return None
+
+    async def chat(request: Request) -> Response:
+        body = await request.json()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        # 文案与策略请求按系统提示词区分，返回对应结构的 JSON
+        system = str((body.get("messages") or [{}])[0].get("content", ""))
+        # 修复请求按用户消息中的字段要求区分
+        content = STRATEGY if "投放顾问" in system or "timing_suggestion" in str(body["messages"][-1]) else CONTENT
+        # 修复请求始终返回合法输出；其余请求按比例返回有缺陷的输出
+        finish_reason = "stop"
+        if "修复" not in system and config.rng.random() < config.malformed_rate:
+            original, content = content, deform(content, config.rng)
+            if content != original and original.startswith(content):
+                # 截断的输出与真实模型一样以 length 结束
+                finish_reason = "length"
+        latency = config.chat_latency(config.rng)
+        usage = {"prompt_tokens": 320, "completion_tokens": len(content), "total_tokens": 320 + len(content)}
+        # 模拟隐式上下文缓存：同一系统提示词再次出现时，前缀部分计为缓存命中
+        if system in seen_prefixes:
+            usage["prompt_tokens_details"] = {"cached_tokens": 256}
+        seen_prefixes.add(system)
+
+        if not body.get("stream"):
+            stats["chat"] += 1
+            await asyncio.sleep(latency)
+            n = 1 if config.ignore_n else int(body.get("n") or 1)
+            if content is CONTENT and (n > 1 or (body.get("temperature") or 0) > 0.9):
+                # 多候选：输入 token 只计一次，每条候选各自计输出 token
+                contents = [content_variant(config.rng.randrange(len(COPY_VARIANTS))) for _ in range(n)]
+                completion = sum(len(c) for c in contents)
+                usage = {**usage, "completion_tokens": completion, "total_tokens": 320 + completion}
+            else:
+                contents = [content]
+            choices = [{"index": i, "message": {"content": c}, "finish_reason": finish_reason} for i, c in enumerate(contents)]
+            return JSONResponse({"model": body.get("model"), "choices": choices, "usage": usage})
+
+        stats["stream"] += 1
+        size = math.ceil(len(content) / config.stream_chunks)
+
+        async def events() -> AsyncIterator[str]:
+            # 首个分片前等待约 1/5 的总延迟，其余时间均摊到各分片之间
+            await asyncio.sleep(latency * 0.2)
+            for i in range(0, len(content), size):
+                chunk = {"choices": [{"delta": {"content": content[i:i + size]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(latency * 0.8 / config.stream_chunks)
+            yield f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': finish_reason}]})}\n\n"
+            yield f"data: {json.dumps({'choices': [], 'usage': usage, 'model': body.get('model')})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def image(request: Request) -> Response:
+        await request.body()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+        stats["image"] += 1
+        latency = config.image_latency(config.rng)
+        if request.headers.get("x-dashscope-async") == "enable":
+            task_id = uuid.uuid4().hex
+            tasks[task_id] = time.monotonic() + latency
+            return JSONResponse({"output": {"task_id": task_id, "task_status": "PENDING"}})
+        await asyncio.sleep(latency)
+        # 生成结果指向替身自身，可被下载；两张图片内容相同，用于验证按内容去重
+        urls = [{"image": f"{request.base_url}generated/{next(image_ids)}.png"} for _ in range(2)]
+        return JSONResponse({"output": {"choices": [{"message": {"content": urls}}]}, "usage": {"image_count": 2}})
+
+    async def task(request: Request) -> Response:
+        stats["tasks"] += 1
+        task_id = request.path_params["task_id"]
+        ready_at = tasks.get(task_id)
+        if ready_at is None:
+            return JSONResponse({"output": {"task_id": task_id, "task_status": "UNKNOWN"}})
+        if time.monotonic() < ready_at:
+            return JSONResponse({"output": {"task_id": task_id, "task_status": "RUNNING"}})
+        results = [{"url": f"{request.base_url}generated/{next(image_ids)}.png"} for _ in range(2)]
+        return JSONResponse({"output": {"task_id": task_id, "task_status": "SUCCEEDED", "results": results}})
+
+    async def base_image(request: Request) -> Response:
+        return Response(png, media_type="image/png")
+
+    async def get_stats(request: Request) -> JSONResponse:
+        return JSONResponse(stats)
+
+    return Starlette(routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/image", image, methods=["POST"]),
+        Route("/tasks/{task_id}", task, methods=["GET"]),
+        Route("/base.png", base_image, methods=["GET"]),
+        Route("/generated/{name}", base_image, methods=["GET"]),
+        Route("/stats", get_stats, methods=["GET"]),
+    ])
+
+
+def mock_environment(base_url: str) -> Dict[str, str]:
+    """
+    将被测服务指向替身所需的环境变量。
+    """
+    return {
+        "QWEN_API_ENDPOINT": f"{base_url}/chat",
+        "WANX_API_ENDPOINT": f"{base_url}/image",
+        "DASHSCOPE_TASK_ENDPOINT": f"{base_url}/tasks",
+        # 替身与测试图片都在本机，需允许服务端下载回环地址
+        "IMAGE_FETCH_ALLOW_PRIVATE": "true",
+    }
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--chat-latency", default="lognormal:0.8,0.4", help="通义千问延迟分布")
+    parser.add_argument("--image-latency", default="uniform:2,4", help="通义万相延迟分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 限流的比例")
+    parser.add_argument("--stream-chunks", type=int, default=20, help="流式响应的分片数")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，便于复现")
+    parser.add_argument("--ignore-n", action="store_true", help="模拟不支持 n 参数的模型：始终只返回一条候选")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="返回有缺陷输出（代码块、多余文字、截断或非 JSON）的比例")
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(chat_latency=args.chat_latency, image_latency=args.image_latency,
+                      error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                      stream_chunks=args.stream_chunks, seed=args.seed, ignore_n=args.ignore_n,
+                      malformed_rate=args.malformed_rate)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 DashScope 替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(mock_environment(f"http://{args.host}:{args.port}"), indent=2))
+    uvicorn.run(build_mock_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
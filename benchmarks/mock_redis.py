@@ -0,0 +1,168 @@
+"""
+本地 Redis 兼容替身：实现共享状态后端用到的 RESP 命令子集，用于在没有 Redis 的环境下验证多 worker 部署。
+
+支持 PING、AUTH、SELECT、GET、SET（EX/PX/NX/XX）、INCR、DEL、EXISTS、PEXPIRE、PTTL、DBSIZE、FLUSHDB。
+数据只保存在内存中，进程退出即丢失。
+
+用法:
+    uv run python -m benchmarks.mock_redis --port 6390
+    STATE_BACKEND_URL=redis://127.0.0.1:6390/0 SERVER_TRANSPORT=http SERVER_WORKERS=4 uv run python main.py
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class MockRedis:
+    """
+    按数据库编号隔离的键空间，值与过期时间（monotonic 秒）一起保存，读取时惰性清理。
+    """
+
+    def __init__(self, password: Optional[str] = None):
+        self.password = password
+        self.dbs: Dict[int, Dict[str, Tuple[Optional[float], str]]] = {}
+        self.commands = 0
+
+    def _live(self, db: Dict[str, Tuple[Optional[float], str]], key: str) -> Optional[str]:
+        entry = db.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del db[key]
+            return None
+        return value
+
+    def execute(self, session: Dict[str, Any], args: List[str]) -> Any:
+        """
+        执行一条命令并返回 Python 值：str 为简单字符串，bytes 为批量字符串，int 为整数，
+        None 为空值，Exception 为错误响应。
+        """
+        self.commands += 1
+        name = args[0].upper()
+        if self.password is not None and not session["authed"] and name not in ("AUTH", "PING"):
+            return Exception("NOAUTH Authentication required.")
+        if name == "PING":
+            return "PONG"
+        if name == "AUTH":
+            session["authed"] = args[-1] == self.password
+            return "OK" if session["authed"] else Exception("WRONGPASS invalid password")
+        if name == "SELECT":
+            session["db"] = int(args[1])
+            return "OK"
+
+        db = self.dbs.setdefault(session["db"], {})
+        if name == "GET":
+            value = self._live(db, args[1])
+            return value.encode("utf-8") if value is not None else None
+        if name == "SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            expires_at = None
+            if "PX" in options:
+                expires_at = time.monotonic() + int(args[3 + options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires_at = time.monotonic() + int(args[3 + options.index("EX") + 1])
+            exists = self._live(db, key) is not None
+            if ("NX" in options and exists) or ("XX" in options and not exists):
+                return None
+            db[key] = (expires_at, value)
+            return "OK"
+        if name == "INCR":
+            current = self._live(db, args[1])
+            try:
+                count = int(current or 0) + 1
+            except ValueError:
+                return Exception("ERR value is not an integer or out of range")
+            db[args[1]] = (db[args[1]][0] if current is not None else None, str(count))
+            return count
+        if name == "DEL":
+            return sum(1 for key in args[1:] if self._live(db, key) is not None and db.pop(key))
+        if name == "EXISTS":
+            return sum(1 for key in args[1:] if self._live(db, key) is not None)
+        if name == "PEXPIRE":
+            value = self._live(db, args[1])
+            if value is None:
+                return 0
+            db[args[1]] = (time.monotonic() + int(args[2]) / 1000, value)
+            return 1
+        if name == "PTTL":
+            if self._live(db, args[1]) is None:
+                return -2
+            expires_at = db[args[1]][0]
+            return -1 if expires_at is None else int((expires_at - time.monotonic()) * 1000)
+        if name == "DBSIZE":
+            return sum(1 for key in list(db) if self._live(db, key) is not None)
+        if name == "FLUSHDB":
+            db.clear()
+            return "OK"
+        return Exception(f"ERR unknown command '{args[0]}'")
+
+
+def encode_reply(value: Any) -> bytes:
+    if isinstance(value, Exception):
+        return f"-{value}\r\n".encode("utf-8")
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool) or isinstance(value, int):
+        return f":{int(value)}\r\n".encode()
+    if isinstance(value, bytes):
+        return f"${len(value)}\r\n".encode() + value + b"\r\n"
+    return f"+{value}\r\n".encode("utf-8")
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[str]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # 兼容 redis-cli 等发送的内联命令
+        return line.decode("utf-8").split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+    return args
+
+
+async def start_mock_redis(store: MockRedis, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session: Dict[str, Any] = {"db": 0, "authed": False}
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                writer.write(encode_reply(store.execute(session, args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def serve(host: str, port: int, password: Optional[str]) -> None:
+    server = await start_mock_redis(MockRedis(password), host, port)
+    print(f"Mock Redis listening on redis://{host}:{server.sockets[0].getsockname()[1]}/0")
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 Redis 兼容替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    parser.add_argument("--password", default=None, help="可选：要求客户端先 AUTH")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.password))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+不依赖上游与网络的行为自检：直接调用各模块的纯函数与关键分支，断言失败时以非 0 退出。
+改动这些模块后先运行本脚本，再运行基于桩服务的基准。
+
+用法:
+    uv run python -m benchmarks.self_check
+"""
+import asyncio
+from typing import List
+
+
+async def check_image_persist_failure() -> None:
+    """
+    保存生成图片时 persist_many 抛出异常：对应图片保留临时地址并附带错误，结果仍能正常封装。
+    上游调用失败时逐张错误保留上游的响应内容。
+    """
+    import httpx
+
+    from src import generate_img
+    from src.generate_img import ImageCall, fan_out_product_images, image_items_result
+    from src.http_client import UpstreamError
+
+    class BrokenStore:
+        async def persist_many(self, urls: List[str], base_url: str) -> None:
+            raise RuntimeError("disk exploded")
+
+    async def fake_request(http, base_image_url, prompt, n=None, timeout=90) -> List[str]:
+        if prompt == "fail":
+            request = httpx.Request("POST", "http://upstream/image")
+            response = httpx.Response(400, text='{"code":"InvalidParameter"}', request=request)
+            raise UpstreamError("bad request", response=response)
+        return [f"http://temp/{i}.png" for i in range(n or 1)]
+
+    original = generate_img.request_product_images
+    generate_img.request_product_images = fake_request
+    try:
+        items = await fan_out_product_images(None, "http://base.png", [ImageCall("ok", None, [0, 1])], 5.0,
+                                             BrokenStore())
+        result = image_items_result(items, persisted=True)
+        assert result.file_content == ["http://temp/0.png", "http://temp/1.png"], result.file_content
+        assert [image.url for image in result.images] == result.file_content, result.images
+        assert all("disk exploded" in item.error for item in result.items), result.items
+
+        items = await fan_out_product_images(None, "http://base.png", [ImageCall("fail", None, [0])], 5.0)
+        assert "InvalidParameter" in items[0].error, items[0].error
+        assert image_items_result(items).filename == "error_report.json"
+    finally:
+        generate_img.request_product_images = original
+    print("image_persist_failure=ok")
+
+
+async def check_image_url_rejection() -> None:
+    """
+    格式错误、非 http(s) 与指向内网的图片地址在发出请求前即以 ImageIngestError 拒绝；
+    公网地址的请求固定连接校验过的 IP。
+    """
+    import httpx
+
+    from src.image_ingest import ImageIngestError, download_image, pinned_request
+
+    async with httpx.AsyncClient(follow_redirects=False) as client:
+        for url in ["http://\x00/", "http:///x.png", "ftp://example.com/x.png", "file:///etc/passwd",
+                    "http://127.0.0.1/x.png", "http://169.254.169.254/latest", "http://[::ffff:10.0.0.1]/x.png"]:
+            try:
+                await download_image(client, url, 1024)
+            except ImageIngestError:
+                continue
+            raise AssertionError(f"{url!r} should be rejected")
+    # 校验过的地址直接用于连接，原主机名只出现在 Host 头与 SNI 中
+    url, headers, extensions = pinned_request(httpx.URL("https://images.example:8443/a.png"), "203.0.113.7")
+    assert (url.host, url.port, headers, extensions) == (
+        "203.0.113.7", 8443, {"Host": "images.example:8443"}, {"sni_hostname": "images.example"}
+    ), (url, headers, extensions)
+    print("image_url_rejection=ok")
+
+
+def check_batch_checkpoint() -> None:
+    """
+    断点文件中缺少 sku、不是对象或写了一半的行被跳过，不影响续跑。
+    """
+    import os
+    import tempfile
+
+    from src.batch import load_checkpoint
+
+    lines = ['{"sku": "a", "status": "ok"}', '{"status": "ok"}', '[1]', '"x"',
+             '{"sku": "b", "status": "error"}', '{"sku": "c", "sta']
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "batch.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        assert load_checkpoint(path) == {"a"}, load_checkpoint(path)
+    print("batch_checkpoint=ok")
+
+
+def check_compliance_scanner() -> None:
+    """
+    自动机返回全部重叠命中，并与逐个模式串的朴素查找一致；扫描时更长的命中与放行短语覆盖较短的命中，
+    全角字符折叠后参与匹配，位置仍对应原文。
+    """
+    import random
+
+    from src.compliance import KeywordAutomaton, scan_copy
+
+    automaton = KeywordAutomaton(["he", "she", "his", "hers"])
+    assert sorted(automaton.finditer("ushers")) == [(1, 1), (2, 0), (2, 3)], automaton.finditer("ushers")
+
+    rng = random.Random(7)
+    patterns = list({"".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(12)})
+    automaton = KeywordAutomaton(patterns)
+    for _ in range(200):
+        text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 30)))
+        naive = sorted((i, index) for index, p in enumerate(patterns)
+                       for i in range(len(text) - len(p) + 1) if text.startswith(p, i))
+        assert sorted(automaton.finditer(text)) == naive, (text, patterns)
+
+    found = [(f.term, f.positions) for f in scan_copy("全网第一，第一次用！ＮＯ．１", "小红书")]
+    assert found == [("全网第一", [0]), ("ＮＯ．１", [10])], found
+    found = [(f.term, f.category) for f in scan_copy("加微信领优惠，100%纯棉，100%好评", "小红书")]
+    assert found == [("加微信", "站外导流"), ("100%", "绝对化用语")], found
+    # 平台规则只对对应平台生效
+    assert [f.term for f in scan_copy("加微信", "淘宝")] == ["加微信"]
+    assert scan_copy("评论抽奖", "淘宝") == []
+    print("compliance_scanner=ok")
+
+
+def check_output_repair() -> None:
+    """
+    本地修复只处理代码块、前后说明文字与多余逗号；被截断（未闭合）的对象不算修复成功，
+    只有 allow_partial 的预览解析会接受。
+    """
+    from src.output import ContentPlan, OutputFormatError, parse_output, repair_json
+
+    assert repair_json('好的：\n```json\n{"a": [1, 2,], }\n```\n以上') == {"a": [1, 2]}
+    assert repair_json('{"a": "含 } 括号", "b": 1} 多余') == {"a": "含 } 括号", "b": 1}
+    assert repair_json("没有 JSON") is None
+
+    truncated = '{"copywriting": "保温杯", "key_elements": ["316"], "image_prompt": "cup", "score": 8, "note": "被截'
+    assert repair_json(truncated) is None
+    assert repair_json(truncated, allow_partial=True)["note"] == "被截"
+    try:
+        parse_output(truncated, ContentPlan)
+    except OutputFormatError:
+        pass
+    else:
+        raise AssertionError("truncated output must not parse as a repair")
+
+    parsed = parse_output('```json\n' + truncated.rsplit(",", 1)[0] + "}\n```", ContentPlan)
+    assert parsed.outcome == "repaired" and parsed.value.copywriting == "保温杯", parsed.outcome
+    print("output_repair=ok")
+
+
+async def check_admission() -> None:
+    """
+    批量调用按并发数计成本（不超过商品数）；排队按客户端公平放行，先到的大量请求不会饿死其他客户端；
+    排队成本超限时立即拒绝。
+    """
+    from src.admission import AdmissionController, AdmissionRejected, tool_cost
+    from src.settings import settings
+
+    products = [{}] * 100
+    assert tool_cost("generate_marketing_content_batch", {"products": products, "concurrency": 4}) == 4
+    assert tool_cost("generate_marketing_content_batch", {"products": products[:2], "concurrency": 4}) == 2
+    assert tool_cost("generate_marketing_content_batch", {"products_file": "p.csv"}) == settings.batch_max_concurrency
+    assert tool_cost("get_launch_strategy", {"compliance_only": True}) == 0
+    assert tool_cost("get_admission_stats", {}) == 0
+
+    controller = AdmissionController(capacity=1, max_queued_cost=4, max_wait_seconds=60)
+    await controller.acquire("a", 1)
+    order: List[str] = []
+
+    async def call(client: str, name: str) -> None:
+        await controller.acquire(client, 1)
+        order.append(name)
+        controller.release(1, 0.0)
+
+    tasks = [asyncio.create_task(call("a", f"a{i}")) for i in range(3)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(call("b", "b0")))
+    await asyncio.sleep(0)
+    try:
+        await controller.acquire("c", 1)
+    except AdmissionRejected:
+        pass
+    else:
+        raise AssertionError("queue over max_queued_cost should reject")
+    controller.release(1, 0.0)
+    await asyncio.gather(*tasks)
+    assert order == ["a0", "b0", "a1", "a2"], order
+    assert controller.in_flight_cost == 0 and controller.queued_cost == 0
+    print("admission=ok")
+
+
+async def main() -> None:
+    await check_image_persist_failure()
+    await check_image_url_rejection()
+    check_batch_checkpoint()
+    check_compliance_scanner()
+    check_output_repair()
+    await check_admission()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
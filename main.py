@@ -1,24 +1,16 @@
 import sys
 
-from src.server import create_mcp_server
-from src.server import get_server_name_with_version
+from src.serving import run_server
+from src.settings import settings
 
 
 def main():
     try:
-        mcp = create_mcp_server()
-    except Exception as e:
-        print(f'Error create server:{e}',file=sys.stderr)
-        sys.exit(1)
-
-    try:
-        mcp.run(
-            transport = "sse",
-            port = 8080,
-            host = "0.0.0.0",
-            show_banner = False,
-        )
+        # 服务实例由 src.server:create_app 在各 worker 进程内创建
+        run_server(settings)
     except KeyboardInterrupt:
+        # 服务模块只在 worker 内导入，主进程不必加载全部工具模块
+        from src.server import get_server_name_with_version
         print(f"\nShutting down {get_server_name_with_version()}...", file=sys.stderr)
         sys.exit(0)
     except Exception as e:
@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from typing import Annotated, Any, Dict, List, Optional, Tuple
+
+from mcp import McpError
+from mcp.types import ErrorData
+from pydantic import BaseModel, Field
+
+from .settings import Settings, settings
+from .http_client import DashScopeClient
+from .metrics import span
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+from fastmcp.server.dependencies import get_http_headers
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+
+
+# --- 1. 工具成本 ---
+# 以一次文本生成为 1 个单位；图像编辑耗时约为文本的数倍，批量与流水线按规模估算
+TOOL_COSTS: Dict[str, float] = {
+    "generate_marketing_content": 1.0,
+    "get_launch_strategy": 1.0,
+    "generate_product_image": 6.0,
+    "run_content_pipeline": 10.0,
+}
+
+
+def tool_cost(name: str, arguments: Optional[Dict[str, Any]]) -> float:
+    """
+    估算一次工具调用的成本；未登记的工具（如统计查询）成本为 0，不参与排队。
+    """
+    if name == "get_launch_strategy" and (arguments or {}).get("compliance_only"):
+        # 仅做本地规则预检，不调用模型
+        return 0.0
+    if name == "generate_marketing_content_batch":
+        # 批量按自身的并发上限与限速器逐个发起上游请求，同时占用的上游名额不超过并发数；
+        # 按整批商品数计费会让大批量在非空闲时被拒绝，并在整个运行期间挤占交互式调用
+        args = arguments or {}
+        try:
+            concurrency = int(args.get("concurrency") or settings.batch_max_concurrency)
+        except (TypeError, ValueError):
+            concurrency = settings.batch_max_concurrency
+        if args.get("products_file"):
+            # 文件按行流式读取，商品数事先未知
+            return float(max(1, concurrency))
+        return float(max(1, min(len(args.get("products") or []), concurrency)))
+    if name == "generate_marketing_content_variants":
+        # 以 n 参数一次生成多条候选时输入 token 只计一次，按候选数的一半估算
+        # 工具模块在注册工具时才导入（见 server.py），这里同样延迟导入
+        from .variants import candidate_count
+        args = arguments or {}
+        try:
+            count = candidate_count(int(args.get("k") or 3), int(args["candidates"]) if args.get("candidates") else None)
+        except (TypeError, ValueError):
+            # 参数不合法时由工具自身的参数校验报错，这里按默认规模计
+            count = candidate_count(3)
+        return max(1.0, count / 2)
+    if name == "generate_product_image":
+        # 多张图片与多个变体拆分为多次上游调用，按调用数计
+        from .generate_img import image_call_count
+        args = arguments or {}
+        try:
+            calls = image_call_count(int(args["num_images"]) if args.get("num_images") else None,
+                                     list(args.get("prompt_variations") or []))
+        except (TypeError, ValueError):
+            calls = 1
+        return TOOL_COSTS[name] * calls
+    return TOOL_COSTS.get(name, 0.0)
+
+
+class AdmissionRejected(McpError):
+    """
+    排队已满或预计等待过长时提前拒绝请求。
+    """
+
+    def __init__(self, message: str):
+        super().__init__(ErrorData(code=-32000, message=message))
+
+
+# --- 2. 统计信息 ---
+class UpstreamStats(BaseModel):
+    limit: Annotated[float, Field(description="当前 AIMD 并发上限")]
+    in_flight: Annotated[int, Field(description="正在进行的上游请求数")]
+    waiting: Annotated[int, Field(description="等待并发名额的请求数")]
+    throttled: Annotated[int, Field(description="累计收到的限流响应次数")]
+    retries: Annotated[int, Field(description="累计重试次数")] = 0
+    hedges: Annotated[int, Field(description="累计发出的对冲请求数")] = 0
+    hedge_wins: Annotated[int, Field(description="对冲请求先于原请求返回的次数")] = 0
+    breaker_state: Annotated[str, Field(description="熔断器状态：closed / open / half_open")] = "closed"
+    breaker_opened: Annotated[int, Field(description="累计熔断次数")] = 0
+    p95_ms: Annotated[Optional[float], Field(description="近期成功调用的 p95 延迟")] = None
+
+
+class AdmissionStats(BaseModel):
+    """
+    准入控制与上游并发池的实时状态。
+    """
+    capacity: Annotated[float, Field(description="允许同时执行的总成本")]
+    in_flight_cost: Annotated[float, Field(description="正在执行的请求总成本")]
+    queue_depth: Annotated[int, Field(description="排队中的请求数")]
+    queued_cost: Annotated[float, Field(description="排队中的请求总成本")]
+    queue_depth_by_client: Annotated[Dict[str, int], Field(description="各客户端排队中的请求数")]
+    admitted: int = 0
+    rejected: int = 0
+    avg_wait_ms: Annotated[float, Field(description="已准入请求的平均排队时间")] = 0.0
+    max_wait_ms: Annotated[float, Field(description="已准入请求的最长排队时间")] = 0.0
+    upstreams: Dict[str, UpstreamStats] = {}
+
+
+# --- 3. 按客户端公平排队的准入控制 ---
+class AdmissionController:
+    """
+    基于成本的准入控制：所有工具调用共享 capacity 个成本单位，超出部分进入队列。
+
+    队列按客户端做加权公平排队（WFQ）：每个请求的完成标签为
+    max(全局虚拟时间, 该客户端上一个请求的标签) + 成本，按标签从小到大放行，
+    因此单个客户端提交大量请求不会饿死其他客户端。
+    队列总成本超过 max_queued_cost，或按当前吞吐估计的等待时间超过 max_wait_seconds 时立即拒绝。
+    """
+
+    def __init__(self, capacity: float, max_queued_cost: float, max_wait_seconds: float):
+        self.capacity = capacity
+        self.max_queued_cost = max_queued_cost
+        self.max_wait_seconds = max_wait_seconds
+        self.in_flight_cost = 0.0
+        self.queued_cost = 0.0
+        self._virtual_time = 0.0
+        self._client_tags: Dict[str, float] = defaultdict(float)
+        self._queue: List[Tuple[float, int, str, float, "asyncio.Future[None]"]] = []
+        self._seq = itertools.count()
+        self._queued_by_client: Dict[str, int] = defaultdict(int)
+        # 成本单位的平均服务时间（指数移动平均），用于估计排队等待
+        self._seconds_per_cost = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _fits(self, cost: float) -> bool:
+        # 单个成本超过容量的请求在空闲时也允许执行，避免永远无法准入
+        return self.in_flight_cost + cost <= self.capacity or self.in_flight_cost == 0
+
+    def _dispatch(self) -> None:
+        while self._queue:
+            tag, _, client, cost, waiter = self._queue[0]
+            if waiter.done():
+                heapq.heappop(self._queue)
+                continue
+            if not self._fits(cost):
+                return
+            heapq.heappop(self._queue)
+            self._virtual_time = max(self._virtual_time, tag - cost)
+            self._queued_by_client[client] -= 1
+            if self._queued_by_client[client] == 0:
+                # 空闲客户端的标签不再影响排序，及时清理以免状态无限增长
+                del self._queued_by_client[client]
+                if self._client_tags.get(client, 0.0) <= self._virtual_time:
+                    self._client_tags.pop(client, None)
+            self.queued_cost -= cost
+            self.in_flight_cost += cost
+            waiter.set_result(None)
+
+    def _record_wait(self, waited: float) -> None:
+        self.admitted += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+
+    async def acquire(self, client: str, cost: float) -> None:
+        if cost <= 0:
+            return
+        if not self._queue and self._fits(cost):
+            self.in_flight_cost += cost
+            self._record_wait(0.0)
+            return
+
+        estimated_wait = (self.queued_cost + self.in_flight_cost) * self._seconds_per_cost / max(self.capacity, 1.0)
+        if self.queued_cost + cost > self.max_queued_cost or estimated_wait > self.max_wait_seconds:
+            self.rejected += 1
+            raise AdmissionRejected(f"服务繁忙，请稍后重试（排队成本 {self.queued_cost:.0f}，预计等待 {estimated_wait:.0f} 秒）")
+
+        tag = max(self._virtual_time, self._client_tags[client]) + cost
+        self._client_tags[client] = tag
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (tag, next(self._seq), client, cost, waiter))
+        self._queued_by_client[client] += 1
+        self.queued_cost += cost
+
+        start = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已放行但调用方随即取消：归还名额
+                self.release(cost, 0.0)
+            else:
+                self._queued_by_client[client] -= 1
+                self.queued_cost -= cost
+            raise
+        self._record_wait(time.monotonic() - start)
+
+    def release(self, cost: float, elapsed: float) -> None:
+        if cost <= 0:
+            return
+        self.in_flight_cost -= cost
+        if elapsed > 0:
+            self._seconds_per_cost = 0.9 * self._seconds_per_cost + 0.1 * (elapsed / cost)
+        self._dispatch()
+
+    def snapshot(self, http: DashScopeClient) -> AdmissionStats:
+        return AdmissionStats(
+            capacity=self.capacity,
+            in_flight_cost=self.in_flight_cost,
+            queue_depth=sum(self._queued_by_client.values()),
+            queued_cost=self.queued_cost,
+            queue_depth_by_client={k: v for k, v in self._queued_by_client.items() if v > 0},
+            admitted=self.admitted,
+            rejected=self.rejected,
+            avg_wait_ms=(self._total_wait / self.admitted * 1000) if self.admitted else 0.0,
+            max_wait_ms=self._max_wait * 1000,
+            upstreams={name: self._upstream_stats(http, name) for name in http.limits},
+        )
+
+    @staticmethod
+    def _upstream_stats(http: DashScopeClient, name: str) -> UpstreamStats:
+        limit = http.limits[name]
+        resilience = http.resilience[name]
+        p95 = resilience.latency.percentile(0.95)
+        return UpstreamStats(
+            limit=limit.limit,
+            in_flight=limit.in_flight,
+            waiting=limit.waiting,
+            throttled=limit.throttled,
+            retries=resilience.retries,
+            hedges=resilience.hedges,
+            hedge_wins=resilience.hedge_wins,
+            breaker_state=resilience.breaker.state,
+            breaker_opened=resilience.breaker.opened,
+            p95_ms=p95 * 1000 if p95 is not None else None,
+        )
+
+
+# --- 4. 中间件 ---
+class AdmissionMiddleware(Middleware):
+    """
+    在工具调用进入执行前按成本与客户端进行准入控制。
+
+    客户端标识依次取 X-API-Key 请求头、Authorization 请求头（均只保留哈希前缀，不在统计中暴露密钥）、
+    MCP client_id、会话 ID。
+    """
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+    @staticmethod
+    def _client_identifier(context: MiddlewareContext) -> str:
+        headers = get_http_headers(include_all=True)
+        for header in ("x-api-key", "authorization"):
+            if headers.get(header):
+                return f"key:{hashlib.sha256(headers[header].encode('utf-8')).hexdigest()[:12]}"
+        ctx = context.fastmcp_context
+        if ctx is not None:
+            if ctx.client_id:
+                return ctx.client_id
+            try:
+                return ctx.session_id
+            except RuntimeError:
+                pass
+        return "anonymous"
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        cost = tool_cost(context.message.name, context.message.arguments)
+        with span("admission_queue", tool=context.message.name, cost=cost):
+            await self.controller.acquire(self._client_identifier(context), cost)
+        start = time.monotonic()
+        try:
+            return await call_next(context)
+        finally:
+            self.controller.release(cost, time.monotonic() - start)
+
+
+def create_admission_controller(config: Settings) -> AdmissionController:
+    return AdmissionController(
+        capacity=config.admission_capacity,
+        max_queued_cost=config.admission_max_queued_cost,
+        max_wait_seconds=config.admission_max_wait_seconds,
+    )
+
+
+# --- 5. 工具注册函数：register_admission_tools ---
+def register_admission_tools(mcp: FastMCP, controller: AdmissionController, http: DashScopeClient) -> None:
+    """
+    注册准入控制状态查询工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "get_admission_stats", "readOnlyHint": True}
+    )
+    async def get_admission_stats() -> AdmissionStats:
+        """
+        查询准入队列深度、等待时间、拒绝次数以及各上游（qwen / wanx）的并发上限、限流、重试、对冲与熔断状态。
+        """
+        return controller.snapshot(http)
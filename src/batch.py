@@ -0,0 +1,301 @@
+import asyncio
+import csv
+import json
+import os
+import re
+import time
+from typing import Annotated, AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Set, TextIO, Union
+
+from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool
+
+from .settings import settings
+from .http_client import DashScopeClient, UpstreamError
+from .cache import ResponseCache
+from .rate_limit import AdaptiveTokenBucket
+from .generate_content import content_cache_key, request_content_plan
+
+# 导入 FastMCP 类型
+from fastmcp import Context, FastMCP
+
+
+# --- 1. 定义输入/输出类型 ---
+class ProductInput(BaseModel):
+    """
+    批量生成中的单个商品。sku 用于断点续跑时识别已完成的条目，缺省时使用商品名。
+    """
+    sku: Annotated[Optional[str], Field(description="商品唯一编码，缺省时使用商品名")] = None
+    product_name: Annotated[str, Field(description="商品名称")]
+    product_features: Annotated[str, Field(description="核心卖点或特点描述")]
+    target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝")]
+    target_audience: Annotated[str, Field(description="目标受众")]
+    product_image_url: Annotated[Optional[str], Field(description="可选：原始产品图片URL")] = None
+
+    @property
+    def item_id(self) -> str:
+        return self.sku or self.product_name
+
+
+class BatchItemResult(BaseModel):
+    """
+    单个商品的生成结果，作为一行 JSONL 输出。
+    """
+    sku: str
+    status: Annotated[str, Field(description="ok 或 error")]
+    content: Annotated[Optional[str], Field(description="成功时为营销内容 JSON 字符串")] = None
+    error: Annotated[Optional[str], Field(description="失败时的错误信息")] = None
+    cached: bool = False
+    attempts: int = 0
+    latency_ms: float = 0.0
+
+
+class BatchResult(BaseModel):
+    """
+    批量生成汇总结果，file_content 为逐条结果的 JSONL。
+    """
+    file_content: Annotated[str, Field(description="每行一个商品结果的 JSONL 字符串")]
+    filename: Annotated[str, Field(description="生成结果文件名，例如: content_batch.jsonl")]
+    mime_type: Annotated[str, Field(description="返回的文件MIME类型, 为 application/x-ndjson")]
+    succeeded: int = 0
+    failed: int = 0
+    skipped: Annotated[int, Field(description="断点续跑时跳过的已完成条目数")] = 0
+
+
+# --- 2. 输入读取与断点 ---
+def iter_products_file(path: str) -> Iterator[ProductInput]:
+    """
+    流式读取 CSV（带表头）或 JSONL 商品文件，不一次性载入内存。无法解析的行抛出带行号的 ValueError。
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(f)
+            for row in reader:
+                try:
+                    yield ProductInput(**{k: v for k, v in row.items() if k and v not in (None, "")})
+                except ValueError as e:
+                    raise ValueError(f"商品文件第 {reader.line_num} 行无效: {e}") from e
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield ProductInput.model_validate_json(line)
+                    except ValueError as e:
+                        raise ValueError(f"商品文件第 {number} 行无效: {e}") from e
+
+
+def products_file_path(name: str) -> str:
+    """
+    将工具参数中的商品文件名解析为 batch_input_dir 下的路径，拒绝目录之外的文件。
+    """
+    if not settings.batch_input_dir:
+        raise ValueError("服务未配置 BATCH_INPUT_DIR，不支持按文件输入商品")
+    root = os.path.realpath(settings.batch_input_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"商品文件必须位于 BATCH_INPUT_DIR 下: {name}")
+    if not os.path.isfile(path):
+        raise ValueError(f"商品文件不存在: {name}")
+    return path
+
+
+async def _aiterate(products: Union[Iterable[ProductInput], AsyncIterable[ProductInput]]) -> AsyncIterator[ProductInput]:
+    if isinstance(products, AsyncIterable):
+        async for product in products:
+            yield product
+    else:
+        for product in products:
+            yield product
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """
+    读取已有的 JSONL 结果文件，返回已成功完成的 SKU。末尾写了一半的行与不是结果记录的行会被忽略。
+    """
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            sku = record.get("sku")
+            if record.get("status") == "ok" and isinstance(sku, str):
+                done.add(sku)
+    return done
+
+
+class CheckpointWriter:
+    """
+    逐行追加写入断点文件；创建目录、打开、写入与关闭都在线程池中执行，不阻塞事件循环。
+    path 为空时不写入。
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._file: Optional[TextIO] = None
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _append(self, line: str) -> None:
+        self._file.write(line + "\n")
+        self._file.flush()
+
+    async def __aenter__(self) -> "CheckpointWriter":
+        if self.path:
+            await asyncio.to_thread(self._open)
+        return self
+
+    async def write(self, line: str) -> None:
+        if self._file is not None:
+            await asyncio.to_thread(self._append, line)
+
+    async def __aexit__(self, *exc_info) -> None:
+        file, self._file = self._file, None
+        if file is not None:
+            await asyncio.to_thread(file.close)
+
+
+def checkpoint_path(batch_id: str) -> str:
+    safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", batch_id)
+    return os.path.join(settings.batch_checkpoint_dir, f"{safe_id}.jsonl")
+
+
+# --- 3. 核心批量调度 ---
+async def run_content_batch(http: DashScopeClient, cache: ResponseCache,
+                            products: Union[Iterable[ProductInput], AsyncIterable[ProductInput]],
+                            concurrency: int, rate_per_second: float,
+                            skip: Optional[Set[str]] = None) -> AsyncIterator[BatchItemResult]:
+    """
+    以有限并发和自适应令牌桶限速将商品分发到通义千问，按完成顺序逐条产出结果。
+
+    单个请求的限流与 5xx 重试由上游弹性策略（UpstreamResilience）负责，批量层不再叠加重试，
+    只在重试后仍被限流时降低后续商品的发送速率；错误记录到该条目的结果中，不影响其余商品。
+    products 可以是异步迭代器（如在线程池中逐行读取的商品文件）。skip 中的 SKU 视为已完成，直接跳过。
+    """
+    skip = skip or set()
+    limiter = AdaptiveTokenBucket(rate=rate_per_second)
+    pending: "asyncio.Queue[Optional[ProductInput]]" = asyncio.Queue(maxsize=concurrency * 2)
+    results: "asyncio.Queue[Optional[BatchItemResult]]" = asyncio.Queue()
+
+    async def process(product: ProductInput) -> BatchItemResult:
+        start = time.perf_counter()
+        key = content_cache_key(product.product_name, product.product_features, product.target_platform,
+                                product.target_audience, product.product_image_url)
+        try:
+            # 缓存命中时无需占用上游配额
+            content = await cache.get(key)
+            cached = content is not None
+            if content is None:
+                await limiter.acquire()
+                content, cached = await cache.get_or_compute(
+                    key,
+                    lambda: request_content_plan(http, product.product_name, product.product_features,
+                                                 product.target_platform, product.target_audience,
+                                                 product.product_image_url),
+                )
+                limiter.on_success()
+            return BatchItemResult(sku=product.item_id, status="ok", content=content, cached=cached,
+                                   attempts=1, latency_ms=(time.perf_counter() - start) * 1000)
+        except UpstreamError as e:
+            if e.is_throttled:
+                # 限流重试由上游弹性策略负责，这里只降低后续商品的发送速率
+                limiter.on_throttle()
+            error = str(e)
+        except Exception as e:
+            error = f"内容生成过程中发生内部错误: {str(e)}"
+        return BatchItemResult(sku=product.item_id, status="error", error=error,
+                               attempts=1, latency_ms=(time.perf_counter() - start) * 1000)
+
+    async def worker() -> None:
+        while (product := await pending.get()) is not None:
+            await results.put(await process(product))
+
+    async def produce() -> None:
+        async for product in _aiterate(products):
+            if product.item_id not in skip:
+                await pending.put(product)
+        for _ in range(concurrency):
+            await pending.put(None)
+
+    async def run_all() -> None:
+        try:
+            await asyncio.gather(produce(), *(worker() for _ in range(concurrency)))
+        finally:
+            await results.put(None)
+
+    runner = asyncio.create_task(run_all())
+    try:
+        while (item := await results.get()) is not None:
+            yield item
+        await runner
+    finally:
+        runner.cancel()
+
+
+# --- 4. 工具注册函数：register_batch_tools ---
+def register_batch_tools(mcp: FastMCP, http: DashScopeClient, cache: ResponseCache) -> None:
+    """
+    注册商品目录批量文案生成工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "generate_marketing_content_batch", "readOnlyHint": False}
+    )
+    async def generate_marketing_content_batch(
+        ctx: Context,
+        products: Annotated[Optional[List[ProductInput]], Field(description="待生成文案的商品列表；与 products_file 二选一")] = None,
+        products_file: Annotated[Optional[str], Field(description="可选：服务端 BATCH_INPUT_DIR 下的商品文件名，CSV（带表头）或 JSONL，逐行流式读取；与 products 二选一")] = None,
+        concurrency: Annotated[Optional[int], Field(description="可选：最大并发上游请求数", ge=1, le=64)] = None,
+        batch_id: Annotated[Optional[str], Field(description="可选：批次ID。提供时结果会写入服务端断点文件，重试同一批次将跳过已成功的SKU")] = None
+    ) -> BatchResult:
+        """
+        为整个商品目录批量生成营销文案。每完成一个商品即通过进度通知推送一行 JSONL 结果，单个商品失败不影响其余商品。
+        """
+        if (products is None) == (products_file is None):
+            raise ValueError("products 与 products_file 必须且只能提供一个")
+        if products_file is not None:
+            # 文件在线程池中逐行读取，商品总数事先未知
+            source = iterate_in_threadpool(iter_products_file(products_file_path(products_file)))
+            total = None
+        else:
+            source, total = products, len(products)
+        path = checkpoint_path(batch_id) if batch_id else None
+        done = await asyncio.to_thread(load_checkpoint, path) if path else set()
+        skipped = 0
+
+        async def todo() -> AsyncIterator[ProductInput]:
+            nonlocal skipped
+            async for product in _aiterate(source):
+                if product.item_id in done:
+                    skipped += 1
+                else:
+                    yield product
+
+        lines: List[str] = []
+        succeeded = failed = 0
+        async with CheckpointWriter(path) as checkpoint:
+            async for item in run_content_batch(http, cache, todo(), concurrency or settings.batch_max_concurrency,
+                                                settings.batch_rate_per_second):
+                line = item.model_dump_json()
+                lines.append(line)
+                if item.status == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+                await checkpoint.write(line)
+                await ctx.report_progress(progress=skipped + succeeded + failed, total=total, message=line)
+
+        return BatchResult(
+            file_content="\n".join(lines),
+            filename=f"{batch_id or 'content'}_batch.jsonl",
+            mime_type="application/x-ndjson",
+            succeeded=succeeded,
+            failed=failed,
+            skipped=skipped,
+        )
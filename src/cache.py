@@ -0,0 +1,306 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Annotated, Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+from fastmcp import FastMCP
+from fastmcp.utilities import logging
+
+from .state import StateBackend, StateBackendError
+
+logger = logging.get_logger(__name__)
+
+
+# --- 1. 键构造 ---
+def normalize_text(value: Optional[str]) -> str:
+    """
+    输入归一化：Unicode NFKC（全角/半角统一）、去首尾空白并折叠连续空白。
+    """
+    if value is None:
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", value).split())
+
+
+def make_cache_key(**parts: Any) -> str:
+    """
+    将参与生成的所有输入（归一化后的参数、系统提示词、模型名、采样参数）序列化后取 SHA-256。
+    """
+    canonical = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# --- 2. 统计信息 ---
+class CacheStats(BaseModel):
+    """
+    缓存命中统计。
+    """
+    hits: Annotated[int, Field(description="内存层命中次数")] = 0
+    disk_hits: Annotated[int, Field(description="磁盘层命中次数")] = 0
+    shared_hits: Annotated[int, Field(description="共享状态后端命中次数（含等待其他 worker 计算出的结果）")] = 0
+    misses: Annotated[int, Field(description="未命中、需要调用上游的次数")] = 0
+    collapsed: Annotated[int, Field(description="与进行中的相同请求合并、未单独调用上游的次数")] = 0
+    bypassed: Annotated[int, Field(description="调用方要求跳过缓存的次数")] = 0
+    evictions: Annotated[int, Field(description="内存层因容量或过期被淘汰的条目数")] = 0
+    memory_entries: Annotated[int, Field(description="当前内存层条目数")] = 0
+
+
+# --- 3. 磁盘层 (SQLite) ---
+class _DiskTier:
+    """
+    可选的 SQLite 磁盘层。所有操作在线程池中执行，避免阻塞事件循环。
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # 首次使用时才打开数据库，close() 之后再次使用会重新打开
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache(accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value, created_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # 先清理过期条目，再按最近访问时间淘汰超出容量的部分
+            conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# --- 4. 两级响应缓存 ---
+class ResponseCache:
+    """
+    内容寻址的响应缓存：内存 LRU 层 + 可选的共享状态层 + 可选的 SQLite 磁盘层，支持 TTL 与容量淘汰。
+
+    相同键的并发请求只会触发一次上游调用，其余调用方等待同一个结果（single-flight）。
+    配置共享状态后端时，single-flight 通过后端中的短期锁扩展到所有 worker 进程。
+    计算函数抛出的异常会传递给所有等待方，且不会写入缓存；计算方被取消（如截止时间到期）时
+    不影响等待方，由其中一个等待方接手计算。
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 86400.0,
+                 disk_path: Optional[str] = None, disk_max_entries: int = 10000,
+                 shared: Optional[StateBackend] = None, lock_seconds: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Future[str]"] = {}
+        self._shared = shared
+        self._disk = _DiskTier(disk_path, disk_max_entries, ttl_seconds) if disk_path else None
+        self.stats = CacheStats()
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if time.monotonic() - created_at > self.ttl_seconds:
+            del self._memory[key]
+            self.stats.evictions += 1
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: str) -> None:
+        self._memory[key] = (time.monotonic(), value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def _shared_get(self, key: str) -> Optional[str]:
+        if self._shared is None:
+            return None
+        try:
+            return await self._shared.get(f"cache:{key}")
+        except StateBackendError as e:
+            # 共享层故障时退化为仅使用本进程的缓存
+            logger.warning(f"Shared cache read failed: {e}")
+            return None
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._memory_get(key)
+        if value is not None:
+            self.stats.hits += 1
+            return value
+        value = await self._shared_get(key)
+        if value is not None:
+            self.stats.shared_hits += 1
+            self._memory_set(key, value)
+            return value
+        if self._disk is not None:
+            value = await asyncio.to_thread(self._disk.get, key)
+            if value is not None:
+                self.stats.disk_hits += 1
+                self._memory_set(key, value)
+                return value
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        self._memory_set(key, value)
+        if self._shared is not None:
+            try:
+                await self._shared.set(f"cache:{key}", value, self.ttl_seconds)
+            except StateBackendError as e:
+                logger.warning(f"Shared cache write failed: {e}")
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, value)
+
+    async def _compute_across_workers(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        只有取得共享锁的进程调用 compute；其他进程轮询共享层等待结果，
+        持锁进程失败（锁被释放而结果未写入）或等待超过 lock_seconds 时自行计算。
+        """
+        if self._shared is None:
+            return await compute()
+        lock = f"cache-lock:{key}"
+        try:
+            owner = await self._shared.set_if_absent(lock, "1", self.lock_seconds)
+        except StateBackendError:
+            return await compute()
+        if owner:
+            try:
+                return await compute()
+            finally:
+                try:
+                    await self._shared.delete(lock)
+                except StateBackendError:
+                    pass
+
+        deadline = time.monotonic() + self.lock_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            value = await self._shared_get(key)
+            if value is not None:
+                self.stats.shared_hits += 1
+                return value
+            try:
+                if await self._shared.get(lock) is None:
+                    break
+            except StateBackendError:
+                break
+        return await compute()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]],
+                             bypass: bool = False) -> Tuple[str, bool]:
+        """
+        返回 (value, cached)。bypass=True 时跳过读取，但仍用新结果刷新缓存。
+        """
+        if bypass:
+            self.stats.bypassed += 1
+        else:
+            value = await self.get(key)
+            if value is not None:
+                return value, True
+
+        joined = False
+        while (inflight := self._inflight.get(key)) is not None:
+            if not joined:
+                self.stats.collapsed += 1
+                joined = True
+            try:
+                return await asyncio.shield(inflight), False
+            except asyncio.CancelledError:
+                # 只有计算方被取消而本调用未被取消时，才接手计算；第一个醒来的等待方成为新的计算方
+                task = asyncio.current_task()
+                if not inflight.cancelled() or (task is not None and task.cancelling()):
+                    raise
+
+        self.stats.misses += 1
+        future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._compute_across_workers(key, compute)
+            await self.set(key, value)
+            future.set_result(value)
+            return value, False
+        except asyncio.CancelledError:
+            # 先移除再取消，等待方醒来时看不到已失效的计算，由其中一个重新计算
+            self._release(key, future)
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待方时取出异常，避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._release(key, future)
+
+    def _release(self, key: str, future: "asyncio.Future[str]") -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    def snapshot(self) -> CacheStats:
+        self.stats.memory_entries = len(self._memory)
+        return self.stats.model_copy()
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+
+
+# --- 5. 工具注册函数：register_cache_tools ---
+def register_cache_tools(mcp: FastMCP, cache: ResponseCache) -> None:
+    """
+    注册缓存统计查询工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "get_cache_stats", "readOnlyHint": True}
+    )
+    async def get_cache_stats() -> CacheStats:
+        """
+        查询文案生成缓存的命中、未命中、合并请求与淘汰次数。
+        """
+        return cache.snapshot()
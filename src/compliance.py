@@ -0,0 +1,373 @@
+import asyncio
+import json
+import re
+import time
+from typing import Annotated, Any, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+from .settings import settings
+from .cache import normalize_text
+from .metrics import metrics
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+
+
+# --- 1. 定义输出类型 ---
+class ComplianceFinding(BaseModel):
+    """
+    规则引擎命中的一类风险词。
+    """
+    term: Annotated[str, Field(description="命中的风险词")]
+    category: Annotated[str, Field(description="风险类别，如：绝对化用语、权威背书、站外导流")]
+    severity: Annotated[str, Field(description="high 为广告法明令禁止，medium 为平台规则限制或需佐证")]
+    scope: Annotated[str, Field(description="规则来源：通用（广告法）或具体平台")]
+    count: int = 1
+    positions: Annotated[List[int], Field(description="在文案中的字符起始位置（最多 5 个）")] = []
+    suggestion: str = ""
+
+
+class ComplianceReport(BaseModel):
+    """
+    单条文案的预检结果。
+    """
+    index: int
+    passed: Annotated[bool, Field(description="没有任何命中时为 true")]
+    findings: List[ComplianceFinding] = []
+
+
+class ComplianceBatchResult(BaseModel):
+    """
+    批量预检结果。
+    """
+    target_platform: str
+    scanned: int
+    flagged: Annotated[int, Field(description="存在风险的文案条数")]
+    elapsed_ms: float
+    reports: List[ComplianceReport]
+
+
+# --- 2. 规则 ---
+# 每条规则为 (风险词, 类别, 严重程度)；类别对应的修改建议见 SUGGESTIONS
+COMMON_RULES: List[Tuple[str, str, str]] = [
+    *((term, "绝对化用语", "high") for term in (
+        "最好", "最佳", "最优", "最强", "最棒", "最高级", "最先进", "最便宜", "最低价", "最受欢迎", "最畅销",
+        "第一", "首个", "首选", "唯一", "顶级", "顶尖", "极致", "独一无二", "史无前例", "无与伦比",
+        "全网第一", "销量第一", "排名第一", "NO.1", "TOP1", "绝对", "永久", "万能", "100%",
+    )),
+    *((term, "权威背书", "high") for term in (
+        "国家级", "世界级", "全球级", "国家免检", "驰名商标", "特供", "专供", "领导人推荐", "央视推荐", "机关推荐",
+    )),
+    *((term, "功效承诺", "high") for term in (
+        "无副作用", "立即见效", "立竿见影", "根治", "药到病除", "包治", "永不反弹", "零风险", "无效退款",
+    )),
+    *((term, "医疗用语", "medium") for term in (
+        "治疗", "治愈", "消炎", "抗炎", "杀菌", "祛疤", "生发", "药妆", "医美级", "处方",
+    )),
+    *((term, "虚假价格", "medium") for term in (
+        "史上最低价", "全网最低", "原价", "出厂价", "清仓价", "亏本", "跳楼价",
+    )),
+]
+
+PLATFORM_RULES: Dict[str, List[Tuple[str, str, str]]] = {
+    "小红书": [
+        *((term, "站外导流", "high") for term in (
+            "加微信", "加V", "vx", "微信号", "私信我", "私我", "淘宝搜", "拼多多", "京东", "二维码",
+        )),
+        *((term, "诱导互动", "medium") for term in (
+            "点赞过", "关注领取", "评论抽奖", "转发抽奖", "互粉", "求赞",
+        )),
+    ],
+    "抖音": [
+        *((term, "站外导流", "high") for term in (
+            "加微信", "加V", "vx", "微信号", "QQ群", "淘宝搜", "拼多多",
+        )),
+        *((term, "诱导互动", "medium") for term in (
+            "点赞过", "不转不是", "双击666", "刷礼物", "评论抽奖",
+        )),
+        *((term, "虚假价格", "high") for term in ("直播间最低价", "秒杀全网")),
+    ],
+    "淘宝": [
+        *((term, "站外导流", "high") for term in (
+            "加微信", "加V", "vx", "微信号", "QQ群", "拼多多", "京东", "抖音同款",
+        )),
+        *((term, "虚假交易", "high") for term in ("好评返现", "晒图返现", "刷单", "五星好评")),
+    ],
+}
+
+# 平台名称的常见写法
+PLATFORM_ALIASES = {
+    "小红书": "小红书", "红书": "小红书", "xiaohongshu": "小红书", "xhs": "小红书", "rednote": "小红书",
+    "抖音": "抖音", "douyin": "抖音", "tiktok": "抖音",
+    "淘宝": "淘宝", "天猫": "淘宝", "taobao": "淘宝", "tmall": "淘宝",
+}
+
+# 包含风险词但属于正常表达的短语，命中这些短语时忽略其中的风险词
+ALLOWED_PHRASES = (
+    "第一次", "第一步", "第一眼", "第一口", "第一时间", "第一天", "第一代", "唯一的缺点",
+    "100%棉", "100%纯棉", "100%羊毛", "100%桑蚕丝",
+    "治疗仪", "原价格",
+)
+
+SUGGESTIONS = {
+    "绝对化用语": "违反广告法第九条，改为具体、可验证的描述（如具体参数或对比对象）",
+    "权威背书": "不得使用国家机关或未经授权的权威名义，删除或替换为可提供证明的资质",
+    "功效承诺": "不得承诺效果或保证，改为使用体验描述并注明个体差异",
+    "医疗用语": "普通商品不得宣传医疗作用，改为日常护理类表述",
+    "虚假价格": "价格比较需有真实成交依据，避免无法证明的比较价格",
+    "站外导流": "平台禁止引导至站外或其他平台交易，删除联系方式与外部平台名称",
+    "诱导互动": "平台限制以利益诱导点赞、评论、关注，改为自然的话题引导",
+    "虚假交易": "平台禁止以返现等方式诱导好评，删除相关表述",
+}
+
+# 全角字符逐一折叠为半角并将英文转为小写；一对一映射，位置与原文一致
+_FOLD = {chr(cp): chr(cp - 0xFEE0).lower() for cp in range(0xFF01, 0xFF5F)}
+_FOLD["\u3000"] = " "
+_FOLD.update({c: c.lower() for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"})
+
+
+def fold(text: str) -> str:
+    return "".join(_FOLD.get(ch, ch) for ch in text)
+
+
+# --- 3. Aho–Corasick 自动机 ---
+class KeywordAutomaton:
+    """
+    多模式串匹配自动机：构建时间与词表总长成正比，扫描时间只与文本长度和命中数有关，
+    与词表大小无关，适合对大批量文案逐条扫描同一套词表。
+
+    失败链上的转移与输出在构建时合并到各状态，扫描时无需沿失败链回溯。
+    """
+
+    def __init__(self, patterns: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        self.patterns = patterns
+        for index, pattern in enumerate(patterns):
+            self._add(pattern, index)
+        self._build()
+
+    def _add(self, pattern: str, index: int) -> None:
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(index)
+
+    def _build(self) -> None:
+        # 按广度优先计算失败指针，并把失败状态的转移并入当前状态，得到完整的确定性转移表：
+        # 扫描时每个字符只需一次字典查找，不在任何模式串中的字符直接回到根状态
+        order = list(self._goto[0].values())
+        head = 0
+        while head < len(order):
+            state = order[head]
+            head += 1
+            for ch, nxt in self._goto[state].items():
+                order.append(nxt)
+                self._fail[nxt] = self._goto[self._fail[state]].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+            self._goto[state] = {**self._goto[self._fail[state]], **self._goto[state]}
+        self.lengths = [len(p) for p in self.patterns]
+        # 处于根状态时用正则（C 实现）跳过不可能开始匹配的字符
+        self._next_start = re.compile("[" + re.escape("".join(self._goto[0])) + "]").search if self._goto[0] else None
+
+    def finditer(self, text: str) -> List[Tuple[int, int]]:
+        """
+        返回所有命中的 (起始位置, 模式串下标)，允许重叠。
+        """
+        goto, out, lengths, next_start = self._goto, self._out, self.lengths, self._next_start
+        hits: List[Tuple[int, int]] = []
+        if next_start is None:
+            return hits
+        state, pos, end = 0, 0, len(text)
+        while pos < end:
+            if not state:
+                match = next_start(text, pos)
+                if match is None:
+                    break
+                pos = match.start()
+            state = goto[state].get(text[pos], 0)
+            if out[state]:
+                for index in out[state]:
+                    hits.append((pos - lengths[index] + 1, index))
+            pos += 1
+        return hits
+
+
+# --- 4. 扫描 ---
+class RuleSet:
+    """
+    一个平台的完整规则（通用规则 + 平台规则 + 放行短语）编译成的自动机。
+    """
+
+    def __init__(self, platform: Optional[str], extra_rules: Dict[str, List[Tuple[str, str, str]]]):
+        self.platform = platform
+        rules: Dict[str, Tuple[str, str, str]] = {}
+        for scope, entries in (("通用", COMMON_RULES + extra_rules.get("通用", [])),
+                               (platform, PLATFORM_RULES.get(platform or "", []) + extra_rules.get(platform or "", []))):
+            for term, category, severity in entries:
+                # 同一个词在平台规则中重复出现时以平台规则为准
+                rules[fold(term)] = (category, severity, scope or "通用")
+        self.terms = list(rules)
+        self.rules = [rules[t] for t in self.terms]
+        allowed = [fold(p) for p in ALLOWED_PHRASES if fold(p) not in rules]
+        self._allowed_from = len(self.terms)
+        self.automaton = KeywordAutomaton(self.terms + allowed)
+        # 只折叠可能影响匹配的字符（折叠后出现在词表中），其余字符原样保留
+        alphabet = set("".join(self.automaton.patterns))
+        foldable = "".join(c for c, folded in _FOLD.items() if folded in alphabet and folded != c)
+        self._fold = re.compile("[" + re.escape(foldable) + "]").sub if foldable else None
+
+    def scan(self, text: str) -> List[ComplianceFinding]:
+        folded = self._fold(lambda m: _FOLD[m.group()], text) if self._fold is not None else text
+        hits = self.automaton.finditer(folded)
+        if not hits:
+            return []
+        lengths = self.automaton.lengths
+
+        # 按起始位置、长度从长到短处理：被更长的命中或放行短语完全覆盖的命中跳过
+        # （如“全网第一”中的“第一”、“第一次”中的“第一”）
+        grouped: Dict[int, ComplianceFinding] = {}
+        covered_to = -1
+        for start, index in sorted(hits, key=lambda h: (h[0], -lengths[h[1]])):
+            end = start + lengths[index]
+            if end <= covered_to:
+                continue
+            covered_to = end
+            if index >= self._allowed_from:
+                continue
+            finding = grouped.get(index)
+            if finding is None:
+                category, severity, scope = self.rules[index]
+                # 字段均由规则表生成，跳过校验以降低大批量扫描的开销
+                grouped[index] = ComplianceFinding.model_construct(
+                    term=text[start:end], category=category, severity=severity, scope=scope, count=1,
+                    positions=[start], suggestion=SUGGESTIONS.get(category, ""),
+                )
+            else:
+                finding.count += 1
+                if len(finding.positions) < 5:
+                    finding.positions.append(start)
+        findings = sorted(grouped.values(), key=lambda f: (f.severity != "high", f.positions[0]))
+        for finding in findings:
+            metrics.compliance_findings.inc(finding.count, scope=finding.scope, category=finding.category)
+        return findings
+
+
+def canonical_platform(target_platform: str) -> Optional[str]:
+    name = normalize_text(target_platform).lower()
+    if name in PLATFORM_ALIASES:
+        return PLATFORM_ALIASES[name]
+    return next((p for alias, p in PLATFORM_ALIASES.items() if alias in name), None)
+
+
+def _load_extra_rules() -> Dict[str, List[Tuple[str, str, str]]]:
+    """
+    读取 COMPLIANCE_RULES_PATH 指定的附加词表：{"通用" 或平台名: [[风险词, 类别, 严重程度], ...]}。
+    """
+    if not settings.compliance_rules_path:
+        return {}
+    with open(settings.compliance_rules_path, encoding="utf-8") as f:
+        data = json.load(f)
+    extra: Dict[str, List[Tuple[str, str, str]]] = {}
+    for scope, entries in data.items():
+        key = scope if scope == "通用" else (canonical_platform(scope) or scope)
+        extra.setdefault(key, []).extend((str(e[0]), str(e[1]), str(e[2]) if len(e) > 2 else "medium") for e in entries)
+    return extra
+
+
+_rule_sets: Dict[Optional[str], RuleSet] = {}
+_extra_rules: Optional[Dict[str, List[Tuple[str, str, str]]]] = None
+
+
+def rule_set(target_platform: str) -> RuleSet:
+    """
+    按平台编译并缓存规则集，自动机只在每个平台首次使用时构建一次。
+    """
+    global _extra_rules
+    if _extra_rules is None:
+        _extra_rules = _load_extra_rules()
+    platform = canonical_platform(target_platform)
+    rules = _rule_sets.get(platform)
+    if rules is None:
+        rules = _rule_sets[platform] = RuleSet(platform, _extra_rules)
+    return rules
+
+
+def scan_copy(copywriting: str, target_platform: str) -> List[ComplianceFinding]:
+    return rule_set(target_platform).scan(copywriting or "")
+
+
+def scan_many(copies: List[str], target_platform: str) -> List[ComplianceReport]:
+    rules = rule_set(target_platform)
+    reports = []
+    for index, copy in enumerate(copies):
+        findings = rules.scan(copy or "")
+        reports.append(ComplianceReport(index=index, passed=not findings, findings=findings))
+    return reports
+
+
+def describe(finding: ComplianceFinding) -> str:
+    """
+    转换为与模型输出的 compliance_risk 相同形式的一句话提示。
+    """
+    times = f"（出现 {finding.count} 次）" if finding.count > 1 else ""
+    scope = "" if finding.scope == "通用" else f"{finding.scope}平台规则："
+    return f"[规则预检] {scope}“{finding.term}”属于{finding.category}{times}，{finding.suggestion}。"
+
+
+def merge_findings(guide: Dict[str, Any], findings: List[ComplianceFinding]) -> Dict[str, Any]:
+    """
+    将本地预检结果并入指导方案：提示放在 compliance_risk 最前面，
+    明细写入 compliance_findings；模型已经指出的同一个词不再重复提示。
+    """
+    risks = guide.get("compliance_risk")
+    if not isinstance(risks, list):
+        risks = [risks] if risks else []
+    mentioned = " ".join(str(r) for r in risks)
+    local = [describe(f) for f in findings if f.term not in mentioned]
+    guide["compliance_risk"] = local + risks
+    guide["compliance_findings"] = [f.model_dump() for f in findings]
+    return guide
+
+
+# --- 5. 工具注册函数：register_compliance_tools ---
+# 超过该条数的批量扫描放到线程中执行，避免长时间占用事件循环
+_THREAD_THRESHOLD = 200
+
+
+def register_compliance_tools(mcp: FastMCP) -> None:
+    """
+    注册不调用模型的批量合规预检工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "check_copy_compliance", "readOnlyHint": True}
+    )
+    async def check_copy_compliance(
+        copies: Annotated[List[str], Field(description="待检查的文案列表")],
+        target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝；其他平台只检查广告法通用规则")],
+    ) -> ComplianceBatchResult:
+        """
+        以本地规则快速检查文案中的广告法违禁词与平台违规用语（绝对化用语、站外导流等），不调用模型，适合大批量文案。
+        """
+        start = time.perf_counter()
+        if len(copies) > _THREAD_THRESHOLD:
+            reports = await asyncio.to_thread(scan_many, copies, target_platform)
+        else:
+            reports = scan_many(copies, target_platform)
+        return ComplianceBatchResult(
+            target_platform=canonical_platform(target_platform) or target_platform,
+            scanned=len(reports),
+            flagged=sum(1 for r in reports if not r.passed),
+            elapsed_ms=round((time.perf_counter() - start) * 1000, 2),
+            reports=reports,
+        )
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from mcp import McpError
+from mcp.types import ErrorData
+
+from fastmcp.server.dependencies import get_http_headers
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.utilities import logging
+
+from .settings import Settings
+from .metrics import metrics
+
+logger = logging.get_logger(__name__)
+
+# 当前工具调用的截止时刻（time.monotonic()），由 DeadlineMiddleware 设置；
+# 调用内创建的子任务复制同一上下文，共享同一截止时间
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    工具调用已超过截止时间，不再发起或继续上游请求。不属于上游故障，不重试、不计入熔断。
+    """
+
+
+# --- 1. 截止时间查询 ---
+def remaining() -> Optional[float]:
+    """
+    当前调用剩余的秒数；不在工具调用中或未设置截止时间时返回 None。
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def upstream_timeout(timeout: float) -> float:
+    """
+    上游请求的超时取固定超时与剩余时间中较小者；已超过截止时间时直接抛出 DeadlineExceeded。
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("请求已超过截止时间，未发起上游调用")
+    return min(timeout, left)
+
+
+def clear() -> None:
+    """
+    在由工具调用间接创建、但生命周期独立于该调用的后台任务（如异步图像任务的 worker）开头调用，
+    避免继承发起调用的截止时间。
+    """
+    _deadline.set(None)
+
+
+# --- 2. 中间件 ---
+class DeadlineMiddleware(Middleware):
+    """
+    为每次工具调用设置截止时间：依次取 MCP 请求 _meta 中的 timeout_ms、X-Request-Timeout 请求头（秒）、
+    REQUEST_DEADLINE_SECONDS。截止时间包含准入排队，传递到各上游请求的超时；到期后取消整个调用并返回错误。
+
+    客户端取消（notifications/cancelled）或断开连接时，调用所在的任务被取消，
+    进行中的上游请求随之中止并立即释放并发名额。
+    """
+
+    def __init__(self, config: Settings):
+        self.config = config
+
+    def _budget(self, context: MiddlewareContext) -> Optional[float]:
+        requested: Any = None
+        ctx = context.fastmcp_context
+        request = ctx.request_context if ctx is not None else None
+        if request is not None and request.meta is not None:
+            requested = (request.meta.model_extra or {}).get("timeout_ms")
+            if requested is not None:
+                try:
+                    requested = float(requested) / 1000
+                except (TypeError, ValueError):
+                    requested = None
+        if requested is None:
+            header = get_http_headers(include_all=True).get("x-request-timeout")
+            try:
+                requested = float(header) if header else None
+            except ValueError:
+                requested = None
+        if requested is not None and requested > 0:
+            return min(requested, self.config.request_deadline_max_seconds)
+        return self.config.request_deadline_seconds or None
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        budget = self._budget(context)
+        if budget is None:
+            return await call_next(context)
+        token = _deadline.set(time.monotonic() + budget)
+        try:
+            async with asyncio.timeout(budget) as scope:
+                return await call_next(context)
+        except TimeoutError:
+            if not scope.expired():
+                raise
+            metrics.tool_deadline_exceeded.inc(tool=context.message.name)
+            logger.warning(f"Tool call {context.message.name} exceeded its {budget:g}s deadline and was cancelled")
+            raise McpError(ErrorData(code=-32000, message=f"工具调用超过截止时间 {budget:g} 秒，已取消"))
+        finally:
+            _deadline.reset(token)
@@ -0,0 +1,25 @@
+from typing import Optional
+
+import httpx
+
+
+class UpstreamError(Exception):
+    """
+    DashScope 返回的业务错误码或非 2xx HTTP 状态，保留原始响应便于工具输出详细信息。
+    """
+
+    def __init__(self, message: str, response: Optional[httpx.Response] = None, code: Optional[str] = None):
+        super().__init__(message)
+        self.response = response
+        self.code = code
+
+    @property
+    def status_code(self) -> Optional[int]:
+        return self.response.status_code if self.response is not None else None
+
+    @property
+    def is_throttled(self) -> bool:
+        """
+        DashScope 限流：HTTP 429 或 Throttling 系列错误码（如 Throttling.RateQuota）。
+        """
+        return self.status_code == 429 or (self.code or "").startswith("Throttling")
@@ -1,14 +1,21 @@
 import json
-import requests
 import os
-from typing import Annotated, Optional
+from typing import Annotated, Any, Dict, Optional
 from pydantic import Field, BaseModel
 
 from .settings import settings
+from .http_client import DashScopeClient, UpstreamError
+from .cache import ResponseCache, make_cache_key, normalize_text
+from .image_ingest import ImageIngestError, ImageIngestor
+from .prompts import fit_text, system_message
+from .output import ContentPlan, OutputFormatError
+from .routing import model_router
+from .similarity import SimilarityIndex, namespace, record_lookup
+from .streaming import DeltaCallback, progress_forwarder
 
 # 导入 FastMCP 类型
 # 确保您已经正确安装 fast-mcp
-from fastmcp import FastMCP 
+from fastmcp import Context, FastMCP
 
 # --- 1. 定义输出类型 ---
 class ContentResult(BaseModel):
@@ -25,21 +32,163 @@ class ContentResult(BaseModel):
 # # 统一使用 OpenAI 兼容模式的 Endpoint
 # AI_API_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
 # # 使用支持结构化输出和多模态的 Qwen 模型
-# MODEL_NAME = "qwen2.5-omni-7b" 
+# MODEL_NAME = "qwen2.5-omni-7b"
 
+# 系统提示词逐字节固定，作为所有文案请求的公共前缀，便于 DashScope 复用上下文缓存；
+# 随请求变化的内容只放在用户消息中
 SYSTEM_PROMPT = """
 你是一位资深的营销专家AI。你的任务是根据提供的商品信息和目标平台，生成高转化文案，并输出严格的JSON结构：
 {"copywriting": "文案", "key_elements": ["卖点", "标签"], "image_prompt": "图像指令 (英文)", "score": 8.5}
 请确保你的回复中只包含一个完整的JSON对象，不要有任何前言、解释或额外的文本。
 """
 
-# --- 3. 工具注册函数：register_content_tools (含多模态可选逻辑) ---
-def register_content_tools(mcp: FastMCP) -> None:
+TOOL_NAME = "generate_marketing_content"
+
+# 采样参数同时参与缓存键计算，修改后旧缓存自动失效
+SAMPLING_PARAMS = {"top_p": 0.8, "temperature": 0.7}
+
+
+# --- 3. 核心生成逻辑 (供工具、批量与流水线复用) ---
+def content_cache_key(product_name: str, product_features: str, target_platform: str,
+                      target_audience: str, product_image_url: Optional[str] = None) -> str:
     """
-    注册电商内容中台的文案生成工具。
+    基于归一化输入、SYSTEM_PROMPT、模型路由配置与采样参数计算内容寻址缓存键。
     """
-    
-    
+    return make_cache_key(
+        product_name=normalize_text(product_name),
+        product_features=normalize_text(product_features),
+        target_platform=normalize_text(target_platform),
+        target_audience=normalize_text(target_audience),
+        product_image_url=(product_image_url or "").strip(),
+        system_prompt=SYSTEM_PROMPT,
+        model=model_router.signature(),
+        sampling=SAMPLING_PARAMS,
+    )
+
+
+def build_content_payload(product_name: str, product_features: str, target_platform: str,
+                          target_audience: str, product_image_url: Optional[str] = None,
+                          reference: Optional[str] = None) -> Dict[str, Any]:
+    """
+    构建文案生成的 Chat Completion 请求体（供单次生成与多变体生成复用）。
+    reference 为相似请求的历史文案，提供时作为风格参考附在用户消息末尾。
+    """
+
+    # ❗ 在这里引用配置中的值
+    MODEL_NAME = settings.qwen_model_name
+
+    # 超长输入在发送前去重并按句截断，控制输入 token
+    short_limit = settings.prompt_short_field_max_tokens
+    product_name = fit_text(product_name, short_limit, TOOL_NAME, "product_name")
+    product_features = fit_text(product_features, settings.prompt_features_max_tokens, TOOL_NAME, "product_features")
+    target_platform = fit_text(target_platform, short_limit, TOOL_NAME, "target_platform")
+    target_audience = fit_text(target_audience, short_limit, TOOL_NAME, "target_audience")
+
+    # 1. 构建基础的用户指令文本
+    user_prompt = f"""
+    --- 商品信息 ---
+    商品名: {product_name}
+    核心特点: {product_features}
+    --- 营销目标 ---
+    目标平台: {target_platform}
+    目标受众: {target_audience}
+
+    请严格遵循系统提示中的 JSON 格式输出。
+    """
+
+    if reference:
+        # 参考文案放在用户消息中，系统提示词前缀保持不变
+        reference = fit_text(reference, settings.prompt_features_max_tokens, TOOL_NAME, "reference")
+        user_prompt += f"\n\n参考文案（来自相似商品，保持风格与结构，按本次卖点调整，不要照抄）：\n{reference}"
+
+    # 2. 动态构建用户消息内容数组
+    user_content_array = []
+
+    if product_image_url:
+        # 强化 Prompt，告知模型已提供图片
+        user_prompt += "\n\n请注意：您已收到原始图片，请结合图片的风格和氛围，给出高度相关的图像生成指令(image_prompt)。"
+
+        # 添加图片对象 (多模态输入结构)
+        user_content_array.append(
+            {"type": "image_url", "image_url": {"url": product_image_url}}
+        )
+    else:
+        # 强化 Prompt，告知模型未提供图片
+         user_prompt += "\n\n请注意：未收到原始图片，请仅根据文字描述，发挥创造力给出图像生成指令(image_prompt)。"
+
+    # 始终添加文本指令
+    user_content_array.append(
+        {"type": "text", "text": user_prompt}
+    )
+
+    # 3. 遵循 OpenAI 兼容 API 结构构建 Payload
+    return {
+        "model": MODEL_NAME,
+        "messages": [
+            system_message(SYSTEM_PROMPT),
+            {"role": "user", "content": user_content_array}
+        ],
+        "response_format": {"type": "json_object"},
+        "stream": False,
+        **SAMPLING_PARAMS,
+    }
+
+
+async def request_content_plan(http: DashScopeClient, product_name: str, product_features: str,
+                               target_platform: str, target_audience: str,
+                               product_image_url: Optional[str] = None,
+                               on_delta: Optional[DeltaCallback] = None,
+                               reference: Optional[str] = None) -> str:
+    """
+    调用通义千问生成营销内容方案，返回经过结构校验的 JSON 字符串；失败时抛出异常。
+
+    提供 on_delta 时以流式方式调用上游，并将增量输出逐段交给 on_delta；reference 为可选的参考文案。
+    """
+    payload = build_content_payload(product_name, product_features, target_platform, target_audience,
+                                    product_image_url, reference)
+
+    # 通过共享连接池异步发送，max_tokens 按本工具近期输出长度设置；流式模式下结构出错时提前终止
+    # 合法的输出原样返回，不再重新序列化；代码块、多余文字与截断在本地修复，仍不合法时重问一次
+    # 按输入规模、图片与平台选择模型路由，快速模型的输出不合格时升级到更大的模型
+    try:
+        parsed = await model_router.complete(http, TOOL_NAME, payload, ContentPlan, 30,
+                                             settings.content_default_max_tokens, platform=target_platform,
+                                             on_delta=on_delta)
+    except OutputFormatError as e:
+        raise ValueError(f"AI返回内容格式错误: {e}; 原始输出: {e.text[:100]}...") from e
+    return parsed.text
+
+
+def content_error_result(e: Exception) -> ContentResult:
+    """
+    将生成过程中的异常封装为错误报告，保持工具始终返回 ContentResult。
+    """
+    if isinstance(e, UpstreamError):
+        error_msg = f"API调用失败 (HTTP/DashScope Error): {str(e)}"
+        if e.response is not None and e.response.text:
+             error_msg += f"\n详细信息: {e.response.text}"
+    elif isinstance(e, ImageIngestError):
+        error_msg = f"输入图片校验失败: {str(e)}"
+    else:
+        # 处理其他如网络、解析或Key未设置错误
+        error_msg = f"内容生成过程中发生内部错误: {str(e)}"
+
+    return ContentResult(
+        file_content=json.dumps({"error": error_msg}, ensure_ascii=False, indent=2),
+        filename="error_report.json",
+        mime_type="application/json"
+    )
+
+
+# --- 4. 工具注册函数：register_content_tools (含多模态可选逻辑) ---
+def register_content_tools(mcp: FastMCP, http: DashScopeClient, cache: ResponseCache, images: ImageIngestor,
+                           similar: Optional[SimilarityIndex] = None) -> None:
+    """
+    注册电商内容中台的文案生成工具。http 为共享连接池客户端，cache 为文案响应缓存，
+    images 在调用上游前预取并校验输入图片，similar 为可选的近似重复索引。
+    """
+
+
     @mcp.tool(
         annotations={"title": "generate_marketing_content", "readOnlyHint": False}
     )
@@ -48,97 +197,49 @@ def register_content_tools(mcp: FastMCP) -> None:
         product_features: Annotated[str, Field(description="核心卖点或特点描述，如：轻至20g，主动降噪45dB")],
         target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝")],
         target_audience: Annotated[str, Field(description="目标受众，如：都市白领, 学生党")],
+        ctx: Context,
         # ❗ 设置为可选参数，默认为 None
-        product_image_url: Annotated[Optional[str], Field(description="可选：原始产品图片URL，用于模型分析视觉元素和生成图像指令。")] = None 
+        product_image_url: Annotated[Optional[str], Field(description="可选：原始产品图片URL，用于模型分析视觉元素和生成图像指令。")] = None,
+        use_cache: Annotated[bool, Field(description="是否使用缓存结果；设为 false 时强制重新生成并刷新缓存")] = True,
+        stream: Annotated[bool, Field(description="是否流式生成；开启后模型的部分输出会通过进度通知实时推送，最终结果不变")] = False
     ) -> ContentResult:
         """
         根据商品信息和可选的图片，一键生成结构化的营销文案、爆款要素、吸引力评分和图像生成指令。
         """
-        
-        # ❗ 在这里引用配置中的值
-        AI_API_URL = settings.qwen_api_endpoint
-        MODEL_NAME = settings.qwen_model_name
-        API_KEY = settings.ai_api_key.get_secret_value()
-        
-        
-        # 1. 构建基础的用户指令文本
-        user_prompt = f"""
-        --- 商品信息 ---
-        商品名: {product_name}
-        核心特点: {product_features}
-        --- 营销目标 ---
-        目标平台: {target_platform}
-        目标受众: {target_audience}
-        
-        请严格遵循系统提示中的 JSON 格式输出。
-        """
-        
-        # 2. 动态构建用户消息内容数组
-        user_content_array = []
-
-        if product_image_url:
-            # 强化 Prompt，告知模型已提供图片
-            user_prompt += "\n\n请注意：您已收到原始图片，请结合图片的风格和氛围，给出高度相关的图像生成指令(image_prompt)。"
-            
-            # 添加图片对象 (多模态输入结构)
-            user_content_array.append(
-                {"type": "image_url", "image_url": {"url": product_image_url}}
-            )
-        else:
-            # 强化 Prompt，告知模型未提供图片
-             user_prompt += "\n\n请注意：未收到原始图片，请仅根据文字描述，发挥创造力给出图像生成指令(image_prompt)。"
 
-        # 始终添加文本指令
-        user_content_array.append(
-            {"type": "text", "text": user_prompt}
-        )
-        
-        # --- 3. 构建并发送请求 Payload ---
+        key = content_cache_key(product_name, product_features, target_platform, target_audience, product_image_url)
+
+        async def compute() -> str:
+            # 坏链接、格式不支持的图片在此快速失败，不必等待上游超时
+            image_url = await images.resolve(product_image_url)
+
+            # 精确缓存未命中时查找近似请求：几乎相同则直接复用，较相似则以其文案为参考生成
+            reference = None
+            if similar is not None:
+                # 命名空间包含商品名：特点描述相近的不同商品不会复用或参考彼此的文案
+                space = namespace(TOOL_NAME, product_name, target_platform, target_audience, product_image_url)
+                text = f"{product_name}\n{product_features}"
+                hit_threshold = settings.semantic_hit_threshold if use_cache else float("inf")
+                warm_threshold = settings.semantic_warm_threshold
+                min_score = min(warm_threshold, hit_threshold) if warm_threshold > 0 else hit_threshold
+                match = await similar.lookup(space, text, min_score) if min_score <= 1 else None
+                outcome = record_lookup(TOOL_NAME, match, hit_threshold)
+                if outcome == "hit":
+                    return match.output
+                if outcome == "warm":
+                    reference = json.loads(match.output).get("copywriting")
+
+            result = await request_content_plan(http, product_name, product_features, target_platform,
+                                                target_audience, image_url,
+                                                on_delta=progress_forwarder(ctx) if stream else None,
+                                                reference=reference)
+            if similar is not None:
+                await similar.add(space, text, result)
+            return result
+
         try:
-            # 遵循 OpenAI 兼容 API 结构
-            payload = {
-                "model": MODEL_NAME,
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_content_array}
-                ],
-                "response_format": {"type": "json_object"}, 
-                "stream": False,
-                "top_p": 0.8,
-                "temperature": 0.7,
-            }
-            
-
-
-            headers = {
-                "Authorization": f"Bearer {API_KEY}", 
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(AI_API_URL, headers=headers, json=payload, timeout=30)
-            response_data = response.json()
-            
-            # 检查 DashScope 错误码
-            if response_data.get('code'):
-                error_code = response_data.get('code')
-                error_message = response_data.get('message', '未知API错误')
-                # 使用 HTTPError 封装 DashScope 错误，便于统一处理
-                raise requests.HTTPError(f"DashScope API Error: [{error_code}] {error_message}", response=response)
-
-            response.raise_for_status() # 检查 HTTP 状态码
-
-            # 提取路径：choices[0] -> message -> content
-            # 注意：content 是模型最终生成的 JSON 字符串
-            ai_response_json_string = response_data.get('choices', [{}])[0].get('message', {}).get('content', '{}')
-
-            # 验证模型返回的内容是否为有效的 JSON
-            try:
-                json_content = json.loads(ai_response_json_string)
-                # 重新封装为美化的 JSON 字符串（可选）
-                final_json_string = json.dumps(json_content, ensure_ascii=False, indent=2)
-            except json.JSONDecodeError:
-                # 如果返回的不是严格的 JSON
-                raise ValueError(f"AI返回内容格式错误，不是有效的JSON: {ai_response_json_string[:100]}...")
+            # 相同输入命中缓存直接返回；并发的相同请求合并为一次上游调用
+            final_json_string, _ = await cache.get_or_compute(key, compute, bypass=not use_cache)
 
             # --- 结果封装与返回 ---
             return ContentResult(
@@ -147,20 +248,5 @@ def register_content_tools(mcp: FastMCP) -> None:
                 mime_type="application/json"
             )
 
-        except requests.HTTPError as http_e:
-            error_msg = f"API调用失败 (HTTP/DashScope Error): {str(http_e)}"
-            if http_e.response and http_e.response.text:
-                 error_msg += f"\n详细信息: {http_e.response.text}"
-            
-            return ContentResult(
-                file_content=json.dumps({"error": error_msg}, ensure_ascii=False, indent=2),
-                filename="error_report.json",
-                mime_type="application/json"
-            )
         except Exception as e:
-            # 处理其他如网络、解析或Key未设置错误
-            return ContentResult(
-                file_content=json.dumps({"error": f"内容生成过程中发生内部错误: {str(e)}"}, ensure_ascii=False, indent=2),
-                filename="error_report.json",
-                mime_type="application/json"
-            )
\ No newline at end of file
+            return content_error_result(e)
@@ -1,13 +1,20 @@
 import json
-import requests
 import os
 from typing import Annotated, Optional
 from pydantic import Field, BaseModel
 
 from .settings import settings
+from .http_client import DashScopeClient
+from .image_ingest import ImageIngestError, ImageIngestor
+from .prompts import fit_text, system_message
+from .output import LaunchGuide, OutputFormatError
+from .routing import model_router
+from .compliance import merge_findings, scan_copy
+from .similarity import SimilarityIndex, namespace, record_lookup
+from .streaming import DeltaCallback, progress_forwarder
 
 # 导入 FastMCP 类型
-from fastmcp import FastMCP 
+from fastmcp import Context, FastMCP 
 
 # --- 1. 定义输出类型 (保持不变) ---
 class GuideResult(BaseModel):
@@ -37,107 +44,186 @@ GUIDE_SYSTEM_PROMPT = """
 5. "launch_checklist": ["发布前需检查的事项清单。"]
 """
 
-# --- 3. 工具注册函数：register_guide_tools (已集成 OpenAI 兼容多模态 API) ---
-def register_guide_tools(mcp: FastMCP) -> None:
+TOOL_NAME = "get_launch_strategy"
+
+# --- 3. 核心生成逻辑 (供工具与流水线复用) ---
+class GuideFormatError(ValueError):
+    """
+    模型返回的指导方案不是有效的 JSON。
+    """
+
+
+async def _generate_guide(http: DashScopeClient, generated_copywriting: str, target_platform: str,
+                          generated_image_url: Optional[str], on_delta: Optional[DeltaCallback]) -> str:
+    MODEL_NAME = settings.qwen_model_name
+
+    # 超长文案在发送前去重并按句截断，控制输入 token
+    generated_copywriting = fit_text(generated_copywriting, settings.prompt_copywriting_max_tokens,
+                                     TOOL_NAME, "generated_copywriting")
+    target_platform = fit_text(target_platform, settings.prompt_short_field_max_tokens, TOOL_NAME, "target_platform")
+
+    image_analysis_instruction = ""
+    user_content_array = []
+
+    if generated_image_url and generated_image_url.strip():
+        image_analysis_instruction = "请结合图片URL对视觉风格、构图和转化潜力进行详细评估。"
+        user_content_array.append(
+            {"type": "image_url", "image_url": {"url": generated_image_url}}
+        )
+    else:
+        # 图片缺失，仅文本分析
+        image_analysis_instruction = "图片URL未提供，请重点评估文案与平台规则的契合度，跳过视觉风格评估部分。"
+
+
+    # 1. 构建用户输入 Prompt/指令
+    user_instruction = f"""
+    请分析以下内容，并提供指导方案：
+    目标平台: {target_platform}
+    待分析文案: {generated_copywriting}
+    请严格遵循系统提示中的 JSON 格式输出。
+    {image_analysis_instruction}
+    """
+
+    user_content_array.append(
+        {"type": "text", "text": user_instruction}
+    )
+
+    # 2. 遵循 OpenAI 兼容 API 结构构建 Payload (多模态输入)
+    payload = {
+        "model": MODEL_NAME,
+        "messages": [
+            system_message(GUIDE_SYSTEM_PROMPT),
+            {"role": "user","content": user_content_array}
+        ],
+        # 关键：开启 JSON 结构化输出
+        "response_format": {"type": "json_object"},
+
+        # 可选参数
+        "stream": False,
+        "top_p": 0.8,
+        "temperature": 0.7,
+    }
+
+    # max_tokens 按本工具近期输出长度设置；流式模式下结构出错时提前终止
+    # 按输入规模、图片与平台选择模型路由，快速模型的输出不合格时升级到更大的模型
+    try:
+        parsed = await model_router.complete(http, TOOL_NAME, payload, LaunchGuide, 60,
+                                             settings.guide_default_max_tokens, platform=target_platform,
+                                             on_delta=on_delta)
+    except OutputFormatError as e:
+        raise GuideFormatError(f"AI返回的指导方案格式不正确: {e}") from e
+    return parsed.text
+
+
+async def request_launch_strategy(http: DashScopeClient, generated_copywriting: str, target_platform: str,
+                                  generated_image_url: Optional[str] = None,
+                                  on_delta: Optional[DeltaCallback] = None,
+                                  similar: Optional[SimilarityIndex] = None) -> str:
+    """
+    调用通义千问生成投放指导方案，返回模型输出的 JSON 字符串；失败时抛出异常。
+
+    提供 on_delta 时以流式方式调用上游，并将增量输出逐段交给 on_delta。
+    开启合规预检时，本地规则对完整文案的扫描结果并入返回的 compliance_risk。
+    提供 similar 时，同一平台下与历史文案足够相似的请求直接复用已有方案（合规预检仍针对本次文案）。
+    """
+    # 在截断之前扫描完整文案，耗时在毫秒以内
+    findings = scan_copy(generated_copywriting, target_platform) if settings.compliance_prescreen_enabled else None
+
+    # 提供图片时方案依赖图片内容，不做近似复用
+    reuse = similar is not None and not generated_image_url
+    scope = namespace(TOOL_NAME, target_platform)
+    guide_text: Optional[str] = None
+    if reuse:
+        match = await similar.lookup(scope, generated_copywriting, settings.semantic_hit_threshold)
+        if record_lookup(TOOL_NAME, match, settings.semantic_hit_threshold) == "hit":
+            guide_text = match.output
+    if guide_text is None:
+        guide_text = await _generate_guide(http, generated_copywriting, target_platform, generated_image_url, on_delta)
+        if reuse:
+            await similar.add(scope, generated_copywriting, guide_text)
+
+    if findings is None:
+        return guide_text
+    return json.dumps(merge_findings(json.loads(guide_text), findings), ensure_ascii=False)
+
+
+def compliance_only_result(generated_copywriting: str, target_platform: str) -> GuideResult:
     """
-    注册电商内容中台的落地指导方案工具。
+    仅以本地规则检查文案，不调用模型，返回与指导方案相同字段名的合规结论。
     """
+    findings = scan_copy(generated_copywriting, target_platform)
+    report = merge_findings({"compliance_risk": []}, findings)
+    report["passed"] = not findings
+    return GuideResult(
+        file_content=json.dumps(report, ensure_ascii=False, indent=2),
+        filename=f"{target_platform}_compliance_check.json",
+        mime_type="application/json"
+    )
+
+
+def guide_error_result(e: Exception) -> GuideResult:
+    """
+    将生成过程中的异常封装为错误报告，保持工具始终返回 GuideResult。
+    """
+    if isinstance(e, GuideFormatError):
+        return GuideResult(
+            file_content=json.dumps({"error": str(e)}),
+            filename="error_guide.json",
+            mime_type="application/json"
+        )
+    if isinstance(e, ImageIngestError):
+        error_details = json.dumps({"error": f"宣传图片校验失败: {str(e)}"}, ensure_ascii=False)
+        return GuideResult(
+            file_content=error_details,
+            filename="error_report.json",
+            mime_type="application/json"
+        )
+    # 处理网络或 API 调用错误
+    error_details = json.dumps({"error": f"指导方案生成失败: {str(e)}"})
+    return GuideResult(
+        file_content=error_details,
+        filename="error_report.json",
+        mime_type="application/json"
+    )
+
+
+# --- 4. 工具注册函数：register_guide_tools (已集成 OpenAI 兼容多模态 API) ---
+def register_guide_tools(mcp: FastMCP, http: DashScopeClient, images: ImageIngestor,
+                         similar: Optional[SimilarityIndex] = None) -> None:
+    """
+    注册电商内容中台的落地指导方案工具。http 为 create_mcp_server 创建的共享连接池客户端，
+    images 在调用上游前预取并校验宣传图片，similar 为可选的近似重复索引。
+    """
+
 
-    
     @mcp.tool(
         annotations={"title": "get_launch_strategy", "readOnlyHint": True}
     )
     async def get_launch_strategy(
         generated_copywriting: Annotated[str, Field(description="文案工具生成的最终文案主体内容")],
         target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝")],
-        generated_image_url: Annotated[Optional[str], Field(description="可选，图片生成工具返回的宣传图片公开访问URL")] = None
+        ctx: Context,
+        generated_image_url: Annotated[Optional[str], Field(description="可选，图片生成工具返回的宣传图片公开访问URL")] = None,
+        stream: Annotated[bool, Field(description="是否流式生成；开启后模型的部分输出会通过进度通知实时推送，最终结果不变")] = False,
+        compliance_only: Annotated[bool, Field(description="只做合规检查：以本地违禁词规则扫描文案并立即返回，不调用模型、不分析图片")] = False
     ) -> GuideResult:
         """
         根据生成的文案、图片URL和目标平台，提供专业的投放策略和合规指导方案。
         """
-        
-        AI_API_URL = settings.qwen_api_endpoint
-        MODEL_NAME = settings.qwen_model_name
-        API_KEY = settings.ai_api_key.get_secret_value()
-        
-
-        image_analysis_instruction = ""
-        user_content_array = []
-
-        if generated_image_url and generated_image_url.strip():
-            image_analysis_instruction = "请结合图片URL对视觉风格、构图和转化潜力进行详细评估。"
-            user_content_array.append(
-                {"type": "image_url", "image_url": {"url": generated_image_url}}
-            )
-        else:
-            # 图片缺失，仅文本分析
-            user_analysis_instruction = "图片URL未提供，请重点评估文案与平台规则的契合度，跳过视觉风格评估部分。"
-
-            
-        # 1. 构建用户输入 Prompt/指令
-        user_instruction = f"""
-        请分析以下内容，并提供指导方案：
-        目标平台: {target_platform}
-        待分析文案: {generated_copywriting}
-        请严格遵循系统提示中的 JSON 格式输出。
-        {image_analysis_instruction}
-        """
-        
-        user_content_array.append(
-            {"type": "text", "text": user_instruction}
-        )
-
-        # --- 2. 遵循 OpenAI 兼容 API 结构构建 Payload (多模态输入) ---
+        if compliance_only:
+            return compliance_only_result(generated_copywriting, target_platform)
         try:
-            payload = {
-                "model": MODEL_NAME,
-                "messages": [
-                    {"role": "system", "content": GUIDE_SYSTEM_PROMPT},
-                    {"role": "user","content": user_content_array}
-                ],
-                # 关键：开启 JSON 结构化输出
-                "response_format": {"type": "json_object"}, 
-                
-                # 可选参数
-                "stream": False,
-                "top_p": 0.8,
-                "temperature": 0.7,
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {API_KEY}", 
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(AI_API_URL, headers=headers, json=payload, timeout=60)
-            response.raise_for_status() 
-            
-            response_data = response.json()
-            
-            # 提取路径：choices[0] -> message -> content
-            ai_response_json_string = response_data.get('choices', [{}])[0].get('message', {}).get('content', '{}')
+            image_url = await images.resolve(generated_image_url)
+            ai_response_json_string = await request_launch_strategy(
+                http, generated_copywriting, target_platform, image_url,
+                on_delta=progress_forwarder(ctx) if stream else None, similar=similar)
 
             # --- 结果封装与返回 ---
-            # 尝试解析 JSON 以确认格式，如果解析失败则返回错误提示
-            try:
-                json.loads(ai_response_json_string) 
-                return GuideResult(
-                    file_content=ai_response_json_string,
-                    filename=f"{target_platform}_launch_guide.json",
-                    mime_type="application/json"
-                )
-            except json.JSONDecodeError:
-                 return GuideResult(
-                    file_content=json.dumps({"error": "AI返回的指导方案格式不正确。"}),
-                    filename="error_guide.json",
-                    mime_type="application/json"
-                )
-
-        except Exception as e:
-            # 处理网络或 API 调用错误
-            error_details = json.dumps({"error": f"指导方案生成失败: {str(e)}"})
             return GuideResult(
-                file_content=error_details,
-                filename="error_report.json",
+                file_content=ai_response_json_string,
+                filename=f"{target_platform}_launch_guide.json",
                 mime_type="application/json"
-            )
\ No newline at end of file
+            )
+
+        except Exception as e:
+            return guide_error_result(e)
@@ -1,15 +1,36 @@
+import asyncio
 import json
-import requests
+import math
 import os
-from typing import Annotated, List
+from typing import Annotated, Any, Awaitable, Callable, Dict, List, Optional
 from pydantic import Field, BaseModel
 
 from .settings import settings
+from .http_client import DashScopeClient, UpstreamError
+from .image_ingest import ImageIngestError, ImageIngestor
+from .image_store import GeneratedImageStore, StoredImage, public_base_url
+from .metrics import metrics
+from .deadline import remaining
 
 # 导入 FastMCP 类型
-from fastmcp import FastMCP 
+from fastmcp import Context, FastMCP 
+from fastmcp.utilities import logging
+
+logger = logging.get_logger(__name__)
 
 # --- 1. 定义输出类型 (返回图像 URL) ---
+class ImageItem(BaseModel):
+    """
+    多图生成中的一张图片。所在的上游调用失败或超过截止时间时 url 为空，并附带 error；
+    保存到本地失败时 url 为临时地址，同样附带 error。
+    """
+    index: Annotated[int, Field(description="图片在结果中的序号：按变体顺序排列，同一变体内按生成顺序")]
+    variation: Annotated[Optional[str], Field(description="生成该图片所用的提示词或风格变体")] = None
+    url: Optional[str] = None
+    image: Annotated[Optional[StoredImage], Field(description="保存到本地时的稳定地址与元数据")] = None
+    error: Optional[str] = None
+
+
 class ImageResult(BaseModel):
     """
     图像生成结果，返回图片公开访问的URL列表和文件MIME类型。
@@ -17,111 +38,327 @@ class ImageResult(BaseModel):
     file_content: Annotated[List[str], Field(description="生成的图片公开访问URL列表")]
     filename: Annotated[str, Field(description="生成结果文件名，例如: product_image.json")]
     mime_type: Annotated[str, Field(description="返回的文件MIME类型, 必须是 application/json")]
+    images: Annotated[Optional[List[StoredImage]], Field(description="保存到本地时每张图片的稳定地址、尺寸、哈希、WebP 与缩略图地址")] = None
+    items: Annotated[Optional[List[ImageItem]], Field(description="逐张图片的结果（含失败项），顺序与请求一致")] = None
 
 
 # # --- 2. 配置和 Prompt Engineering (保持不变) ---
 # AI_IMAGE_API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation"
 # MODEL_NAME = "qwen-image-edit-plus" 
 
-# --- 3. 工具注册函数：register_image_tools (已修正提取逻辑) ---
-def register_image_tools(mcp: FastMCP) -> None:
-    
-    
+# --- 3. 核心生成逻辑 (供工具、流水线与异步任务复用) ---
+def build_image_payload(base_image_url: str, image_prompt: str, n: Optional[int] = None) -> Dict[str, Any]:
+    """
+    构建通义万相图像编辑请求体。n 为本次调用生成的图片数，默认取 WANX_IMAGES_PER_CALL。
+    """
+
+    # ❗ 在这里引用配置中的值
+    MODEL_NAME = settings.wanx_model_name
+
+    user_text_prompt = f"根据以下英文指令生成最终图片，如果原始图不符合要求，请进行编辑或重绘：{image_prompt}"
+
+    payload = {
+        "model": MODEL_NAME,
+        "input": {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"image": base_image_url},
+                        {"text": user_text_prompt}
+                    ]
+                }
+            ]
+        },
+        "parameters": {
+            "n": n or settings.wanx_images_per_call,
+            "negative_prompt": "blurry, low quality, distorted, bad contrast",
+            "prompt_extend": True,
+            "watermark": False
+        }
+    }
+    return payload
+
+
+def extract_image_urls(response_data: Dict[str, Any]) -> List[str]:
+    """
+    从同步响应或异步任务结果中提取图片 URL 列表；没有任何图片时抛出 ValueError。
+    """
+
+    # --- ❗ 重点修正：提取生成的图片 URL 列表 ---
+    image_urls = []
+    output = response_data.get('output', {})
+
+    # 路径：output -> choices[0] -> message -> content (这是一个图片对象数组)
+    content_array = (output.get('choices') or [{}])[0].get('message', {}).get('content', [])
+
+    # 遍历 content 数组，提取每个 { "image": "URL" } 中的 URL
+    for item in content_array:
+        if isinstance(item, dict) and 'image' in item:
+            image_urls.append(item['image'])
+
+    # 异步任务结果路径：output -> results[] -> url
+    for item in output.get('results') or []:
+        if isinstance(item, dict) and item.get('url'):
+            image_urls.append(item['url'])
+
+    if not image_urls:
+         raise ValueError("AI图像服务成功返回，但未找到任何有效的图片URL。")
+
+    return image_urls
+
+
+async def request_product_images(http: DashScopeClient, base_image_url: str, image_prompt: str,
+                                 n: Optional[int] = None, timeout: float = 90) -> List[str]:
+    """
+    调用通义万相生成或编辑宣传图片，返回图片 URL 列表；失败时抛出异常。
+    """
+    payload = build_image_payload(base_image_url, image_prompt, n)
+
+    # 通过共享连接池异步发送；DashScope 错误码与非 2xx 状态统一抛出 UpstreamError
+    response_data = await http.post_json("wanx", settings.wanx_api_endpoint, payload, timeout=timeout)
+    return extract_image_urls(response_data)
+
+
+async def submit_image_task(http: DashScopeClient, base_image_url: str, image_prompt: str) -> str:
+    """
+    以 DashScope 异步任务模式（X-DashScope-Async: enable）提交图像编辑，立即返回 task_id，不占用长连接。
+    """
+    payload = build_image_payload(base_image_url, image_prompt)
+    response_data = await http.post_json("wanx", settings.wanx_api_endpoint, payload, timeout=30,
+                                         headers={"X-DashScope-Async": "enable"})
+    task_id = response_data.get('output', {}).get('task_id')
+    if not task_id:
+        raise ValueError("通义万相未返回异步任务 ID，请确认模型支持异步调用或关闭 WANX_ASYNC_ENABLED")
+    return str(task_id)
+
+
+async def poll_image_task(http: DashScopeClient, task_id: str) -> Optional[List[str]]:
+    """
+    查询一次异步任务状态：成功返回图片 URL 列表，仍在执行返回 None，失败时抛出 UpstreamError。
+    """
+    response_data = await http.get_json("wanx", f"{settings.dashscope_task_endpoint.rstrip('/')}/{task_id}", timeout=30)
+    output = response_data.get('output', {})
+    status = output.get('task_status')
+    if status == "SUCCEEDED":
+        return extract_image_urls(response_data)
+    if status in ("FAILED", "CANCELED", "UNKNOWN"):
+        raise UpstreamError(f"DashScope 异步任务失败: [{output.get('code', status)}] {output.get('message', '')}",
+                            code=str(output.get('code') or status))
+    return None
+
+
+def image_error_details(e: Exception) -> List[str]:
+    """
+    将生成过程中的异常转换为可读的错误说明。
+    """
+    if isinstance(e, UpstreamError):
+        # 处理 HTTP 或 API 错误
+        return [f"图像生成失败 (HTTP/API 错误): {str(e)}", f"API 返回信息: {e.response.text if e.response is not None else 'N/A'}"]
+    if isinstance(e, ImageIngestError):
+        return [f"原始图片校验失败: {str(e)}"]
+    # 处理其他如网络或解析错误
+    return [f"图像生成过程中发生错误: {str(e)}"]
+
+
+def image_error_result(e: Exception) -> ImageResult:
+    """
+    将生成过程中的异常封装为错误报告，保持工具始终返回 ImageResult。
+    """
+    return ImageResult(
+        file_content=image_error_details(e),
+        filename="error_report.json",
+        mime_type="application/json"
+    )
+
+
+def image_items_result(items: List[ImageItem], persisted: bool = False) -> ImageResult:
+    """
+    按请求顺序合并成功的图片，失败项保留在 items 中；全部失败时返回去重后的错误报告。
+    """
+    succeeded = [item for item in items if item.url]
+    if not succeeded:
+        return ImageResult(
+            file_content=list(dict.fromkeys(item.error or "" for item in items)),
+            filename="error_report.json",
+            mime_type="application/json",
+            items=items
+        )
+    return ImageResult(
+        file_content=[item.url for item in succeeded],
+        filename="generated_images.json",
+        mime_type="application/json",
+        images=[item.image for item in succeeded if item.image is not None] if persisted else None,
+        items=items
+    )
+
+
+# --- 4. 多图并发生成 ---
+class ImageCall:
+    """
+    一次上游调用：以 prompt 生成结果中 indexes 对应的若干张图片。
+    """
+
+    def __init__(self, prompt: str, variation: Optional[str], indexes: List[int]):
+        self.prompt = prompt
+        self.variation = variation
+        self.indexes = indexes
+
+
+def plan_image_calls(image_prompt: str, num_images: int, variations: Optional[List[str]] = None,
+                     per_call: Optional[int] = None) -> List[ImageCall]:
+    """
+    每个变体生成 num_images 张图片（未提供变体时只用原指令），并按单次调用的图片数上限拆分。
+    变体追加在原指令之后，例如 "studio lighting" 或 "watercolor style"。
+    """
+    per_call = max(1, per_call or settings.wanx_images_per_call)
+    calls: List[ImageCall] = []
+    index = 0
+    for variation in variations or [None]:
+        prompt = f"{image_prompt}, {variation}" if variation else image_prompt
+        for start in range(0, num_images, per_call):
+            count = min(per_call, num_images - start)
+            calls.append(ImageCall(prompt, variation, list(range(index, index + count))))
+            index += count
+    return calls
+
+
+def image_call_count(num_images: Optional[int] = None, variations: Optional[List[str]] = None) -> int:
+    """
+    一次请求拆分出的上游调用数，供准入控制估算成本。num_images 为 None 时按默认的一次调用计。
+    """
+    per_call = max(1, settings.wanx_images_per_call)
+    return max(1, len(variations or [None])) * math.ceil(max(1, num_images or per_call) / per_call)
+
+
+async def fan_out_product_images(http: DashScopeClient, base_image_url: str, calls: List[ImageCall], deadline: float,
+                                 store: Optional[GeneratedImageStore] = None, base_url: str = "",
+                                 on_items: Optional[Callable[[List[ImageItem]], Awaitable[None]]] = None) -> List[ImageItem]:
+    """
+    同时发起全部调用，实际并发受通义万相的自适应并发配额限制（见 http_client），多出的调用排队等待。
+
+    每个调用完成即回调 on_items（用于流式推送），提供 store 时先保存该调用的图片再回调。
+    单个调用失败只影响它负责的图片；超过 deadline 秒仍未完成的调用被取消，对应图片报告超时。
+    返回的列表与 calls 的图片顺序一致。
+    """
+    items = [ImageItem(index=i, variation=call.variation) for call in calls for i in call.indexes]
+    loop = asyncio.get_running_loop()
+    expires = loop.time() + deadline
+
+    async def run(call: ImageCall) -> List[ImageItem]:
+        # 单次调用的超时不超过整个请求剩余的时间
+        timeout = max(1.0, min(90.0, expires - loop.time()))
+        try:
+            urls = await request_product_images(http, base_image_url, call.prompt, len(call.indexes), timeout)
+        except Exception as e:
+            # 保留上游错误的响应内容，便于逐张排查
+            error = "; ".join(image_error_details(e))
+            for i in call.indexes:
+                items[i].error = error
+            return [items[i] for i in call.indexes]
+        # 上游可能多返回图片，只取请求的数量
+        urls = urls[:len(call.indexes)]
+        stored: Optional[List[StoredImage]] = None
+        if store is not None:
+            try:
+                stored = await store.persist_many(urls, base_url)
+            except Exception as e:
+                # persist 只处理下载与 I/O 错误；图片解码（如 DecompressionBombError）或进程池异常
+                # 同样只影响本次调用的图片，与单张下载失败一样保留临时地址并说明原因
+                logger.warning(f"Failed to persist generated images: {e}")
+                error = f"图片保存失败，返回临时地址: {type(e).__name__}: {e}"
+                stored = [StoredImage(source_url=url, url=url, error=error) for url in urls]
+        for position, i in enumerate(call.indexes):
+            if position < len(urls):
+                image = stored[position] if stored is not None else None
+                items[i].url = image.url if image is not None else urls[position]
+                items[i].image = image
+                items[i].error = image.error if image is not None else None
+            else:
+                items[i].error = "上游返回的图片少于请求数"
+        return [items[i] for i in call.indexes]
+
+    pending = {asyncio.create_task(run(call)) for call in calls}
+    try:
+        while pending:
+            time_left = expires - loop.time()
+            if time_left <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=time_left, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if on_items is not None:
+                    await on_items(task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    for item in items:
+        if item.url is not None:
+            metrics.image_items.inc(outcome="ok")
+        elif item.error is not None:
+            metrics.image_items.inc(outcome="failed")
+        else:
+            item.error = f"超过截止时间 {deadline:g} 秒仍未完成，已取消"
+            metrics.image_items.inc(outcome="timeout")
+    return items
+
+
+# --- 5. 工具注册函数：register_image_tools (已修正提取逻辑) ---
+def register_image_tools(mcp: FastMCP, http: DashScopeClient, images: ImageIngestor,
+                         store: Optional[GeneratedImageStore] = None) -> None:
+    """
+    注册宣传图片生成工具。store 为生成图片的本地存储，提供时可将临时地址替换为稳定地址。
+    """
+
+
     @mcp.tool(
         annotations={"title": "generate_product_image", "readOnlyHint": False}
     )
     async def generate_product_image(
         base_image_url: Annotated[str, Field(description="用于编辑或作为参考的原始图片URL")],
-        image_prompt: Annotated[str, Field(description="图像生成工具生成的英文指令，包含风格和场景描述")]
+        image_prompt: Annotated[str, Field(description="图像生成工具生成的英文指令，包含风格和场景描述")],
+        ctx: Context,
+        persist_images: Annotated[Optional[bool], Field(description="是否下载生成图片并保存到本地，返回稳定地址、尺寸、哈希与缩略图；默认取服务配置 IMAGE_STORE_ENABLED")] = None,
+        num_images: Annotated[Optional[int], Field(description="每个变体生成的图片数；默认取 WANX_IMAGES_PER_CALL（一次上游调用）", ge=1)] = None,
+        prompt_variations: Annotated[Optional[List[str]], Field(description="可选：追加在英文指令后的提示词或风格变体，如 [\"studio lighting\", \"outdoor scene\"]，每个变体各生成 num_images 张")] = None,
+        deadline_seconds: Annotated[Optional[float], Field(description="可选：整个请求的截止时间（秒），不超过服务配置 IMAGE_REQUEST_DEADLINE", gt=0)] = None
     ) -> ImageResult:
         """
         根据文案工具提供的图像指令和基础图片，调用通义万相生成或编辑宣传图片。
+        多张图片与多个变体拆分为并发的上游调用，每完成一次调用即通过进度通知推送其图片；单次调用失败或超时逐项报告。
         """
-                
-        # ❗ 在这里引用配置中的值
-        AI_IMAGE_API_URL = settings.wanx_api_endpoint
-        MODEL_NAME = settings.wanx_model_name
-        API_KEY = settings.ai_api_key.get_secret_value()
+        variations = [v.strip() for v in prompt_variations or [] if v.strip()]
+        count = num_images or settings.wanx_images_per_call
+        total = count * max(1, len(variations))
+        if total > settings.image_fanout_max_images:
+            return image_error_result(ValueError(f"请求的图片总数 {total} 超过上限 {settings.image_fanout_max_images}"))
+        deadline = min(deadline_seconds or settings.image_request_deadline, settings.image_request_deadline)
+        # 不超过整个工具调用剩余的时间，留出封装结果的余量
+        left = remaining()
+        if left is not None:
+            deadline = max(0.1, round(min(deadline, left - 0.5), 1))
 
-        # ... (Payload 构建逻辑保持不变)
         try:
-            user_text_prompt = f"根据以下英文指令生成最终图片，如果原始图不符合要求，请进行编辑或重绘：{image_prompt}"
-            
-            payload = {
-                "model": MODEL_NAME,
-                "input": {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {"image": base_image_url}, 
-                                {"text": user_text_prompt} 
-                            ]
-                        }
-                    ]
-                },
-                "parameters": {
-                    "n": 2, 
-                    "negative_prompt": "blurry, low quality, distorted, bad contrast", 
-                    "prompt_extend": True,
-                    "watermark": False
-                }
-            }
-            
-            headers = {
-                # ❗ 使用配置中获取的密钥
-                "Authorization": f"Bearer {API_KEY}",
-                "Content-Type": "application/json",
-            }
-            
-            response = requests.post(AI_IMAGE_API_URL, headers=headers, json=payload, timeout=90)
-            response_data = response.json()
-            
-            # --- ❗ 重点修正：处理 API 错误响应 ---
-            # 如果请求返回了 DashScope 的错误码 (如 InvalidApiKey)，则直接抛出异常
-            if response_data.get('code'):
-                error_code = response_data.get('code')
-                error_message = response_data.get('message', '未知API错误')
-                raise requests.HTTPError(f"DashScope API Error: [{error_code}] {error_message}", response=response)
-
-            # 确保 HTTP 状态码在 200-299 之间
-            response.raise_for_status() 
-
-            # --- ❗ 重点修正：提取生成的图片 URL 列表 ---
-            image_urls = []
-            
-            # 路径：output -> choices[0] -> message -> content (这是一个图片对象数组)
-            content_array = response_data.get('output', {}).get('choices', [{}])[0].get('message', {}).get('content', [])
-            
-            # 遍历 content 数组，提取每个 { "image": "URL" } 中的 URL
-            for item in content_array:
-                if isinstance(item, dict) and 'image' in item:
-                    image_urls.append(item['image'])
-                
-            if not image_urls:
-                 raise ValueError("AI图像服务成功返回，但未找到任何有效的图片URL。")
-
-
-            # --- 结果封装与返回 ---
-            return ImageResult(
-                file_content=image_urls,
-                filename="generated_images.json",
-                mime_type="application/json"
-            )
-
-        except requests.HTTPError as http_e:
-            # 处理 HTTP 或 API 错误
-            error_details = [f"图像生成失败 (HTTP/API 错误): {str(http_e)}", f"API 返回信息: {http_e.response.text if http_e.response else 'N/A'}"]
-            return ImageResult(
-                file_content=error_details,
-                filename="error_report.json",
-                mime_type="application/json"
-            )
+            # 先在本地校验原图，坏链接与不符合编辑接口要求的图片无需等待 90 秒上游超时
+            base_image = await images.resolve(base_image_url, min_side=settings.wanx_image_min_side)
         except Exception as e:
-            # 处理其他如网络或解析错误
-            error_details = [f"图像生成过程中发生错误: {str(e)}"]
-            return ImageResult(
-                file_content=error_details,
-                filename="error_report.json",
-                mime_type="application/json"
-            )
\ No newline at end of file
+            return image_error_result(e)
+
+        # 上游返回的是会过期的临时地址：按需在每个调用完成后立即下载并保存，保存失败的图片保留临时地址
+        persist = settings.image_store_enabled if persist_images is None else persist_images
+        target = store if persist and store is not None else None
+        done = 0
+
+        async def report(finished: List[ImageItem]) -> None:
+            nonlocal done
+            for item in finished:
+                done += 1
+                await ctx.report_progress(progress=done, total=total, message=item.model_dump_json(exclude_none=True))
+
+        calls = plan_image_calls(image_prompt, count, variations)
+        items = await fan_out_product_images(http, base_image, calls, deadline, target,
+                                             public_base_url(settings) if target else "", report)
+
+        return image_items_result(items, persisted=target is not None)
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Annotated, Any, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+from .settings import Settings
+from .cache import make_cache_key, normalize_text
+from .deadline import clear as clear_deadline
+from .metrics import metrics, usage_scope
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.tools.tool import ToolResult
+from fastmcp.utilities import logging
+
+logger = logging.get_logger(__name__)
+
+# 记录到生成历史的工具；统计查询类工具不记录
+HISTORY_TOOLS = {
+    "generate_marketing_content",
+    "generate_marketing_content_variants",
+    "generate_marketing_content_batch",
+    "generate_product_image",
+    "get_launch_strategy",
+    "run_content_pipeline",
+}
+
+# 可以直接以历史结果作答的工具：图片地址会过期、批量与流水线结果与断点有关，均不复用
+REUSABLE_TOOLS = {"generate_marketing_content", "generate_marketing_content_variants", "get_launch_strategy"}
+
+# 不影响生成结果的参数，不参与复用键
+_NON_SEMANTIC_ARGS = {"use_cache", "stream", "deadline_seconds", "persist_images", "batch_id", "concurrency"}
+
+_COLUMNS = ("record_id", "created_at", "tool", "product_name", "target_platform", "input_key", "status",
+            "model", "latency_ms", "prompt_tokens", "completion_tokens", "inputs", "output")
+
+
+# --- 1. 查询结果 ---
+class HistoryRecord(BaseModel):
+    """
+    一次生成的历史记录。
+    """
+    record_id: Annotated[str, Field(description="记录 ID，同时通过工具结果的 _meta.history_record_id 返回给调用方")]
+    created_at: datetime
+    tool: str
+    product_name: Optional[str] = None
+    target_platform: Optional[str] = None
+    status: Annotated[str, Field(description="ok / error")]
+    model: Annotated[Optional[str], Field(description="本次调用实际使用的模型，多个时以逗号分隔；为空表示结果来自缓存，未调用上游")] = None
+    latency_ms: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    inputs: Dict[str, Any]
+    output: Annotated[Optional[str], Field(description="工具返回的结构化结果（JSON 字符串）")] = None
+
+
+class HistoryPage(BaseModel):
+    """
+    一页历史记录，按时间从新到旧排列。
+    """
+    records: List[HistoryRecord]
+    next_cursor: Annotated[Optional[str], Field(description="下一页的游标，为空表示没有更多记录")] = None
+
+
+# --- 2. SQLite 存储 ---
+class _HistoryStore:
+    """
+    只追加的 SQLite 表，开启 WAL：写入不阻塞读取，多个 worker 进程可共用同一文件。所有操作在线程池中执行。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # WAL 模式下 NORMAL 仍保证崩溃后数据库一致，只可能丢失最近一次检查点之后的提交
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_history ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, record_id TEXT NOT NULL UNIQUE, created_at REAL NOT NULL,"
+                " tool TEXT NOT NULL, product_name TEXT, target_platform TEXT, input_key TEXT NOT NULL,"
+                " status TEXT NOT NULL, model TEXT, latency_ms REAL NOT NULL, prompt_tokens INTEGER NOT NULL,"
+                " completion_tokens INTEGER NOT NULL, inputs TEXT NOT NULL, output TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_product ON generation_history(product_name, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_platform ON generation_history(target_platform, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON generation_history(created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_input ON generation_history(input_key, created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def insert_many(self, rows: List[Tuple[Any, ...]]) -> None:
+        with self._lock:
+            conn = self._connection()
+            # 一批记录在一个事务中提交，只触发一次 WAL 同步
+            conn.executemany(
+                f"INSERT INTO generation_history ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})", rows
+            )
+            conn.commit()
+
+    def query(self, filters: Dict[str, Any], since: Optional[float], until: Optional[float],
+              cursor: Optional[Tuple[float, int]], limit: int) -> List[sqlite3.Row]:
+        clauses, params = [], []
+        for column, value in filters.items():
+            clauses.append(f"{column} = ?")
+            params.append(value)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        if cursor is not None:
+            # 键集分页：从上一页最后一条之后继续，翻页开销与页码无关
+            clauses.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return self._connection().execute(
+                f"SELECT * FROM generation_history{where} ORDER BY created_at DESC, id DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+
+    def latest_output(self, input_key: str, since: float) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT record_id, output FROM generation_history WHERE input_key = ? AND created_at >= ? AND status = 'ok'"
+                " ORDER BY created_at DESC LIMIT 1", (input_key, since)
+            ).fetchone()
+        return (row["record_id"], row["output"]) if row is not None else None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# --- 3. 生成历史 ---
+def input_key(config: Settings, tool: str, arguments: Dict[str, Any]) -> str:
+    """
+    复用键：工具名、去掉非语义参数并归一化文本后的参数，以及模型配置。模型或路由配置变化后不再复用旧结果。
+    """
+    normalized = {
+        name: normalize_text(value) if isinstance(value, str) else value
+        for name, value in arguments.items() if name not in _NON_SEMANTIC_ARGS
+    }
+    return make_cache_key(kind="history", tool=tool, arguments=normalized,
+                          model=config.qwen_model_name, routes=config.model_routes or "")
+
+
+class GenerationHistory:
+    """
+    每次生成的输入、输出、模型、耗时与 token 用量的只追加记录。
+
+    record() 只把记录放入内存队列，不等待磁盘；后台写入任务每攒够 history_batch_size 条
+    或每隔 history_flush_interval 秒在线程池中批量写入一次。查询前先写入队列中的记录。
+    """
+
+    def __init__(self, config: Settings):
+        self.config = config
+        self._store = _HistoryStore(config.history_path)
+        self._pending: List[Tuple[Any, ...]] = []
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+    # --- 写入 ---
+    def record(self, tool: str, arguments: Dict[str, Any], status: str, output: Optional[str],
+               latency: float, usage: Dict[str, Any]) -> str:
+        record_id = uuid.uuid4().hex
+        if len(self._pending) >= self.config.history_max_pending:
+            metrics.history_records.inc(outcome="dropped")
+            return record_id
+        product = arguments.get("product_name")
+        platform = arguments.get("target_platform")
+        self._pending.append((
+            record_id, time.time(), tool,
+            normalize_text(product) if isinstance(product, str) else None,
+            normalize_text(platform) if isinstance(platform, str) else None,
+            input_key(self.config, tool, arguments), status,
+            ",".join(usage["models"]) or None, latency * 1000,
+            usage["prompt_tokens"], usage["completion_tokens"],
+            json.dumps(arguments, ensure_ascii=False, default=str), output,
+        ))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._run())
+        if len(self._pending) >= self.config.history_batch_size:
+            self._wakeup.set()
+        return record_id
+
+    async def _run(self) -> None:
+        # 写入任务在首次记录的工具调用中创建，不继承该调用的截止时间
+        clear_deadline()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.config.history_flush_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        try:
+            await asyncio.to_thread(self._store.insert_many, rows)
+        except sqlite3.Error as e:
+            metrics.history_records.inc(len(rows), outcome="failed")
+            logger.warning(f"Failed to write {len(rows)} generation history record(s): {e}")
+            return
+        metrics.history_records.inc(len(rows), outcome="written")
+
+    # --- 查询与复用 ---
+    async def query(self, product_name: Optional[str] = None, target_platform: Optional[str] = None,
+                    tool: Optional[str] = None, record_id: Optional[str] = None,
+                    since: Optional[datetime] = None, until: Optional[datetime] = None,
+                    cursor: Optional[str] = None, limit: int = 20, include_output: bool = True) -> HistoryPage:
+        position = None
+        if cursor:
+            try:
+                created_at, row_id = cursor.split("_", 1)
+                position = (float(created_at), int(row_id))
+            except ValueError:
+                raise ValueError(f"无效的分页游标: {cursor}")
+        filters = {
+            column: normalize_text(value) if column in ("product_name", "target_platform") else value
+            for column, value in (("product_name", product_name), ("target_platform", target_platform),
+                                  ("tool", tool), ("record_id", record_id))
+            if value
+        }
+        await self.flush()
+        rows = await asyncio.to_thread(self._store.query, filters, since.timestamp() if since else None,
+                                       until.timestamp() if until else None, position, limit + 1)
+        records = [
+            HistoryRecord(
+                record_id=row["record_id"],
+                created_at=datetime.fromtimestamp(row["created_at"], tz=timezone.utc),
+                tool=row["tool"], product_name=row["product_name"], target_platform=row["target_platform"],
+                status=row["status"], model=row["model"], latency_ms=round(row["latency_ms"], 1),
+                prompt_tokens=row["prompt_tokens"], completion_tokens=row["completion_tokens"],
+                inputs=json.loads(row["inputs"]), output=row["output"] if include_output else None,
+            )
+            for row in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f"{last['created_at']!r}_{last['id']}"
+        return HistoryPage(records=records, next_cursor=next_cursor)
+
+    async def reusable_output(self, tool: str, arguments: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """
+        返回 history_reuse_max_age_seconds 内相同输入的最近一次成功结果的记录 ID 与输出。
+        """
+        key = input_key(self.config, tool, arguments)
+        since = time.time() - self.config.history_reuse_max_age_seconds
+        # 先查尚未写入的记录，刚生成的结果同样可以复用
+        for row in reversed(self._pending):
+            if row[5] == key and row[6] == "ok" and row[1] >= since:
+                return row[0], row[12]
+        return await asyncio.to_thread(self._store.latest_output, key, since)
+
+    async def aclose(self) -> None:
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+        await self.flush()
+        self._store.close()
+
+
+# --- 4. 中间件 ---
+def _status(structured: Any) -> str:
+    """
+    各工具出错时仍返回正常结构，以错误报告文件名或 error 字段区分。
+    """
+    if isinstance(structured, dict):
+        if str(structured.get("filename") or "").startswith("error"):
+            return "error"
+        content = structured.get("file_content")
+        if isinstance(content, str) and content.lstrip().startswith('{"error"'):
+            return "error"
+    return "ok"
+
+
+class HistoryMiddleware(Middleware):
+    """
+    记录生成类工具的每次调用，并在工具结果的 _meta.history_record_id 中返回记录 ID。
+
+    开启 HISTORY_REUSE_ENABLED 时，文案、多变体与运营指导在 use_cache 不为 false 的情况下
+    先查找相同输入的近期成功结果，找到则直接返回，不经过准入排队与上游调用。
+    """
+
+    def __init__(self, history: GenerationHistory):
+        self.history = history
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        tool = context.message.name
+        if tool not in HISTORY_TOOLS:
+            return await call_next(context)
+        arguments = dict(context.message.arguments or {})
+
+        config = self.history.config
+        if config.history_reuse_enabled and tool in REUSABLE_TOOLS and arguments.get("use_cache", True) is not False:
+            try:
+                reused = await self.history.reusable_output(tool, arguments)
+            except sqlite3.Error as e:
+                logger.warning(f"Generation history lookup failed: {e}")
+                reused = None
+            if reused is not None:
+                metrics.history_records.inc(outcome="reused")
+                return ToolResult(structured_content=json.loads(reused[1]), meta={"history_reused_from": reused[0]})
+
+        start = time.perf_counter()
+        with usage_scope() as usage:
+            try:
+                result = await call_next(context)
+            except Exception as e:
+                self.history.record(tool, arguments, "error", json.dumps({"error": str(e)}, ensure_ascii=False),
+                                    time.perf_counter() - start, usage)
+                raise
+        structured = getattr(result, "structured_content", None)
+        output = json.dumps(structured, ensure_ascii=False) if structured is not None else None
+        record_id = self.history.record(tool, arguments, _status(structured), output, time.perf_counter() - start, usage)
+        if isinstance(result, ToolResult):
+            result.meta = {**(result.meta or {}), "history_record_id": record_id}
+        return result
+
+
+# --- 5. 工具注册函数：register_history_tools ---
+def register_history_tools(mcp: FastMCP, history: GenerationHistory) -> None:
+    """
+    注册生成历史查询工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "query_generation_history", "readOnlyHint": True}
+    )
+    async def query_generation_history(
+        product_name: Annotated[Optional[str], Field(description="可选：按商品名称精确筛选")] = None,
+        target_platform: Annotated[Optional[str], Field(description="可选：按目标平台筛选")] = None,
+        tool: Annotated[Optional[str], Field(description="可选：按工具名筛选，如 generate_marketing_content")] = None,
+        record_id: Annotated[Optional[str], Field(description="可选：按记录 ID 查询（工具结果 _meta.history_record_id）")] = None,
+        since: Annotated[Optional[datetime], Field(description="可选：起始时间（含），ISO 8601 格式")] = None,
+        until: Annotated[Optional[datetime], Field(description="可选：结束时间（不含），ISO 8601 格式")] = None,
+        limit: Annotated[int, Field(description="每页条数", ge=1, le=100)] = 20,
+        cursor: Annotated[Optional[str], Field(description="可选：上一页返回的 next_cursor")] = None,
+        include_output: Annotated[bool, Field(description="是否返回每条记录的完整输出")] = True
+    ) -> HistoryPage:
+        """
+        按商品、平台、工具与时间范围分页查询历史生成记录（输入、输出、模型、耗时与 token 用量），按时间从新到旧排列，
+        可用于 A/B 分析或取回以往生成的文案而无需重新生成。
+        """
+        return await history.query(product_name, target_platform, tool, record_id, since, until,
+                                   cursor, limit, include_output)
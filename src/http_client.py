@@ -0,0 +1,309 @@
+import asyncio
+import json
+import time
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from fastmcp.utilities import logging
+
+from .settings import Settings
+from .errors import UpstreamError
+from .deadline import DeadlineExceeded, expired, upstream_timeout
+from .rate_limit import AdaptiveConcurrencyLimit, SharedRateLimit
+from .state import StateBackend
+from .resilience import CircuitBreaker, UpstreamResilience
+from .metrics import UpstreamPhaseTimer, metrics
+
+logger = logging.get_logger(__name__)
+
+
+# --- 1. 共享连接池客户端 ---
+class DashScopeClient:
+    """
+    所有工具共享的异步 HTTP 客户端层。
+
+    每个上游（qwen 文本/多模态、wanx 图像）各自持有一个 httpx.AsyncClient 连接池：
+    开启 keep-alive，在上游支持时协商 HTTP/2，并按端点单独限制最大连接数。
+    在 create_mcp_server 中创建一次，服务关闭时通过 aclose() 释放连接；
+    连接池在首次使用时才建立，关闭后再次使用会重新建立。
+
+    每个上游另有独立的熔断器与重试策略；通义千问额外启用对冲请求，
+    通义万相的图像编辑耗时长且计费，读超时后不再重试，避免重复生成。
+
+    工具调用设置了截止时间时（见 deadline.DeadlineMiddleware），每次请求的超时不超过剩余时间；
+    调用被取消时进行中的请求立即中止并释放并发名额，节省的预计上游耗时记入指标。
+
+    多 worker 部署时传入共享状态后端并配置 QWEN_GLOBAL_RPS / WANX_GLOBAL_RPS，
+    所有进程合计的每秒请求数不超过该值。
+    """
+
+    def __init__(self, config: Settings, state: Optional[StateBackend] = None):
+        self.config = config
+        self._max_connections = {
+            "qwen": config.qwen_max_connections,
+            "wanx": config.wanx_max_connections,
+        }
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        # 按上游隔离的 AIMD 并发配额，遇到 DashScope 限流自动收缩
+        self.limits: Dict[str, AdaptiveConcurrencyLimit] = {
+            "qwen": AdaptiveConcurrencyLimit(config.qwen_max_concurrency),
+            "wanx": AdaptiveConcurrencyLimit(config.wanx_max_concurrency),
+        }
+        self.resilience: Dict[str, UpstreamResilience] = {
+            "qwen": self._build_resilience(hedge=config.qwen_hedge_enabled, retry_timeouts=True),
+            "wanx": self._build_resilience(hedge=False, retry_timeouts=False),
+        }
+        global_rps = {"qwen": config.qwen_global_rps, "wanx": config.wanx_global_rps}
+        self.rate_limits: Dict[str, SharedRateLimit] = {
+            name: SharedRateLimit(state, name, rps)
+            for name, rps in global_rps.items() if state is not None and rps > 0
+        }
+
+    def _build_resilience(self, hedge: bool, retry_timeouts: bool) -> UpstreamResilience:
+        return UpstreamResilience(
+            max_attempts=self.config.retry_max_attempts,
+            base_delay=self.config.retry_base_delay,
+            max_delay=self.config.retry_max_delay,
+            breaker=CircuitBreaker(self.config.breaker_failure_threshold, self.config.breaker_reset_timeout),
+            hedge=hedge,
+            hedge_min_samples=self.config.hedge_min_samples,
+            retry_timeouts=retry_timeouts,
+        )
+
+    def _build_client(self, max_connections: int) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=self.config.http_keepalive_expiry,
+        )
+        headers = {
+            "Authorization": f"Bearer {self.config.ai_api_key.get_secret_value()}",
+            "Content-Type": "application/json",
+        }
+        return httpx.AsyncClient(
+            http2=self.config.http2_enabled,
+            limits=limits,
+            headers=headers,
+            timeout=httpx.Timeout(60.0, connect=self.config.http_connect_timeout),
+        )
+
+    def client(self, upstream: str) -> httpx.AsyncClient:
+        client = self._clients.get(upstream)
+        if client is None:
+            client = self._clients[upstream] = self._build_client(self._max_connections[upstream])
+        return client
+
+    @staticmethod
+    def _raise_for_dashscope(response: httpx.Response, response_data: Any) -> None:
+        if isinstance(response_data, dict) and response_data.get('code'):
+            error_code = response_data.get('code')
+            error_message = response_data.get('message', '未知API错误')
+            raise UpstreamError(f"DashScope API Error: [{error_code}] {error_message}", response=response, code=str(error_code))
+
+        if response.is_error:
+            raise UpstreamError(f"DashScope HTTP Error: {response.status_code} {response.reason_phrase}", response=response)
+
+    async def _send_once(self, upstream: str, method: str, url: str, payload: Optional[Dict[str, Any]],
+                         timeout: float, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        limit = self.limits[upstream]
+        timer = UpstreamPhaseTimer(upstream)
+        if upstream in self.rate_limits:
+            await self.rate_limits[upstream].acquire()
+        async with limit.slot():
+            timer.mark("queue")
+            metrics.upstream_in_flight.inc(upstream=upstream)
+            started = time.monotonic()
+            try:
+                timeout = upstream_timeout(timeout)
+                response = await self.client(upstream).request(
+                    method,
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=httpx.Timeout(timeout, connect=self.config.http_connect_timeout),
+                    extensions=timer.extensions,
+                )
+                timer.mark("receive")
+                metrics.upstream_response_bytes.observe(len(response.content), upstream=upstream)
+                try:
+                    response_data = response.json()
+                except ValueError:
+                    response_data = None
+                timer.mark("parse")
+                self._raise_for_dashscope(response, response_data)
+            except UpstreamError as e:
+                timer.finish("error", e.code or str(e.status_code))
+                if e.is_throttled:
+                    limit.on_throttle()
+                raise
+            except asyncio.CancelledError:
+                timer.finish("cancelled")
+                self._record_cancel(upstream, time.monotonic() - started)
+                raise
+            except Exception as e:
+                timer.finish("error", type(e).__name__)
+                if isinstance(e, httpx.TimeoutException) and expired():
+                    # 超时由截止时间缩短所致，不按上游超时重试或计入熔断
+                    raise DeadlineExceeded("请求已超过截止时间，已中止上游调用") from e
+                raise
+            finally:
+                metrics.upstream_in_flight.dec(upstream=upstream)
+            timer.finish("ok")
+            metrics.record_usage(upstream, response_data, (payload or {}).get("model"))
+            limit.on_success()
+
+        if not isinstance(response_data, dict):
+            raise ValueError(f"上游返回内容不是有效的JSON对象: {response.text[:100]}...")
+
+        return response_data
+
+    def _record_cancel(self, upstream: str, elapsed: float) -> None:
+        """
+        记录一次被取消的上游请求。以该上游近期成功调用的中位耗时估计请求本应持续的时间，
+        减去已耗时即为节省的上游耗时；尚无耗时样本时只计次数。
+        """
+        metrics.upstream_cancelled.inc(upstream=upstream)
+        expected = self.resilience[upstream].latency.percentile(0.5)
+        if expected is not None:
+            metrics.upstream_saved_seconds.inc(max(0.0, expected - elapsed), upstream=upstream)
+
+    async def post_json(self, upstream: str, url: str, payload: Dict[str, Any], timeout: float,
+                        headers: Optional[Dict[str, str]] = None, hedge_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        以 JSON 形式 POST 到指定上游并返回解析后的响应体。
+
+        每次尝试前先取得该上游的并发名额；DashScope 业务错误码（响应体中的 code 字段）与
+        HTTP 错误状态统一抛出 UpstreamError，限流错误会同时收缩该上游的并发上限。
+        限流、5xx 与连接错误按抖动指数退避重试，上游熔断期间直接抛出 CircuitOpenError。
+        headers 为本次请求额外附加的请求头（如 X-DashScope-Async）。
+        hedge_key 为幂等短请求的类别（如工具名），提供且开启对冲时，超过同类请求近期 p95 仍未返回即发出对冲请求。
+        """
+        return await self.resilience[upstream].call(
+            lambda: self._send_once(upstream, "POST", url, payload, timeout, headers), latency_key=hedge_key)
+
+    async def get_json(self, upstream: str, url: str, timeout: float) -> Dict[str, Any]:
+        """
+        GET 指定上游的 JSON 资源（如异步任务状态），错误处理与重试策略同 post_json。
+        """
+        return await self.resilience[upstream].call(lambda: self._send_once(upstream, "GET", url, None, timeout))
+
+    async def _stream_once(self, upstream: str, url: str, payload: Dict[str, Any], timeout: float) -> AsyncIterator[Dict[str, Any]]:
+        limit = self.limits[upstream]
+        timer = UpstreamPhaseTimer(upstream)
+        if upstream in self.rate_limits:
+            await self.rate_limits[upstream].acquire()
+        async with limit.slot():
+            timer.mark("queue")
+            metrics.upstream_in_flight.inc(upstream=upstream)
+            status, code = "cancelled", None
+            started = time.monotonic()
+            try:
+                timeout = upstream_timeout(timeout)
+                async with self.client(upstream).stream(
+                    "POST",
+                    url,
+                    json=payload,
+                    timeout=httpx.Timeout(timeout, connect=self.config.http_connect_timeout),
+                    extensions=timer.extensions,
+                ) as response:
+                    if response.is_error:
+                        await response.aread()
+                        try:
+                            error_data = response.json()
+                        except ValueError:
+                            error_data = None
+                        self._raise_for_dashscope(response, error_data)
+
+                    limit.on_success()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            status = "ok"
+                            return
+                        event = json.loads(data)
+                        self._raise_for_dashscope(response, event)
+                        # include_usage 时最后一个分片携带整次生成的 usage
+                        metrics.record_usage(upstream, event, payload.get("model"))
+                        yield event
+                    status = "ok"
+            except UpstreamError as e:
+                status, code = "error", e.code or str(e.status_code)
+                if e.is_throttled:
+                    limit.on_throttle()
+                raise
+            except asyncio.CancelledError:
+                self._record_cancel(upstream, time.monotonic() - started)
+                raise
+            except Exception as e:
+                status, code = "error", type(e).__name__
+                if isinstance(e, httpx.TimeoutException) and expired():
+                    raise DeadlineExceeded("请求已超过截止时间，已中止上游调用") from e
+                raise
+            finally:
+                metrics.upstream_in_flight.dec(upstream=upstream)
+                timer.mark("receive")
+                timer.finish(status, code)
+
+    async def stream_events(self, upstream: str, url: str, payload: Dict[str, Any], timeout: float) -> AsyncIterator[Dict[str, Any]]:
+        """
+        以 SSE 流式方式 POST，逐个产出 `data:` 事件解析后的 JSON 对象，遇到 [DONE] 结束。
+
+        整个流的生命周期内占用该上游的一个并发名额。timeout 为相邻两次读取之间的最大间隔；
+        调用方提前退出迭代时立即关闭上游连接。
+        只有在尚未产出任何事件时才会重试，已推送给调用方的部分输出不会重复。
+        """
+        resilience = self.resilience[upstream]
+        attempt_index = 0
+        while True:
+            resilience.before_call()
+            started = False
+            try:
+                async with aclosing(self._stream_once(upstream, url, payload, timeout)) as events:
+                    async for event in events:
+                        started = True
+                        yield event
+            except Exception as e:
+                resilience.record_outcome(e)
+                if started or not resilience.should_retry(e, attempt_index):
+                    raise
+                await resilience.backoff(attempt_index)
+                attempt_index += 1
+                continue
+            except BaseException:
+                # 调用方提前关闭或被取消，不计入熔断统计
+                resilience.breaker.on_neutral()
+                raise
+            resilience.record_outcome(None)
+            return
+
+    async def warm_up(self, connections: int) -> None:
+        """
+        预先建立到各上游的连接（含 TLS 握手与 HTTP/2 协商），连接随后留在连接池中供首批请求复用。
+
+        每个上游并发向端点所在主机的根路径发送 connections 个 HEAD 请求（HTTP/2 下复用同一连接），
+        不经过限流、重试与熔断，也不计入上游指标；响应状态无关紧要，失败时只记录日志。
+        """
+        endpoints = {"qwen": self.config.qwen_api_endpoint, "wanx": self.config.wanx_api_endpoint}
+
+        async def probe(upstream: str, origin: str) -> None:
+            try:
+                response = await self.client(upstream).head(origin, timeout=self.config.http_connect_timeout)
+                await response.aclose()
+            except httpx.HTTPError as e:
+                logger.warning(f"Warm-up connection to {origin} failed: {e!r}")
+
+        probes = []
+        for upstream, endpoint in endpoints.items():
+            parts = urlsplit(endpoint)
+            origin = f"{parts.scheme}://{parts.netloc}/"
+            probes.extend(probe(upstream, origin) for _ in range(max(1, min(connections, self._max_connections[upstream]))))
+        await asyncio.gather(*probes)
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
@@ -0,0 +1,490 @@
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import io
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Annotated, Dict, List, Optional, Tuple
+
+import httpx
+from pydantic import BaseModel, Field
+
+from .settings import Settings
+from .metrics import span
+
+# 导入 FastMCP 类型
+from fastmcp.utilities import logging
+
+logger = logging.get_logger(__name__)
+
+# Pillow 为可选依赖：未安装时只做格式与尺寸校验，超限图片直接拒绝而不是压缩。
+# 启动时只检查是否安装，首次需要转码时才在工作线程中导入
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+
+# DashScope 多模态接口可直接处理的格式
+UPSTREAM_FORMATS = {"image/jpeg", "image/png", "image/webp", "image/bmp"}
+EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/bmp": "bmp",
+              "image/gif": "gif", "image/tiff": "tiff"}
+
+
+class ImageIngestError(ValueError):
+    """
+    输入图片无法下载、格式不支持或尺寸不符合要求；在调用上游之前快速失败。
+    """
+
+
+# --- 1. 格式与尺寸识别（不依赖 Pillow） ---
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        # SOF0-SOF15（排除 DHT/JPG/DAC）携带图像尺寸
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    return None
+
+
+def sniff_image(data: bytes) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """
+    根据文件头判断图片格式并尽量读取宽高，返回 (mime_type, (width, height) 或 None)。
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg", _jpeg_size(data)
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24:
+        return "image/png", struct.unpack(">II", data[16:24])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", _webp_size(data)
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return "image/gif", struct.unpack("<HH", data[6:10])
+    if data[:2] == b"BM" and len(data) >= 26:
+        width, height = struct.unpack("<ii", data[18:26])
+        return "image/bmp", (width, abs(height))
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff", None
+    raise ImageIngestError("不支持的图片格式，请使用 JPEG、PNG、WebP 或 BMP")
+
+
+def _recompress(data: bytes, max_side: int) -> Tuple[bytes, str, Tuple[int, int]]:
+    """
+    在工作线程中按最长边缩放并重新编码：带透明通道的保留 PNG，其余转为 JPEG。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(buffer, format="PNG", optimize=True)
+            mime = "image/png"
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+            mime = "image/jpeg"
+        return buffer.getvalue(), mime, image.size
+
+
+# 下载时最多跟随的重定向次数；每一跳都重新校验目标地址
+MAX_REDIRECTS = 5
+
+# 两次清理磁盘缓存之间的最短间隔（秒）
+PRUNE_INTERVAL = 60.0
+
+
+async def check_public_host(url: httpx.URL) -> str:
+    """
+    解析主机名并拒绝回环、私有、链路本地（如 169.254.169.254 元数据服务）等非公网地址，
+    避免服务端代替调用方访问内网。任一解析结果不是公网地址即拒绝；返回校验过的第一个地址，
+    调用方应直接连接该地址，不再重新解析（防止 DNS rebinding 在校验后换成内网地址）。
+    """
+    host = url.host
+    try:
+        addresses = [ipaddress.ip_address(host)]
+    except ValueError:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(url.raw_host.decode("ascii"), url.port,
+                                                                 type=socket.SOCK_STREAM)
+        except OSError as e:
+            raise ImageIngestError(f"图片地址无法解析: {host}") from e
+        addresses = [ipaddress.ip_address(info[4][0].split("%", 1)[0]) for info in infos]
+    if not addresses:
+        raise ImageIngestError(f"图片地址无法解析: {host}")
+    for address in addresses:
+        mapped = getattr(address, "ipv4_mapped", None)
+        if not (mapped or address).is_global:
+            raise ImageIngestError(f"图片地址指向非公网地址，已拒绝: {host}")
+    return str(addresses[0])
+
+
+def pinned_request(url: httpx.URL, address: str) -> Tuple[httpx.URL, Dict[str, str], Dict[str, str]]:
+    """
+    改写请求使连接直达已校验的地址：URL 中的主机名换成该地址，Host 头与 TLS SNI（证书校验同样
+    以它为准）仍使用原主机名。返回 (请求 URL, 请求头, httpx 扩展参数)。
+    """
+    if address == url.host:
+        return url, {}, {}
+    name = url.raw_host.decode("ascii")
+    return (url.copy_with(host=address), {"Host": url.netloc.decode("ascii")},
+            {"sni_hostname": name} if url.scheme == "https" else {})
+
+
+async def download_image(client: httpx.AsyncClient, url: str, limit: int, allow_private: bool = False) -> bytes:
+    """
+    流式下载一张图片，超过 limit 字节时立即中止；下载失败统一抛出 ImageIngestError。
+
+    client 不应自动跟随重定向：这里逐跳跟随，每一跳都校验协议，并在 allow_private 为 False 时
+    校验目标是否为公网地址，且直接连接校验过的地址。
+    """
+    try:
+        target = httpx.URL(url)
+        for _ in range(MAX_REDIRECTS + 1):
+            if target.scheme not in ("http", "https"):
+                raise ImageIngestError(f"图片地址必须是 http(s) URL: {str(target)[:100]}")
+            if not target.host:
+                raise ImageIngestError(f"图片地址缺少主机名: {str(target)[:100]}")
+            request_url, headers, extensions = target, {}, {}
+            if not allow_private:
+                request_url, headers, extensions = pinned_request(target, await check_public_host(target))
+            async with client.stream("GET", request_url, headers=headers, extensions=extensions) as response:
+                if response.is_redirect:
+                    # 相对地址按原主机名而不是连接用的 IP 拼接
+                    target = target.join(response.headers.get("location", ""))
+                    continue
+                if response.is_error:
+                    raise ImageIngestError(f"图片下载失败: HTTP {response.status_code} {url[:100]}")
+                declared = response.headers.get("content-length")
+                if declared and declared.isdigit() and int(declared) > limit:
+                    raise ImageIngestError(f"图片过大: {int(declared)} 字节，上限 {limit} 字节")
+                chunks: List[bytes] = []
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received > limit:
+                        raise ImageIngestError(f"图片过大: 超过 {limit} 字节")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+    except httpx.InvalidURL as e:
+        # 调用方传入或重定向给出的地址无法解析为 URL
+        raise ImageIngestError(f"图片地址无效: {url[:100]}") from e
+    except httpx.HTTPError as e:
+        raise ImageIngestError(f"图片下载失败: {type(e).__name__} {url[:100]}") from e
+    raise ImageIngestError(f"图片下载失败: 重定向超过 {MAX_REDIRECTS} 次 {url[:100]}")
+
+
+# --- 2. 入库结果 ---
+class IngestedImage(BaseModel):
+    """
+    一张已校验（必要时已压缩）的输入图片。
+    """
+    source_url: Annotated[str, Field(description="调用方传入的原始图片地址")]
+    sha256: Annotated[str, Field(description="最终上送内容的 SHA-256")]
+    mime_type: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    size: Annotated[int, Field(description="最终上送内容的字节数")]
+    processed: Annotated[bool, Field(description="是否经过缩放或转码")] = False
+    path: Annotated[str, Field(description="磁盘缓存中的文件路径")]
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.read_bytes()).decode('ascii')}"
+
+
+# --- 3. 图片预取与缓存 ---
+class ImageIngestor:
+    """
+    在调用 DashScope 之前下载并校验输入图片。
+
+    - 按 URL 与内容哈希两级缓存在磁盘上，内存中保留最近使用的元数据；
+      超过 image_cache_ttl_seconds 未使用或总大小超过 image_cache_max_bytes 时，在线程池中按修改时间删除旧文件；
+    - 并发的相同 URL 只下载一次；
+    - 下载超过 image_download_max_bytes、格式不支持或尺寸不符合上游要求时立即失败；
+    - 最长边超过 image_max_side 或体积超过 image_target_bytes 时（需安装 Pillow）缩放并重新编码；
+    - 压缩过的图片与不超过 image_inline_max_bytes 的小图以 base64 data URL 上送，
+      其余沿用原始 URL，避免增大请求体。
+
+    独立于 DashScopeClient 的连接池，不会把 API 密钥发送给第三方图床。
+    """
+
+    def __init__(self, config: Settings):
+        self.config = config
+        self.cache_dir = config.image_cache_dir
+        self._client: Optional[httpx.AsyncClient] = None
+        self._memory: "OrderedDict[str, Tuple[float, IngestedImage]]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Future[IngestedImage]"] = {}
+        self._pruner: Optional[asyncio.Task] = None
+        self._last_prune = float("-inf")
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                # 重定向由 download_image 逐跳校验后跟随
+                follow_redirects=False,
+                timeout=httpx.Timeout(self.config.image_fetch_timeout, connect=self.config.http_connect_timeout),
+                limits=httpx.Limits(max_connections=self.config.image_fetch_max_connections),
+            )
+        return self._client
+
+    @staticmethod
+    def _url_key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    # --- 磁盘缓存（在线程池中执行） ---
+    def _index_path(self, url_key: str) -> str:
+        return os.path.join(self.cache_dir, "urls", f"{url_key}.json")
+
+    def _load_index(self, url_key: str) -> Optional[IngestedImage]:
+        path = self._index_path(url_key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.config.image_cache_ttl_seconds:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                image = IngestedImage.model_validate_json(f.read())
+        except (OSError, ValueError):
+            return None
+        try:
+            # 刷新修改时间，清理时按最近使用排序
+            os.utime(image.path)
+        except OSError:
+            return None
+        return image
+
+    def _store(self, url: str, data: bytes, mime: str, dimensions: Optional[Tuple[int, int]], processed: bool) -> IngestedImage:
+        digest = hashlib.sha256(data).hexdigest()
+        blob_dir = os.path.join(self.cache_dir, "blobs")
+        os.makedirs(blob_dir, exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, "urls"), exist_ok=True)
+        path = os.path.join(blob_dir, f"{digest}.{EXTENSIONS[mime]}")
+        # 内容寻址：相同内容只写一次；先写临时文件再改名，避免并发读到半个文件
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        width, height = dimensions if dimensions else (None, None)
+        # data URL 只保留头部，避免在内存元数据中重复保存整张图片
+        source = url.split(",", 1)[0] if url.startswith("data:") else url
+        image = IngestedImage(source_url=source, sha256=digest, mime_type=mime, width=width, height=height,
+                              size=len(data), processed=processed, path=path)
+        if not url.startswith("data:"):
+            index_path = self._index_path(self._url_key(url))
+            tmp = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(image.model_dump_json())
+            os.replace(tmp, index_path)
+        return image
+
+    def _prune(self) -> int:
+        """
+        删除超过有效期的 URL 索引与图片，再按修改时间从旧到新删除图片，直到总大小不超过 image_cache_max_bytes。
+        被删除图片的索引在读取时发现文件不存在而失效。返回删除的文件数。
+        """
+        now = time.time()
+        removed = 0
+        blobs: List[Tuple[float, int, str]] = []
+        for name in ("urls", "blobs"):
+            try:
+                entries = list(os.scandir(os.path.join(self.cache_dir, name)))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    if now - stat.st_mtime > self.config.image_cache_ttl_seconds:
+                        os.remove(entry.path)
+                        removed += 1
+                    elif name == "blobs" and not entry.name.endswith(".tmp"):
+                        blobs.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.config.image_cache_max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+        return removed
+
+    async def _prune_in_background(self) -> None:
+        try:
+            removed = await asyncio.to_thread(self._prune)
+        except Exception as e:
+            logger.warning(f"Failed to prune image cache {self.cache_dir}: {e}")
+            return
+        if removed:
+            logger.info(f"Pruned {removed} files from image cache {self.cache_dir}")
+
+    def _maybe_prune(self) -> None:
+        """
+        写入新图片后调用：距上次清理超过 PRUNE_INTERVAL 秒且没有正在进行的清理时，启动一次后台清理。
+        """
+        now = time.monotonic()
+        if now - self._last_prune < PRUNE_INTERVAL or (self._pruner is not None and not self._pruner.done()):
+            return
+        self._last_prune = now
+        self._pruner = asyncio.create_task(self._prune_in_background())
+
+    # --- 下载与处理 ---
+    async def _download(self, url: str) -> bytes:
+        if url.startswith("data:"):
+            header, _, encoded = url.partition(",")
+            if ";base64" not in header:
+                raise ImageIngestError("仅支持 base64 编码的 data URL")
+            try:
+                return base64.b64decode(encoded, validate=True)
+            except ValueError:
+                raise ImageIngestError("data URL 不是有效的 base64 内容")
+        return await download_image(self._http(), url, self.config.image_download_max_bytes,
+                                    allow_private=self.config.image_fetch_allow_private)
+
+    async def _process(self, url: str, data: bytes) -> IngestedImage:
+        mime, dimensions = sniff_image(data)
+        oversized = (dimensions is not None and max(dimensions) > self.config.image_max_side) \
+            or len(data) > self.config.image_target_bytes
+        processed = False
+        if oversized or mime not in UPSTREAM_FORMATS:
+            if PILLOW_AVAILABLE:
+                data, mime, dimensions = await asyncio.to_thread(_recompress, data, self.config.image_max_side)
+                processed = True
+            elif mime not in UPSTREAM_FORMATS:
+                raise ImageIngestError(f"上游不支持 {mime} 格式，且未安装 Pillow 无法转码")
+        if len(data) > self.config.image_max_bytes:
+            raise ImageIngestError(f"图片过大: {len(data)} 字节，上游上限 {self.config.image_max_bytes} 字节")
+
+        image = await asyncio.to_thread(self._store, url, data, mime, dimensions, processed)
+        self._maybe_prune()
+        return image
+
+    async def _ingest_uncached(self, url: str) -> IngestedImage:
+        url_key = self._url_key(url)
+        cached = None if url.startswith("data:") else await asyncio.to_thread(self._load_index, url_key)
+        if cached is not None:
+            return cached
+        with span("image_ingest.fetch"):
+            data = await self._download(url)
+        with span("image_ingest.process"):
+            return await self._process(url, data)
+
+    def _remember(self, url_key: str, image: IngestedImage) -> None:
+        self._memory[url_key] = (time.monotonic(), image)
+        self._memory.move_to_end(url_key)
+        while len(self._memory) > self.config.image_cache_memory_entries:
+            self._memory.popitem(last=False)
+
+    async def ingest(self, url: str) -> IngestedImage:
+        """
+        下载、校验并缓存一张图片；相同 URL 的并发调用共享同一次下载，发起下载的调用被取消时由其他调用接手。
+        """
+        url = url.strip()
+        url_key = self._url_key(url)
+        entry = self._memory.get(url_key)
+        if entry is not None and time.monotonic() - entry[0] <= self.config.image_cache_ttl_seconds:
+            self._memory.move_to_end(url_key)
+            return entry[1]
+
+        while (inflight := self._inflight.get(url_key)) is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # 下载方被取消而本调用未被取消时，由第一个醒来的等待方重新下载
+                task = asyncio.current_task()
+                if not inflight.cancelled() or (task is not None and task.cancelling()):
+                    raise
+
+        future: "asyncio.Future[IngestedImage]" = asyncio.get_running_loop().create_future()
+        self._inflight[url_key] = future
+        try:
+            image = await self._ingest_uncached(url)
+        except asyncio.CancelledError:
+            # 先移除再取消，等待方醒来时不会再次加入已取消的下载
+            if self._inflight.get(url_key) is future:
+                del self._inflight[url_key]
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(image)
+            self._remember(url_key, image)
+            return image
+        finally:
+            if self._inflight.get(url_key) is future:
+                del self._inflight[url_key]
+
+    async def resolve(self, url: Optional[str], min_side: Optional[int] = None) -> Optional[str]:
+        """
+        返回应当上送给 DashScope 的图片地址：压缩过的图片与小图为 base64 data URL，其余为原始 URL。
+        url 为空或未开启预取时原样返回；校验失败抛出 ImageIngestError。
+        min_side 为该上游要求的最短边像素数，默认取 image_min_side。
+        """
+        if not url or not url.strip() or not self.config.image_ingest_enabled:
+            return url
+        url = url.strip()
+        image = await self.ingest(url)
+        min_side = min_side if min_side is not None else self.config.image_min_side
+        if image.width is not None and image.height is not None and min(image.width, image.height) < min_side:
+            raise ImageIngestError(f"图片尺寸过小: {image.width}x{image.height}，最短边至少 {min_side} 像素")
+        if image.processed or (image.size <= self.config.image_inline_max_bytes and not url.startswith("data:")):
+            try:
+                return await asyncio.to_thread(image.data_url)
+            except FileNotFoundError:
+                # 缓存文件已被清理（可能由共用目录的其他进程）：丢弃内存中的元数据后重新下载
+                self._memory.pop(self._url_key(url), None)
+                image = await self.ingest(url)
+                return await asyncio.to_thread(image.data_url)
+        return url
+
+    async def resolve_many(self, urls: List[str]) -> List[str]:
+        """
+        并发预取多张图片。
+        """
+        return list(await asyncio.gather(*(self.resolve(url) for url in urls)))
+
+    async def aclose(self) -> None:
+        pruner, self._pruner = self._pruner, None
+        if pruner is not None and not pruner.done():
+            pruner.cancel()
+            await asyncio.gather(pruner, return_exceptions=True)
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
@@ -0,0 +1,33 @@
+import os
+from typing import Any, Optional, Tuple
+
+# 在进程池中执行的图片编码操作。本模块只依赖 Pillow、不导入服务的其他模块，
+# 子进程只需导入这里即可开始工作，不会重复加载 FastMCP 等重量级依赖
+
+
+def _save_atomic(image: Any, path: str, **options: Any) -> None:
+    # 先写临时文件再改名，并发请求与其他 worker 不会读到半个文件
+    tmp = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp, **options)
+    os.replace(tmp, path)
+
+
+def render_derivatives(source_path: str, webp_path: Optional[str], thumbnail_path: str,
+                       thumbnail_side: int, quality: int) -> Tuple[int, int]:
+    """
+    读取原图，生成同尺寸的 WebP 版本（webp_path 为 None 时跳过，如原图已是 WebP）
+    与最长边不超过 thumbnail_side 的 WebP 缩略图，返回原图的宽高。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as source:
+        size = source.size
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode == "LA" or "transparency" in image.info else "RGB")
+        if webp_path is not None:
+            _save_atomic(image, webp_path, format="WEBP", quality=quality, method=4)
+        thumbnail = image.copy()
+        thumbnail.thumbnail((thumbnail_side, thumbnail_side), Image.Resampling.LANCZOS)
+        _save_atomic(thumbnail, thumbnail_path, format="WEBP", quality=quality, method=4)
+    return size
@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Annotated, Dict, List, Optional, Tuple
+
+import httpx
+from pydantic import BaseModel, Field
+from starlette.requests import Request
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+from .settings import Settings
+from .image_ingest import EXTENSIONS, PILLOW_AVAILABLE, ImageIngestError, download_image, sniff_image
+from .image_ops import render_derivatives
+from .metrics import metrics, span
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+from fastmcp.utilities import logging
+
+logger = logging.get_logger(__name__)
+
+ROUTE_PREFIX = "/images"
+_FILE_NAME = re.compile(r"^[0-9a-f]{64}(?:\.thumb)?\.(?:jpg|png|webp|bmp|gif|tiff)$")
+
+
+# --- 1. 保存结果 ---
+class StoredImage(BaseModel):
+    """
+    一张已保存到本地的生成图片。保存失败时 url 为上游返回的临时地址，并附带 error。
+    """
+    source_url: Annotated[str, Field(description="通义万相返回的临时图片地址")]
+    url: Annotated[str, Field(description="稳定的本地访问地址（原图）")]
+    sha256: Optional[str] = None
+    mime_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    size: Annotated[Optional[int], Field(description="原图字节数")] = None
+    webp_url: Annotated[Optional[str], Field(description="同尺寸 WebP 版本的地址（需安装 Pillow）")] = None
+    thumbnail_url: Annotated[Optional[str], Field(description="WebP 缩略图地址（需安装 Pillow）")] = None
+    error: Optional[str] = None
+
+
+class _StoredFiles(BaseModel):
+    """
+    磁盘上的元数据：只记录文件名，访问地址在返回时按当前的 base_url 拼接。
+    """
+    sha256: str
+    mime_type: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    size: int
+    original: str
+    webp: Optional[str] = None
+    thumbnail: Optional[str] = None
+
+
+# --- 2. 内容寻址存储 ---
+class GeneratedImageStore:
+    """
+    下载通义万相返回的临时图片并按内容哈希保存在 image_store_dir 下：
+
+    - 同一批图片并发下载，内容相同的图片只保存和处理一次；
+    - 安装 Pillow 时在进程池中生成同尺寸 WebP 与缩略图，不占用事件循环与线程池；
+    - 文件名即内容哈希，通过 GET /images/{文件名} 访问，可被客户端与 CDN 永久缓存。
+
+    多个 worker 进程可共用同一目录：文件先写临时文件再改名，元数据最后写入，代表处理完成。
+    """
+
+    def __init__(self, config: Settings):
+        self.config = config
+        self.root = config.image_store_dir
+        self._client: Optional[httpx.AsyncClient] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, "asyncio.Future[_StoredFiles]"] = {}
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                # 重定向由 download_image 逐跳校验后跟随
+                follow_redirects=False,
+                timeout=httpx.Timeout(self.config.image_store_fetch_timeout, connect=self.config.http_connect_timeout),
+                limits=httpx.Limits(max_connections=self.config.image_fetch_max_connections),
+            )
+        return self._client
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # forkserver / spawn 的子进程不继承事件循环与线程状态；子进程只导入 src.image_ops
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = ProcessPoolExecutor(max_workers=self.config.image_store_process_workers,
+                                             mp_context=multiprocessing.get_context(method))
+        return self._pool
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    # --- 磁盘操作（在线程池中执行） ---
+    def _load(self, digest: str) -> Optional[_StoredFiles]:
+        try:
+            with open(self.path(f"{digest}.json"), "r", encoding="utf-8") as f:
+                files = _StoredFiles.model_validate_json(f.read())
+        except (OSError, ValueError):
+            return None
+        return files if os.path.exists(self.path(files.original)) else None
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self.path(name)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _save_metadata(self, files: _StoredFiles) -> None:
+        self._write(f"{files.sha256}.json", files.model_dump_json().encode("utf-8"))
+
+    # --- 处理 ---
+    async def _derive(self, files: _StoredFiles) -> None:
+        """
+        在进程池中生成 WebP 与缩略图；失败时只保留原图。
+        """
+        webp = None if files.mime_type == "image/webp" else f"{files.sha256}.webp"
+        thumbnail = f"{files.sha256}.thumb.webp"
+        try:
+            with span("image_store.derive"):
+                width, height = await asyncio.get_running_loop().run_in_executor(
+                    self._executor(), render_derivatives, self.path(files.original),
+                    self.path(webp) if webp else None, self.path(thumbnail),
+                    self.config.image_store_thumbnail_side, self.config.image_store_webp_quality,
+                )
+        except BrokenProcessPool as e:
+            # 子进程异常退出（如内存不足）后进程池不可再用，下次使用时重建
+            self._pool = None
+            logger.warning(f"Image derivative pool broke, keeping original only: {e}")
+            return
+        except Exception as e:
+            logger.warning(f"Failed to render derivatives for {files.sha256}: {e}")
+            return
+        files.width, files.height = width, height
+        files.webp = webp or files.original
+        files.thumbnail = thumbnail
+
+    async def _save_uncached(self, digest: str, data: bytes, mime: str,
+                             dimensions: Optional[Tuple[int, int]]) -> _StoredFiles:
+        files = await asyncio.to_thread(self._load, digest)
+        if files is not None:
+            metrics.image_store.inc(outcome="deduplicated")
+            return files
+        width, height = dimensions if dimensions else (None, None)
+        files = _StoredFiles(sha256=digest, mime_type=mime, width=width, height=height, size=len(data),
+                             original=f"{digest}.{EXTENSIONS[mime]}")
+        await asyncio.to_thread(self._write, files.original, data)
+        if PILLOW_AVAILABLE:
+            await self._derive(files)
+        await asyncio.to_thread(self._save_metadata, files)
+        metrics.image_store.inc(outcome="stored")
+        return files
+
+    async def _save(self, data: bytes) -> _StoredFiles:
+        mime, dimensions = sniff_image(data)
+        digest = hashlib.sha256(data).hexdigest()
+        # 同一内容的并发保存共享一次处理
+        joined = False
+        while (inflight := self._inflight.get(digest)) is not None:
+            if not joined:
+                metrics.image_store.inc(outcome="deduplicated")
+                joined = True
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # 保存方被取消而本调用未被取消时，由第一个醒来的等待方接手保存
+                task = asyncio.current_task()
+                if not inflight.cancelled() or (task is not None and task.cancelling()):
+                    raise
+        future: "asyncio.Future[_StoredFiles]" = asyncio.get_running_loop().create_future()
+        self._inflight[digest] = future
+        try:
+            files = await self._save_uncached(digest, data, mime, dimensions)
+        except asyncio.CancelledError:
+            if self._inflight.get(digest) is future:
+                del self._inflight[digest]
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(files)
+            return files
+        finally:
+            if self._inflight.get(digest) is future:
+                del self._inflight[digest]
+
+    async def persist(self, url: str, base_url: str) -> StoredImage:
+        """
+        下载并保存一张生成图片，返回以 base_url 为前缀的稳定地址；任何失败都记录在 error 中，不抛出异常。
+        """
+        try:
+            with span("image_store.download"):
+                data = await download_image(self._http(), url, self.config.image_store_max_bytes,
+                                            allow_private=self.config.image_fetch_allow_private)
+            files = await self._save(data)
+        except (ImageIngestError, OSError) as e:
+            metrics.image_store.inc(outcome="failed")
+            logger.warning(f"Failed to persist generated image {url[:100]}: {e}")
+            return StoredImage(source_url=url, url=url, error=str(e))
+
+        def link(name: Optional[str]) -> Optional[str]:
+            return f"{base_url.rstrip('/')}{ROUTE_PREFIX}/{name}" if name else None
+
+        return StoredImage(source_url=url, url=link(files.original), sha256=files.sha256,
+                           mime_type=files.mime_type, width=files.width, height=files.height, size=files.size,
+                           webp_url=link(files.webp), thumbnail_url=link(files.thumbnail))
+
+    async def persist_many(self, urls: List[str], base_url: str) -> List[StoredImage]:
+        """
+        并发保存一批图片，结果与 urls 顺序一致。
+        """
+        return list(await asyncio.gather(*(self.persist(url, base_url) for url in urls)))
+
+    def warm(self) -> None:
+        """
+        预先启动进程池的子进程（由后台预热调用），避免首次处理时等待子进程启动。
+        """
+        if PILLOW_AVAILABLE:
+            pool = self._executor()
+            for _ in range(self.config.image_store_process_workers):
+                pool.submit(os.getpid)
+
+    async def aclose(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- 3. 访问地址与路由 ---
+def public_base_url(config: Settings) -> str:
+    """
+    返回拼接图片地址的前缀：优先使用 IMAGE_STORE_BASE_URL；否则按当前 HTTP 请求的 Host 推断，
+    不在 HTTP 请求中（如内存客户端）时返回空字符串，即站内相对路径。
+    """
+    if config.image_store_base_url:
+        return config.image_store_base_url
+    from fastmcp.server.dependencies import get_http_request
+    try:
+        request = get_http_request()
+    except RuntimeError:
+        return ""
+    scheme = request.headers.get("x-forwarded-proto") or request.url.scheme
+    host = request.headers.get("x-forwarded-host") or request.headers.get("host") or request.url.netloc
+    return f"{scheme}://{host}"
+
+
+def register_image_store_routes(mcp: FastMCP, store: GeneratedImageStore) -> None:
+    """
+    挂载 GET /images/{name}，与 MCP 传输共用同一端口。文件名为内容哈希，内容不会变化，可永久缓存。
+    """
+
+    @mcp.custom_route(f"{ROUTE_PREFIX}/{{name}}", methods=["GET"])
+    async def stored_image(request: Request) -> Response:
+        name = request.path_params["name"]
+        path = store.path(name)
+        if not _FILE_NAME.match(name) or not os.path.exists(path):
+            return PlainTextResponse("Not Found", status_code=404)
+        return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Annotated, Any, Dict, List, Optional, Set
+
+from pydantic import BaseModel, Field
+
+from .settings import Settings
+from .http_client import DashScopeClient
+from .cache import make_cache_key, normalize_text
+from .image_ingest import ImageIngestor
+from .deadline import clear as clear_deadline
+from .generate_img import poll_image_task, request_product_images, submit_image_task
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+from fastmcp.utilities import logging
+
+logger = logging.get_logger(__name__)
+
+PENDING, RUNNING, SUCCEEDED, FAILED = "pending", "running", "succeeded", "failed"
+
+
+# --- 1. 定义输出类型 ---
+class ImageJob(BaseModel):
+    """
+    异步图像生成任务的状态与结果。
+    """
+    job_id: Annotated[str, Field(description="任务 ID，用于查询进度与结果")]
+    status: Annotated[str, Field(description="任务状态：pending / running / succeeded / failed")]
+    image_urls: Annotated[List[str], Field(description="生成成功时的图片公开访问URL列表")] = []
+    error: Annotated[Optional[str], Field(description="失败时的错误信息")] = None
+    deduplicated: Annotated[bool, Field(description="提交时是否复用了相同输入的已有任务")] = False
+    created_at: float
+    updated_at: float
+
+
+# --- 2. 任务存储 (SQLite) ---
+class JobStore:
+    """
+    持久化的任务表：服务重启或客户端断线重连后仍可查询结果。所有操作在线程池中执行。
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_jobs ("
+                " job_id TEXT PRIMARY KEY, input_hash TEXT NOT NULL, status TEXT NOT NULL,"
+                " request TEXT NOT NULL, result TEXT, error TEXT, task_id TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT, lease_until REAL)"
+            )
+            # 早期版本创建的表没有租约列
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(image_jobs)")}
+            for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE image_jobs ADD COLUMN {column} {kind}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_image_jobs_input ON image_jobs(input_hash, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs(status)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row, deduplicated: bool = False) -> ImageJob:
+        return ImageJob(
+            job_id=row["job_id"],
+            status=row["status"],
+            image_urls=json.loads(row["result"]) if row["result"] else [],
+            error=row["error"],
+            deduplicated=deduplicated,
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+        )
+
+    def get(self, job_id: str) -> Optional[ImageJob]:
+        with self._lock:
+            row = self._connection().execute("SELECT * FROM image_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row is not None else None
+
+    def find_or_create(self, input_hash: str, request: Dict[str, Any]) -> ImageJob:
+        """
+        相同输入且未失败、未过期的任务直接复用，否则新建 pending 任务。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # 多个 worker 进程共用同一数据库文件时，查找与插入需在同一写事务内完成
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM image_jobs WHERE input_hash = ? AND status != ? AND created_at >= ?"
+                " ORDER BY created_at DESC LIMIT 1",
+                (input_hash, FAILED, now - self.ttl_seconds),
+            ).fetchone()
+            if row is not None:
+                conn.rollback()
+                return self._to_job(row, deduplicated=True)
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO image_jobs (job_id, input_hash, status, request, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, input_hash, PENDING, json.dumps(request, ensure_ascii=False), now, now),
+            )
+            conn.commit()
+        return ImageJob(job_id=job_id, status=PENDING, created_at=now, updated_at=now)
+
+    def update(self, job_id: str, status: str, result: Optional[List[str]] = None,
+               error: Optional[str] = None, task_id: Optional[str] = None) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "UPDATE image_jobs SET status = ?, result = COALESCE(?, result), error = ?,"
+                " task_id = COALESCE(?, task_id), updated_at = ? WHERE job_id = ?",
+                (status, json.dumps(result) if result is not None else None, error, task_id, time.time(), job_id),
+            )
+            conn.commit()
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT request, task_id, status FROM image_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"request": json.loads(row["request"]), "task_id": row["task_id"], "status": row["status"]}
+
+    def claim(self, job_id: str, owner: str, lease_seconds: float) -> bool:
+        """
+        为未完成的任务取得租约：任务未被占用、租约已过期或本就属于 owner 时成功。
+        多个进程共用同一数据库文件时，同一任务同时只有一个进程能取得租约。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "UPDATE image_jobs SET owner = ?, lease_until = ? WHERE job_id = ? AND status IN (?, ?)"
+                " AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+                (owner, now + lease_seconds, job_id, PENDING, RUNNING, owner, now),
+            )
+            conn.commit()
+        return cursor.rowcount == 1
+
+    def release(self, owner: str, job_id: Optional[str] = None) -> None:
+        """
+        释放 owner 持有的租约；job_id 为空时释放全部（进程正常退出时），其他进程可立即接管。
+        """
+        with self._lock:
+            conn = self._connection()
+            if job_id is None:
+                conn.execute("UPDATE image_jobs SET owner = NULL, lease_until = NULL WHERE owner = ?", (owner,))
+            else:
+                conn.execute("UPDATE image_jobs SET owner = NULL, lease_until = NULL WHERE job_id = ? AND owner = ?",
+                             (job_id, owner))
+            conn.commit()
+
+    def unfinished(self) -> List[str]:
+        """
+        清理过期任务，并返回未完成且没有有效租约的任务 ID（上次退出时未完成，或执行它的进程已退出）。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM image_jobs WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.commit()
+            rows = conn.execute(
+                "SELECT job_id FROM image_jobs WHERE status IN (?, ?) AND (owner IS NULL OR lease_until < ?)"
+                " ORDER BY created_at", (PENDING, RUNNING, now)
+            ).fetchall()
+        return [row["job_id"] for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# --- 3. 任务调度 ---
+class ImageJobManager:
+    """
+    异步图像任务：提交立即返回 job_id，由固定数量的 worker 在后台执行。
+
+    worker 在首次提交时启动，并恢复上次退出时未完成的任务；开启 WANX_ASYNC_ENABLED 时
+    使用 DashScope 异步任务模式提交后轮询结果，重启后可凭已保存的 task_id 继续轮询而不重复生成。
+
+    执行前先在任务表中取得该任务的租约（owner 与 lease_until 列），多个 worker 进程共用同一任务库时
+    同一任务只由一个进程执行，不依赖共享状态后端。正常退出时释放租约；进程异常退出时，
+    其他进程（或重启后的本进程）在租约过期后的下一次巡检中接管。
+    """
+
+    def __init__(self, http: DashScopeClient, images: ImageIngestor, config: Settings):
+        self.http = http
+        self.images = images
+        self.config = config
+        self._owner = uuid.uuid4().hex
+        # 租约覆盖单个任务的最长轮询时间并留出余量
+        self._lease_seconds = config.image_job_timeout + 60.0
+        self.store = JobStore(config.image_job_store_path, config.image_job_ttl_seconds)
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        # 排队中或执行中的任务，避免启动恢复与新提交重复入队
+        self._active: Set[str] = set()
+        self._changed: Dict[str, asyncio.Event] = {}
+
+    def input_hash(self, base_image_url: str, image_prompt: str) -> str:
+        return make_cache_key(
+            base_image_url=base_image_url.strip(),
+            image_prompt=normalize_text(image_prompt),
+            model=self.config.wanx_model_name,
+        )
+
+    async def _ensure_workers(self) -> None:
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.config.image_job_workers)]
+        await self._requeue_unfinished()
+        self._workers.append(asyncio.create_task(self._recover()))
+
+    async def _requeue_unfinished(self) -> None:
+        for job_id in await asyncio.to_thread(self.store.unfinished):
+            self._enqueue(job_id)
+
+    async def _recover(self) -> None:
+        # 定期巡检未完成的任务，接管租约已过期（原进程已退出）的任务
+        clear_deadline()
+        while True:
+            await asyncio.sleep(self._lease_seconds / 2)
+            await self._requeue_unfinished()
+
+    def _enqueue(self, job_id: str) -> None:
+        if job_id not in self._active:
+            self._active.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _notify(self, job_id: str) -> None:
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _update(self, job_id: str, status: str, **fields: Any) -> None:
+        await asyncio.to_thread(self.store.update, job_id, status, **fields)
+        self._notify(job_id)
+
+    async def _generate(self, job_id: str, request: Dict[str, Any], task_id: Optional[str]) -> List[str]:
+        if not self.config.wanx_async_enabled:
+            base_image = await self.images.resolve(request["base_image_url"], min_side=self.config.wanx_image_min_side)
+            return await request_product_images(self.http, base_image, request["image_prompt"])
+
+        if task_id is None:
+            base_image = await self.images.resolve(request["base_image_url"], min_side=self.config.wanx_image_min_side)
+            task_id = await submit_image_task(self.http, base_image, request["image_prompt"])
+            await asyncio.to_thread(self.store.update, job_id, RUNNING, task_id=task_id)
+
+        deadline = time.monotonic() + self.config.image_job_timeout
+        interval = self.config.image_job_poll_interval
+        while True:
+            urls = await poll_image_task(self.http, task_id)
+            if urls is not None:
+                return urls
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"异步任务 {task_id} 超过 {self.config.image_job_timeout:.0f} 秒仍未完成")
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, self.config.image_job_poll_max_interval)
+
+    async def _run(self, job_id: str) -> None:
+        # 租约只授予未完成的任务，其他进程刚刚完成或正在执行的任务在此跳过
+        if not await asyncio.to_thread(self.store.claim, job_id, self._owner, self._lease_seconds):
+            return
+        try:
+            saved = await asyncio.to_thread(self.store.load, job_id)
+            if saved is None or saved["status"] not in (PENDING, RUNNING):
+                return
+            await self._update(job_id, RUNNING)
+            try:
+                urls = await self._generate(job_id, saved["request"], saved["task_id"])
+            except Exception as e:
+                logger.warning(f"Image job {job_id} failed: {e}")
+                await self._update(job_id, FAILED, error=str(e))
+            else:
+                await self._update(job_id, SUCCEEDED, result=urls)
+        finally:
+            await asyncio.to_thread(self.store.release, self._owner, job_id)
+
+    async def _worker(self) -> None:
+        # worker 在首次提交任务的工具调用中创建，不继承该调用的截止时间
+        clear_deadline()
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._active.discard(job_id)
+                self._queue.task_done()
+
+    async def submit(self, base_image_url: str, image_prompt: str) -> ImageJob:
+        await self._ensure_workers()
+        request = {"base_image_url": base_image_url.strip(), "image_prompt": image_prompt}
+        job = await asyncio.to_thread(self.store.find_or_create, self.input_hash(base_image_url, image_prompt), request)
+        if not job.deduplicated:
+            self._enqueue(job.job_id)
+        return job
+
+    async def get(self, job_id: str, wait_seconds: float = 0.0) -> Optional[ImageJob]:
+        """
+        查询任务；wait_seconds > 0 时在任务结束前最多等待该秒数（长轮询）。
+        """
+        await self._ensure_workers()
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            job = await asyncio.to_thread(self.store.get, job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.status in (SUCCEEDED, FAILED) or remaining <= 0:
+                return job
+            event = self._changed.setdefault(job_id, asyncio.Event())
+            # 由其他 worker 进程执行的任务不会触发本进程的事件，最多每秒重新读取一次存储
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def aclose(self) -> None:
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # 未执行完的任务保留 pending/running 状态并释放租约，其他进程或下次启动时立即恢复
+        self._queue = asyncio.Queue()
+        self._active.clear()
+        if workers:
+            await asyncio.to_thread(self.store.release, self._owner)
+        self.store.close()
+
+
+# --- 4. 工具注册函数：register_job_tools ---
+def register_job_tools(mcp: FastMCP, jobs: ImageJobManager) -> None:
+    """
+    注册异步图像任务的提交与查询工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "submit_product_image_job", "readOnlyHint": False}
+    )
+    async def submit_product_image_job(
+        base_image_url: Annotated[str, Field(description="用于编辑或作为参考的原始图片URL")],
+        image_prompt: Annotated[str, Field(description="图像生成工具生成的英文指令，包含风格和场景描述")]
+    ) -> ImageJob:
+        """
+        提交宣传图片生成任务并立即返回 job_id；相同输入会复用已有任务。之后用 get_product_image_job 查询结果。
+        """
+        return await jobs.submit(base_image_url, image_prompt)
+
+    @mcp.tool(
+        annotations={"title": "get_product_image_job", "readOnlyHint": True}
+    )
+    async def get_product_image_job(
+        job_id: Annotated[str, Field(description="submit_product_image_job 返回的任务 ID")],
+        wait_seconds: Annotated[float, Field(description="任务未完成时最多等待的秒数（0-30），0 表示立即返回当前状态", ge=0, le=30)] = 0.0
+    ) -> ImageJob:
+        """
+        查询宣传图片生成任务的状态；成功时返回图片URL列表。断线重连或服务重启后仍可查询。
+        """
+        job = await jobs.get(job_id, wait_seconds)
+        if job is None:
+            now = time.time()
+            return ImageJob(job_id=job_id, status=FAILED, error="任务不存在或已过期", created_at=now, updated_at=now)
+        return job
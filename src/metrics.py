@@ -0,0 +1,374 @@
+import asyncio
+import bisect
+import os
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .settings import settings
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+# OpenTelemetry 为可选依赖：未安装或未开启 TRACING_ENABLED 时只记录直方图，不创建 span。
+# 只在开启 TRACING_ENABLED 后首次创建 span 时导入
+otel_trace: Any = None
+_otel_unavailable = False
+
+
+LabelValues = Tuple[str, ...]
+
+# 覆盖 5ms ~ 2min：文案生成通常数秒，图像编辑可达一分钟以上
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+# 当前工具调用的上游用量汇总，由 usage_scope() 开启；调用内创建的子任务复制上下文后共享同一个字典
+_call_usage: ContextVar[Optional[Dict[str, Any]]] = ContextVar("call_usage", default=None)
+
+
+@contextmanager
+def usage_scope() -> Iterator[Dict[str, Any]]:
+    """
+    在作用域内汇总所有上游响应报告的 token 用量与所用模型（用于生成历史记录）。
+    """
+    usage: Dict[str, Any] = {"prompt_tokens": 0, "completion_tokens": 0, "models": []}
+    token = _call_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _call_usage.reset(token)
+
+
+# --- 1. 指标类型 ---
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value:g}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    固定分桶直方图：观测只做一次二分查找与两次加法，可在生产环境常开。
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # 每组标签：各分桶（非累计）计数 + 溢出桶、总和
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            cumulative += counts[-1]
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, inf)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total[0]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+# --- 2. 指标注册表 ---
+class MetricsRegistry:
+    """
+    进程内指标注册表，以 Prometheus 文本格式导出。
+
+    所有观测都在事件循环线程内完成，无需加锁。
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self.tool_calls = self._add(Counter("ecom_tool_calls_total", "工具调用次数", ("tool", "status")))
+        self.tool_duration = self._add(Histogram("ecom_tool_duration_seconds", "工具调用耗时（含排队）", ("tool",)))
+        self.tool_deadline_exceeded = self._add(Counter("ecom_tool_deadline_exceeded_total", "超过截止时间被取消的工具调用数", ("tool",)))
+        self.tool_in_flight = self._add(Gauge("ecom_tool_in_flight", "正在执行的工具调用数", ("tool",)))
+        self.tool_request_bytes = self._add(Histogram("ecom_tool_request_bytes", "工具调用参数大小（字符数）", ("tool",), SIZE_BUCKETS))
+        self.tool_response_bytes = self._add(Histogram("ecom_tool_response_bytes", "工具返回内容大小", ("tool",), SIZE_BUCKETS))
+        self.stage_duration = self._add(Histogram("ecom_stage_duration_seconds", "各处理阶段耗时", ("stage",)))
+        self.compliance_findings = self._add(Counter("ecom_compliance_findings_total", "本地合规预检命中的风险词次数", ("scope", "category")))
+        self.output_parses = self._add(Counter("ecom_output_parses_total", "模型输出的解析结果：valid / repaired（本地修复）/ reasked（重问后合法）/ failed", ("tool", "outcome")))
+        self.image_store = self._add(Counter("ecom_image_store_total", "生成图片的保存结果：stored / deduplicated（内容已存在）/ failed", ("outcome",)))
+        self.image_items = self._add(Counter("ecom_image_items_total", "多图生成中每张图片的结果：ok / failed（所在调用失败）/ timeout（超过截止时间）", ("outcome",)))
+        self.route_requests = self._add(Counter("ecom_route_requests_total", "各模型路由的尝试结果：accepted（采用）/ escalated（升级到下一路由）/ failed", ("tool", "route", "outcome")))
+        self.route_escalations = self._add(Counter("ecom_route_escalations_total", "模型路由升级原因：schema（输出结构不合法）/ score（自评分过低）", ("tool", "route", "reason")))
+        self.route_duration = self._add(Histogram("ecom_route_duration_seconds", "各模型路由单次尝试的耗时（含本地修复与重问）", ("tool", "route")))
+        self.route_cost = self._add(Counter("ecom_route_cost_total", "按路由配置的每千 token 单价估算的调用费用", ("tool", "route")))
+        self.history_records = self._add(Counter("ecom_history_records_total", "生成历史记录：written（已写入）/ dropped（待写队列已满）/ failed（写入失败）/ reused（作为复用来源直接返回）", ("outcome",)))
+        self.semantic_cache = self._add(Counter("ecom_semantic_cache_total", "近似重复查找结果：hit（直接复用）/ warm（作为参考）/ miss", ("tool", "outcome")))
+        self.content_variants = self._add(Counter("ecom_content_variants_total", "多变体文案候选的去向：入选、重复剔除或无法解析", ("outcome",)))
+        self.upstream_requests = self._add(Counter("ecom_upstream_requests_total", "上游请求次数", ("upstream", "status")))
+        self.upstream_duration = self._add(Histogram("ecom_upstream_phase_seconds", "上游请求各阶段耗时：connect / send / wait / receive / parse", ("upstream", "phase")))
+        self.upstream_in_flight = self._add(Gauge("ecom_upstream_in_flight", "正在进行的上游请求数", ("upstream",)))
+        self.upstream_cancelled = self._add(Counter("ecom_upstream_cancelled_total", "进行中被取消的上游请求数（客户端取消或断开、超过截止时间、对冲落败）", ("upstream",)))
+        self.upstream_saved_seconds = self._add(Counter("ecom_upstream_saved_seconds_total", "取消上游请求节省的预计上游耗时（秒）：近期中位耗时减去取消前已耗时", ("upstream",)))
+        self.upstream_errors = self._add(Counter("ecom_upstream_errors_total", "上游错误次数，按 DashScope 错误码或 HTTP 状态分类", ("upstream", "code")))
+        self.upstream_response_bytes = self._add(Histogram("ecom_upstream_response_bytes", "上游响应体大小", ("upstream",), SIZE_BUCKETS))
+        self.tokens = self._add(Counter("ecom_upstream_tokens_total", "上游 usage 字段报告的 token 用量", ("upstream", "model", "kind")))
+        self.tool_tokens = self._add(Counter("ecom_tool_tokens_total", "按工具统计的 token 用量：prompt / completion / cached（命中上下文缓存的输入）", ("tool", "kind")))
+        self.prompt_truncations = self._add(Counter("ecom_prompt_truncations_total", "输入字段去重、截断与输出触达 max_tokens 的次数", ("tool", "field", "action")))
+        self.loop_lag = self._add(Histogram("ecom_event_loop_lag_seconds", "事件循环调度延迟（定时器实际唤醒时间与预期之差）", (), LAG_BUCKETS))
+        self.memory = self._add(Gauge("process_resident_memory_bytes", "进程常驻内存"))
+        self.startup = self._add(Gauge("ecom_startup_seconds", "冷启动各阶段距进程启动的秒数：import / ready / tools / warmup / first_request / first_tool_call", ("phase",)))
+
+    def _add(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def record_usage(self, upstream: str, response_data: Any, model: Optional[str] = None) -> None:
+        """
+        从 Qwen 响应（含流式最后一个分片）的 usage 字段累计 token 用量。
+        """
+        if not isinstance(response_data, dict):
+            return
+        model = str(response_data.get("model") or model or "")
+        tracked = _call_usage.get()
+        if tracked is not None and model and model not in tracked["models"]:
+            tracked["models"].append(model)
+        usage = response_data.get("usage")
+        if not isinstance(usage, dict):
+            return
+        for kind in ("prompt_tokens", "completion_tokens", "input_tokens", "output_tokens"):
+            value = usage.get(kind)
+            if isinstance(value, (int, float)) and value:
+                self.tokens.inc(value, upstream=upstream, model=model, kind=kind)
+                if tracked is not None:
+                    key = "prompt_tokens" if kind in ("prompt_tokens", "input_tokens") else "completion_tokens"
+                    tracked[key] += int(value)
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if isinstance(cached, (int, float)) and cached:
+            self.tokens.inc(cached, upstream=upstream, model=model, kind="cached_tokens")
+
+    def render(self) -> str:
+        self.memory.set(_resident_memory())
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _resident_memory() -> float:
+    """
+    当前常驻内存；无 /proc 的平台退化为峰值常驻内存。
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return float(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # macOS 上 ru_maxrss 单位为字节，Linux 上为 KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return float(peak if os.uname().sysname == "Darwin" else peak * 1024)
+
+
+metrics = MetricsRegistry()
+
+
+# --- 3. 阶段 span ---
+def _tracer() -> Any:
+    global otel_trace, _otel_unavailable
+    if not settings.tracing_enabled or _otel_unavailable:
+        return None
+    if otel_trace is None:
+        try:
+            from opentelemetry import trace
+        except ImportError:  # pragma: no cover - 取决于部署环境
+            _otel_unavailable = True
+            return None
+        otel_trace = trace
+    return otel_trace.get_tracer("ecom-content-agent")
+
+
+@contextmanager
+def span(stage: str, **attributes: Any) -> Iterator[None]:
+    """
+    记录一个处理阶段的耗时到 ecom_stage_duration_seconds；
+    安装了 opentelemetry-api 且开启 TRACING_ENABLED 时同时创建同名 span。
+    """
+    tracer = _tracer()
+    start = time.perf_counter()
+    with tracer.start_as_current_span(stage, attributes=attributes) if tracer is not None else nullcontext():
+        try:
+            yield
+        finally:
+            metrics.stage_duration.observe(time.perf_counter() - start, stage=stage)
+
+
+class UpstreamPhaseTimer:
+    """
+    通过 httpx 的 trace 扩展拆分一次上游请求的耗时：
+    connect（等待连接池与建连）、send（发送请求）、wait（上游生成直至响应头）、
+    receive（读取响应体）、parse（JSON 解析，由调用方通过 mark 记录）。
+    """
+
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+        self._last = self._start = time.perf_counter()
+        self._phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self._phases[phase] = self._phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    async def trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event.endswith("send_request_headers.started"):
+            self.mark("connect")
+        elif event.endswith("receive_response_headers.started"):
+            self.mark("send")
+        elif event.endswith("receive_response_headers.complete"):
+            self.mark("wait")
+
+    @property
+    def extensions(self) -> Dict[str, Any]:
+        return {"trace": self.trace}
+
+    def finish(self, status: str, code: Optional[str] = None) -> None:
+        for phase, seconds in self._phases.items():
+            metrics.upstream_duration.observe(seconds, upstream=self.upstream, phase=phase)
+        metrics.upstream_requests.inc(upstream=self.upstream, status=status)
+        if code:
+            metrics.upstream_errors.inc(upstream=self.upstream, code=code)
+
+
+class EventLoopLagMonitor:
+    """
+    周期性休眠 interval 秒，把实际唤醒时间超出预期的部分记为事件循环延迟。
+    阻塞调用或 CPU 密集任务会直接体现为该指标升高。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            metrics.loop_lag.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+# --- 4. 中间件与导出端点 ---
+def _content_size(result: Any) -> int:
+    size = 0
+    for block in getattr(result, "content", None) or []:
+        text = getattr(block, "text", None)
+        if text:
+            size += len(text.encode("utf-8"))
+    return size
+
+
+class MetricsMiddleware(Middleware):
+    """
+    记录每次工具调用的耗时、并发数、参数与返回内容大小。
+    放在准入控制之前，耗时包含排队时间；排队本身另记为 admission_queue 阶段。
+    """
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        tool = context.message.name
+        arguments = context.message.arguments or {}
+        metrics.tool_request_bytes.observe(sum(len(str(v)) for v in arguments.values()), tool=tool)
+        metrics.tool_in_flight.inc(tool=tool)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await call_next(context)
+            status = "ok"
+            metrics.tool_response_bytes.observe(_content_size(result), tool=tool)
+            return result
+        except asyncio.CancelledError:
+            # 客户端取消或断开连接
+            status = "cancelled"
+            raise
+        finally:
+            metrics.tool_in_flight.dec(tool=tool)
+            metrics.tool_duration.observe(time.perf_counter() - start, tool=tool)
+            metrics.tool_calls.inc(tool=tool, status=status)
+
+
+def register_metrics_routes(mcp: FastMCP) -> None:
+    """
+    在 SSE / HTTP 传输旁挂载 GET /metrics，输出 Prometheus 文本格式。
+    """
+
+    @mcp.custom_route("/metrics", methods=["GET"])
+    async def metrics_endpoint(request: Request) -> PlainTextResponse:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,260 @@
+import re
+from typing import Annotated, Any, Dict, Generic, List, Optional, Type, TypeVar
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+from pydantic_core import from_json
+
+from .settings import settings
+from .http_client import DashScopeClient
+from .metrics import metrics
+from .prompts import complete_chat, system_message
+from .streaming import DeltaCallback, reset_stream
+
+
+class OutputFormatError(ValueError):
+    """
+    模型输出在本地修复后仍不是符合要求的 JSON 对象。
+    """
+
+    def __init__(self, message: str, text: str = ""):
+        super().__init__(message)
+        self.text = text
+
+
+# --- 1. 输出结构 ---
+def _as_list(value: Any) -> Any:
+    """
+    模型偶尔把列表字段写成一个字符串，按常见分隔符拆开；列表中的非字符串元素转为字符串。
+    """
+    if isinstance(value, str):
+        return [part.strip() for part in re.split(r"[\n；;、，,]+", value) if part.strip()]
+    if isinstance(value, list):
+        return [item if isinstance(item, str) else str(item) for item in value if item is not None]
+    return value
+
+
+class ContentPlan(BaseModel):
+    """
+    文案生成工具的输出结构，与 SYSTEM_PROMPT 中约定的字段一致；模型额外输出的字段原样保留。
+    """
+    model_config = ConfigDict(extra="allow")
+
+    copywriting: Annotated[str, Field(min_length=1)]
+    key_elements: List[str] = []
+    image_prompt: str = ""
+    score: Optional[float] = None
+
+    @field_validator("key_elements", mode="before")
+    @classmethod
+    def split_elements(cls, v: Any) -> Any:
+        return _as_list(v)
+
+    @field_validator("score", mode="before")
+    @classmethod
+    def parse_score(cls, v: Any) -> Any:
+        """
+        兼容 "8.5"、"8.5/10"、"8.5分" 等写法，无法识别时视为缺失。
+        """
+        if isinstance(v, str):
+            match = re.search(r"\d+(?:\.\d+)?", v)
+            return float(match.group()) if match else None
+        return v if isinstance(v, (int, float)) and not isinstance(v, bool) else None
+
+
+class LaunchGuide(BaseModel):
+    """
+    运营指导工具的输出结构，与 GUIDE_SYSTEM_PROMPT 中约定的字段一致；至少需包含其中一个字段。
+    """
+    model_config = ConfigDict(extra="allow")
+
+    timing_suggestion: str = ""
+    visual_assessment: str = ""
+    interaction_strategy: List[str] = []
+    compliance_risk: List[str] = []
+    launch_checklist: List[str] = []
+
+    @field_validator("interaction_strategy", "compliance_risk", "launch_checklist", mode="before")
+    @classmethod
+    def split_items(cls, v: Any) -> Any:
+        return _as_list(v)
+
+    @model_validator(mode="before")
+    @classmethod
+    def require_known_field(cls, data: Any) -> Any:
+        if isinstance(data, dict) and not any(name in data for name in cls.model_fields):
+            raise ValueError(f"缺少指导方案字段，需包含 {', '.join(cls.model_fields)} 中的至少一个")
+        return data
+
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class ParsedOutput(Generic[T]):
+    """
+    解析结果：value 为校验后的对象；text 为对应的 JSON 字符串——输出本身合法时就是模型原文，
+    不再重新序列化，只有经过修复时才由 value 序列化一次。
+    """
+
+    def __init__(self, value: T, text: str, outcome: str):
+        self.value = value
+        self.text = text
+        self.outcome = outcome
+
+
+# --- 2. 本地修复 ---
+_FENCE = re.compile(r"```[A-Za-z]*\s*(.*?)(?:```|$)", re.S)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+def _object_span(text: str, start: int) -> int:
+    """
+    返回从 start 处的 '{' 开始的顶层对象的结束位置（不含）；对象未闭合时返回 -1。
+    """
+    depth = 0
+    in_string = escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+    return -1
+
+
+def repair_json(text: str, allow_partial: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    修复模型输出中的常见缺陷并解析为字典：Markdown 代码块、对象前后的说明文字、末尾多余的逗号。
+    无法修复时返回 None。
+
+    对象未闭合（通常是因 max_tokens 截断）时默认视为无法修复：截断的字段与缺失的可选字段
+    仍能通过校验，不能作为成功结果返回或缓存。allow_partial=True 时按已输出的部分解析，
+    只用于展示生成中的预览。
+    """
+    fenced = _FENCE.search(text)
+    if fenced and "{" in fenced.group(1):
+        text = fenced.group(1)
+    start = text.find("{")
+    if start < 0:
+        return None
+    end = _object_span(text, start)
+    if end < 0 and not allow_partial:
+        return None
+    candidate = text[start:end] if end > 0 else text[start:]
+
+    for attempt in (candidate, _TRAILING_COMMA.sub(r"\1", candidate)):
+        try:
+            # 预览时按已输出的部分解析，截断的字符串保留已有内容
+            value = from_json(attempt, allow_partial="trailing-strings" if end < 0 else False)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+
+def _error_summary(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(str(p) for p in e['loc']) or '(root)'}: {e['msg']}" for e in error.errors()[:5])
+    return str(error)
+
+
+def parse_output(text: str, schema: Type[T], tool: str = "") -> ParsedOutput[T]:
+    """
+    解析并校验模型输出：先直接按 schema 解析（pydantic-core 的 JSON 解析器，解析与校验一次完成），
+    失败时在本地修复后再校验；仍失败时抛出 OutputFormatError。
+    """
+    try:
+        value = schema.model_validate_json(text)
+        metrics.output_parses.inc(tool=tool, outcome="valid")
+        return ParsedOutput(value, text, "valid")
+    except ValidationError as e:
+        error: Exception = e
+
+    repaired = repair_json(text)
+    if repaired is not None:
+        try:
+            value = schema.model_validate(repaired)
+            metrics.output_parses.inc(tool=tool, outcome="repaired")
+            return ParsedOutput(value, value.model_dump_json(), "repaired")
+        except ValidationError as e:
+            error = e
+    raise OutputFormatError(_error_summary(error), text)
+
+
+# --- 3. 调用与重问 ---
+REPAIR_PROMPT = "你是 JSON 修复助手。根据错误信息修正给出的内容，只输出一个符合字段要求的 JSON 对象，不要输出任何其他文字。"
+
+
+def _field_hint(schema: Type[BaseModel]) -> str:
+    return ", ".join(
+        f"{name}({'必填' if field.is_required() else '可选'})" for name, field in schema.model_fields.items()
+    )
+
+
+async def complete_structured(http: DashScopeClient, tool: str, payload: Dict[str, Any], schema: Type[T],
+                              timeout: float, default_max_tokens: int,
+                              on_delta: Optional[DeltaCallback] = None, reask: bool = True,
+                              usage: Optional[Dict[str, int]] = None) -> ParsedOutput[T]:
+    """
+    调用通义千问并将输出解析为 schema 对象。
+
+    输出因 max_tokens 截断而无法解析时，以加倍的 max_tokens（不超过 PROMPT_MAX_OUTPUT_TOKENS）重新生成一次；
+    其他本地无法修复的输出，用一条简短的修复提示（错误信息、字段要求与原输出）重问一次，
+    不重新发送商品信息与原始提示词；重问结果仍不合法时抛出 OutputFormatError。
+    reask 为 False 时不重问（如模型路由会改用更大的模型重新生成）；usage 用于累计各次调用的 token 用量。
+    """
+    finish: Dict[str, Any] = {}
+    text = await complete_chat(http, tool, payload, timeout, default_max_tokens, on_delta=on_delta,
+                               usage=usage, finish=finish)
+    try:
+        return parse_output(text, schema, tool)
+    except OutputFormatError as e:
+        if not settings.output_reask_enabled or not reask:
+            metrics.output_parses.inc(tool=tool, outcome="failed")
+            raise
+        error = e
+
+    larger = min(2 * finish.get("max_tokens", default_max_tokens), settings.prompt_max_output_tokens)
+    if finish.get("finish_reason") == "length" and larger > finish.get("max_tokens", larger):
+        # 截断的输出缺少内容，修复提示无法补全，按原始请求以更大的 max_tokens 重新生成
+        await reset_stream(on_delta, f"输出被截断，以 max_tokens={larger} 重新生成")
+        retry_text = await complete_chat(http, tool, payload, timeout, default_max_tokens, on_delta=on_delta,
+                                         usage=usage, max_tokens=larger)
+        try:
+            parsed = parse_output(retry_text, schema, tool)
+        except OutputFormatError as e:
+            metrics.output_parses.inc(tool=tool, outcome="failed")
+            raise OutputFormatError(f"{error}（输出被截断，以 max_tokens={larger} 重新生成后仍不合法：{e}）", text) from e
+        metrics.output_parses.inc(tool=tool, outcome="reasked")
+        parsed.outcome = "reasked"
+        return parsed
+
+    repair_payload = {
+        "model": payload.get("model", settings.qwen_model_name),
+        "messages": [
+            system_message(REPAIR_PROMPT),
+            {"role": "user", "content": f"错误：{error}\n字段要求：{_field_hint(schema)}\n待修正内容：\n{text[:settings.output_reask_max_chars]}"},
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0,
+    }
+    retry_text = await complete_chat(http, f"{tool}.repair", repair_payload, timeout, default_max_tokens, usage=usage)
+    try:
+        parsed = parse_output(retry_text, schema, f"{tool}.repair")
+    except OutputFormatError as e:
+        metrics.output_parses.inc(tool=tool, outcome="failed")
+        raise OutputFormatError(f"{error}（重问后仍不合法：{e}）", text) from e
+    metrics.output_parses.inc(tool=tool, outcome="reasked")
+    parsed.outcome = "reasked"
+    return parsed
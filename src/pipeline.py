@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+from typing import Annotated, Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+from .settings import settings
+from .http_client import DashScopeClient
+from .cache import ResponseCache
+from .generate_content import content_cache_key, request_content_plan
+from .generate_img import request_product_images
+from .generate_guide import request_launch_strategy
+from .metrics import span
+from .image_ingest import ImageIngestor
+
+# 导入 FastMCP 类型
+from fastmcp import Context, FastMCP
+
+
+# --- 1. 定义输出类型 ---
+class PipelineResult(BaseModel):
+    """
+    端到端流水线结果，返回包含文案、图片、各投放指导方案与阶段耗时的JSON字符串。
+    """
+    file_content: Annotated[str, Field(description="包含 content、images、copy_strategy、image_strategies、stage_latency_ms 与 errors 的JSON字符串")]
+    filename: Annotated[str, Field(description="生成结果文件名，例如: pipeline_result.json")]
+    mime_type: Annotated[str, Field(description="返回的文件MIME类型, 必须是 application/json")]
+
+
+# --- 2. 流水线执行 ---
+class _PipelineRun:
+    """
+    单次流水线执行的状态：记录各阶段结果与耗时，并在每个阶段完成时推送进度通知。
+    """
+
+    def __init__(self, ctx: Context):
+        self.ctx = ctx
+        self.started_at = time.perf_counter()
+        self.completed = 0
+        self.output: Dict[str, Any] = {
+            "content": None,
+            "images": [],
+            "copy_strategy": None,
+            "image_strategies": [],
+            "stage_latency_ms": {},
+            "errors": {},
+        }
+
+    async def stage(self, name: str, coro: Any) -> Any:
+        """
+        执行一个阶段并记录耗时；异常记录到 errors 后返回 None，不中断其余分支。
+        """
+        start = time.perf_counter()
+        try:
+            # image_strategy[0]、image_strategy[1] 归入同一个阶段统计
+            with span(f"pipeline.{name.split('[')[0]}"):
+                result = await coro
+            error = None
+        except Exception as e:
+            result, error = None, str(e)
+        latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        self.output["stage_latency_ms"][name] = latency_ms
+        if error:
+            self.output["errors"][name] = error
+
+        self.completed += 1
+        update = {"stage": name, "latency_ms": latency_ms, "error": error, "result": result}
+        await self.ctx.report_progress(progress=self.completed, message=json.dumps(update, ensure_ascii=False))
+        return result
+
+
+def _parse_json(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+async def run_pipeline(http: DashScopeClient, cache: ResponseCache, images: ImageIngestor, ctx: Context, product_name: str,
+                       product_features: str, target_platform: str, target_audience: str,
+                       product_image_url: Optional[str] = None) -> Dict[str, Any]:
+    """
+    以 DAG 方式执行 文案 -> (文案策略 || 图片 -> 每张图片的策略)。
+
+    文案一生成即并行启动文案策略分析与图片生成；每张图片返回后立即并行分析，互不等待。
+    图片生成需要原始商品图，未提供时跳过图片分支；原图只下载校验一次，两个分支共享结果。
+    """
+    run = _PipelineRun(ctx)
+
+    async def content_stage() -> Any:
+        key = content_cache_key(product_name, product_features, target_platform, target_audience, product_image_url)
+
+        async def compute() -> str:
+            image_url = await images.resolve(product_image_url)
+            return await request_content_plan(http, product_name, product_features, target_platform,
+                                              target_audience, image_url)
+
+        content_json, _ = await cache.get_or_compute(key, compute)
+        return _parse_json(content_json)
+
+    async def strategy_stage(image_url: Optional[str] = None) -> Any:
+        return _parse_json(await request_launch_strategy(http, copywriting, target_platform, image_url))
+
+    content = await run.stage("content", content_stage())
+    run.output["content"] = content
+    if not isinstance(content, dict):
+        run.output["stage_latency_ms"]["total"] = round((time.perf_counter() - run.started_at) * 1000, 1)
+        return run.output
+
+    copywriting = str(content.get("copywriting", ""))
+    image_prompt = content.get("image_prompt")
+
+    async def copy_branch() -> None:
+        run.output["copy_strategy"] = await run.stage("copy_strategy", strategy_stage())
+
+    async def image_branch() -> None:
+        if not product_image_url or not image_prompt:
+            return
+
+        async def images_stage() -> List[str]:
+            base_image = await images.resolve(product_image_url, min_side=settings.wanx_image_min_side)
+            return await request_product_images(http, base_image, str(image_prompt))
+
+        image_urls: Optional[List[str]] = await run.stage("images", images_stage())
+        run.output["images"] = image_urls or []
+        strategies = await asyncio.gather(*(
+            run.stage(f"image_strategy[{i}]", strategy_stage(url)) for i, url in enumerate(image_urls or [])
+        ))
+        run.output["image_strategies"] = [
+            {"image_url": url, "strategy": strategy} for url, strategy in zip(image_urls or [], strategies)
+        ]
+
+    await asyncio.gather(copy_branch(), image_branch())
+    run.output["stage_latency_ms"]["total"] = round((time.perf_counter() - run.started_at) * 1000, 1)
+    return run.output
+
+
+# --- 3. 工具注册函数：register_pipeline_tools ---
+def register_pipeline_tools(mcp: FastMCP, http: DashScopeClient, cache: ResponseCache, images: ImageIngestor) -> None:
+    """
+    注册端到端内容流水线工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "run_content_pipeline", "readOnlyHint": False}
+    )
+    async def run_content_pipeline(
+        product_name: Annotated[str, Field(description="商品名称，如：极光无线降噪耳机")],
+        product_features: Annotated[str, Field(description="核心卖点或特点描述，如：轻至20g，主动降噪45dB")],
+        target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝")],
+        target_audience: Annotated[str, Field(description="目标受众，如：都市白领, 学生党")],
+        ctx: Context,
+        product_image_url: Annotated[Optional[str], Field(description="可选：原始产品图片URL。提供时会基于文案的图像指令生成宣传图并逐张分析")] = None
+    ) -> PipelineResult:
+        """
+        一次调用完成 文案生成 -> 宣传图生成 -> 投放策略 全流程。各阶段尽早并行执行，每个阶段完成时通过进度通知推送部分结果，并返回各阶段耗时。
+        """
+        output = await run_pipeline(http, cache, images, ctx, product_name, product_features, target_platform,
+                                    target_audience, product_image_url)
+        return PipelineResult(
+            file_content=json.dumps(output, ensure_ascii=False, indent=2),
+            filename=f"{product_name}_pipeline_result.json",
+            mime_type="application/json"
+        )
@@ -0,0 +1,206 @@
+import math
+import re
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Union
+
+from .settings import settings
+from .http_client import DashScopeClient
+from .metrics import metrics
+from .streaming import DeltaCallback, stream_chat_content
+
+# 可选依赖：安装 dashscope SDK 后使用其本地 Qwen 分词器精确计数，否则按字符类别保守估算。
+# SDK 导入较慢，首次计数时才导入，不计入服务启动时间
+_tokenizer: Any = None
+_tokenizer_unavailable = False
+
+
+def _load_tokenizer() -> Any:
+    global _tokenizer, _tokenizer_unavailable
+    if _tokenizer is None and not _tokenizer_unavailable:
+        try:
+            from dashscope import get_tokenizer
+            _tokenizer = get_tokenizer("qwen-turbo")
+        except Exception:
+            # 未安装 SDK 或分词器文件缺失时退化为估算，不再重试
+            _tokenizer_unavailable = True
+    return _tokenizer
+
+
+# --- 1. 本地 token 计数 ---
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_WORD = re.compile(r"[A-Za-z0-9]+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    发送前估算文本的 token 数。
+
+    有 Qwen 分词器时精确计数；否则每个中文字符或全角标点按 1 个 token、
+    每个英文/数字词按 4 个字符 1 个 token、其余字符各 1 个 token 估算，略高于实际值，截断后不会超出预算。
+    """
+    tokenizer = _load_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    cjk = len(_CJK.findall(text))
+    words = _WORD.findall(text)
+    word_chars = sum(len(w) for w in words)
+    others = len(text) - cjk - word_chars - text.count(" ")
+    return cjk + sum(math.ceil(len(w) / 4) for w in words) + max(0, others)
+
+
+# --- 2. 输入裁剪 ---
+_SENTENCE_END = re.compile(r"(?<=[。！？!?；;\n])")
+TRUNCATION_MARK = "…（已截断）"
+
+
+def fit_text(text: str, max_tokens: int, tool: str, field: str) -> str:
+    """
+    将用户输入压缩到 max_tokens 以内：先折叠空白并去掉重复的句子（商品详情页复制来的文本常有重复段落），
+    仍然超出时按句子边界保留开头部分，最后一句放不下时按字符截断，并附加截断标记。
+    """
+    text = re.sub(r"[ \t\r\f\v]+", " ", (text or "").strip())
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    seen = set()
+    sentences: List[str] = []
+    for sentence in _SENTENCE_END.split(text):
+        key = sentence.strip()
+        if key and key not in seen:
+            seen.add(key)
+            sentences.append(sentence)
+    compacted = "".join(sentences).strip()
+    if estimate_tokens(compacted) <= max_tokens:
+        metrics.prompt_truncations.inc(tool=tool, field=field, action="deduplicated")
+        return compacted
+
+    budget = max_tokens - estimate_tokens(TRUNCATION_MARK)
+    kept: List[str] = []
+    used = 0
+    for sentence in sentences:
+        cost = estimate_tokens(sentence)
+        if used + cost > budget:
+            if not kept:
+                # 首句即超出预算时按字符二分，找到能放下的最长前缀
+                low, high = 0, len(sentence)
+                while low < high:
+                    mid = (low + high + 1) // 2
+                    if estimate_tokens(sentence[:mid]) <= budget:
+                        low = mid
+                    else:
+                        high = mid - 1
+                kept.append(sentence[:low])
+            break
+        kept.append(sentence)
+        used += cost
+    metrics.prompt_truncations.inc(tool=tool, field=field, action="truncated")
+    return "".join(kept).rstrip() + TRUNCATION_MARK
+
+
+# --- 3. 消息组织 ---
+def system_message(prompt: str) -> Dict[str, Any]:
+    """
+    构建系统消息。系统提示词放在消息列表最前面且逐字节不变，DashScope 可对这一公共前缀做上下文缓存；
+    开启 PROMPT_CACHE_CONTROL 时显式标记为可缓存（需所用模型支持显式缓存）。
+    """
+    content: Union[str, List[Dict[str, Any]]] = prompt
+    if settings.prompt_cache_control:
+        content = [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+    return {"role": "system", "content": content}
+
+
+# --- 4. 输出 token 预算 ---
+class OutputBudget:
+    """
+    按工具统计近期输出的 completion tokens，据此设置 max_tokens：取 p99 的 1.5 倍并留出余量，
+    限制在 [floor, ceiling] 之间；样本不足时使用各工具的默认值。
+
+    出现因 max_tokens 截断（finish_reason 为 length）的输出时，按本次上限的两倍记一个样本，
+    后续请求的上限随之提高。
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20, floor: int = 256):
+        self.window = window
+        self.min_samples = min_samples
+        self.floor = floor
+        self._samples: Dict[str, Deque[int]] = {}
+
+    def max_tokens(self, tool: str, default: int) -> int:
+        ceiling = settings.prompt_max_output_tokens
+        samples = self._samples.get(tool)
+        if not samples or len(samples) < self.min_samples:
+            return min(default, ceiling)
+        ordered = sorted(samples)
+        p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+        return max(self.floor, min(ceiling, int(p99 * 1.5) + 64))
+
+    def observe(self, tool: str, usage: Optional[Dict[str, Any]], finish_reason: Optional[str],
+                max_tokens: int, choices: int = 1) -> None:
+        """
+        记录一次调用的 token 用量；choices > 1（n 参数）时按候选数均分输出 token。
+        """
+        if not isinstance(usage, dict):
+            return
+        prompt_tokens = int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+        cached_tokens = int((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+        metrics.tool_tokens.inc(prompt_tokens, tool=tool, kind="prompt")
+        metrics.tool_tokens.inc(completion_tokens, tool=tool, kind="completion")
+        if cached_tokens:
+            metrics.tool_tokens.inc(cached_tokens, tool=tool, kind="cached")
+
+        samples = self._samples.setdefault(tool, deque(maxlen=self.window))
+        if finish_reason == "length":
+            metrics.prompt_truncations.inc(tool=tool, field="output", action="max_tokens")
+            samples.append(max_tokens * 2)
+        elif completion_tokens:
+            samples.append(math.ceil(completion_tokens / max(1, choices)))
+
+
+output_budget = OutputBudget()
+
+
+# --- 5. 调用 ---
+def add_usage(total: Optional[Dict[str, int]], usage: Any) -> None:
+    """
+    将一次调用的 prompt / completion tokens 累加到 total（total 为 None 时忽略）。
+    """
+    if total is None or not isinstance(usage, dict):
+        return
+    total["prompt_tokens"] = total.get("prompt_tokens", 0) + int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0)
+    total["completion_tokens"] = total.get("completion_tokens", 0) + int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+
+
+async def complete_chat(http: DashScopeClient, tool: str, payload: Dict[str, Any], timeout: float,
+                        default_max_tokens: int, on_delta: Optional[DeltaCallback] = None,
+                        usage: Optional[Dict[str, int]] = None, finish: Optional[Dict[str, Any]] = None,
+                        max_tokens: Optional[int] = None) -> str:
+    """
+    以工具的输出预算设置 max_tokens 后调用通义千问，返回模型输出的 content，并记录本次 token 用量。
+
+    提供 on_delta 时以流式方式调用，增量输出逐段交给 on_delta；提供 usage 时把本次 token 用量累加到其中；
+    提供 finish 时写入本次的 finish_reason 与 max_tokens。max_tokens 不为空时覆盖输出预算。
+    """
+    max_tokens = max_tokens or output_budget.max_tokens(tool, default_max_tokens)
+    payload = {**payload, "max_tokens": max_tokens}
+    url = settings.qwen_api_endpoint
+
+    if on_delta is not None:
+        final: Dict[str, Any] = {}
+        content = await stream_chat_content(http, url, payload, timeout, on_delta, final=final)
+        output_budget.observe(tool, final.get("usage"), final.get("finish_reason"), max_tokens)
+        add_usage(usage, final.get("usage"))
+        if finish is not None:
+            finish.update(finish_reason=final.get("finish_reason"), max_tokens=max_tokens)
+        return content
+
+    # 只对输出较短的请求对冲，并按工具分别统计延迟；长输出请求耗时差异大，对冲只会加倍费用与限流压力
+    hedge_key = tool if max_tokens <= settings.qwen_hedge_max_tokens else None
+    response_data = await http.post_json("qwen", url, payload, timeout=timeout, hedge_key=hedge_key)
+    # 提取路径：choices[0] -> message -> content
+    choice = (response_data.get("choices") or [{}])[0]
+    output_budget.observe(tool, response_data.get("usage"), choice.get("finish_reason"), max_tokens)
+    add_usage(usage, response_data.get("usage"))
+    if finish is not None:
+        finish.update(finish_reason=choice.get("finish_reason"), max_tokens=max_tokens)
+    return choice.get("message", {}).get("content", "{}")
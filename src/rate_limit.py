@@ -0,0 +1,141 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from .state import StateBackend, StateBackendError
+
+
+class AdaptiveTokenBucket:
+    """
+    自适应令牌桶：按当前速率补充令牌，速率随上游反馈按 AIMD 调整。
+
+    每次成功调用按 increase_step 线性提高速率（不超过 max_rate）；
+    遇到上游限流时按 decrease_factor 成倍降低速率（不低于 min_rate）并清空已积累的令牌。
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: float = 0.5,
+                 max_rate: Optional[float] = None, increase_step: float = 0.1, decrease_factor: float = 0.5):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        """
+        取得一个令牌；令牌不足时按当前速率等待。持锁等待保证先到先得。
+        """
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self) -> None:
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._tokens = 0.0
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD 自适应并发上限，用于按上游（qwen / wanx）隔离并发配额。
+
+    每次成功调用将上限提高 1/limit（约每轮满并发 +1），遇到限流时减半；
+    上限始终在 [min_limit, max_limit] 之间。超过上限的调用按到达顺序排队等待。
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int = 1, max_limit: Optional[int] = None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial_limit
+        self.in_flight = 0
+        self.throttled = 0
+        self._waiters: "deque[asyncio.Future[None]]" = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # 已被唤醒但调用方随即取消时归还名额
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self) -> None:
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def on_throttle(self) -> None:
+        self.throttled += 1
+        self.limit = max(float(self.min_limit), self.limit / 2)
+
+
+class SharedRateLimit:
+    """
+    多个 worker 进程共享的每秒请求上限：在共享状态后端按整秒窗口计数，超出时等待到下一个窗口。
+
+    每个进程的 AIMD 并发配额仍各自生效；该上限用于保证所有进程合计不超过账号的 QPS 配额。
+    共享状态后端不可用时直接放行，避免共享存储故障拖垮上游调用。
+    """
+
+    def __init__(self, state: StateBackend, name: str, rate: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.time()
+            window = int(now)
+            try:
+                count = await self.state.incr(f"rate:{self.name}:{window}", ttl_seconds=2.0)
+            except StateBackendError:
+                return
+            if count <= self.rate:
+                return
+            await asyncio.sleep(window + 1 - now)
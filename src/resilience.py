@@ -0,0 +1,240 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import httpx
+
+from .errors import UpstreamError
+
+
+T = TypeVar("T")
+
+# DashScope 可安全重试的服务端错误码（限流另由 UpstreamError.is_throttled 判断）
+RETRYABLE_CODES = {"InternalError", "InternalError.Algo", "ServiceUnavailable", "RequestTimeOut"}
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    上游熔断期间直接失败，不再发出请求。
+    """
+
+
+# --- 1. 错误分类与退避 ---
+def is_retryable(e: BaseException, retry_timeouts: bool = True) -> bool:
+    """
+    判断错误是否可以安全重试：限流、5xx、可重试错误码、连接类错误，以及（可选）读超时。
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+    if isinstance(e, UpstreamError):
+        status = e.status_code or 0
+        return e.is_throttled or status >= 500 or (e.code or "") in RETRYABLE_CODES
+    if isinstance(e, httpx.TimeoutException):
+        # 连接阶段超时说明请求尚未送达，总是可以重试
+        return retry_timeouts or isinstance(e, (httpx.ConnectTimeout, httpx.PoolTimeout))
+    return isinstance(e, httpx.TransportError)
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """
+    计入熔断统计的上游故障：5xx、超时与连接错误。4xx 与限流属于调用方或配额问题，不触发熔断。
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+    if isinstance(e, UpstreamError):
+        return (e.status_code or 0) >= 500 or (e.code or "") in RETRYABLE_CODES
+    return isinstance(e, httpx.TransportError)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    带完全抖动的指数退避：在 [0, min(cap, base * 2^attempt)] 内均匀取值。
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+# --- 2. 熔断器 ---
+class CircuitBreaker:
+    """
+    按上游统计连续故障的熔断器。
+
+    连续 failure_threshold 次故障后进入 open，在 reset_timeout 秒内直接失败；
+    之后进入 half_open，仅放行一个探测请求，成功则恢复 closed，失败则重新 open。
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("上游服务异常，熔断中，请稍后重试")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise CircuitOpenError("上游服务异常，正在探测恢复，请稍后重试")
+            self._probe_in_flight = True
+
+    def on_success(self) -> None:
+        self._failures = 0
+        self._probe_in_flight = False
+        self.state = "closed"
+
+    def on_failure(self) -> None:
+        self._probe_in_flight = False
+        self._failures += 1
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def on_neutral(self) -> None:
+        """
+        非上游故障（如 4xx、限流）结束调用时仅释放探测名额。
+        """
+        self._probe_in_flight = False
+
+
+# --- 3. 延迟统计 ---
+class LatencyTracker:
+    """
+    保留最近 window 次成功调用的耗时，用于估计 p95 作为对冲请求的触发延迟。
+    """
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- 4. 单个上游的弹性策略 ---
+class UpstreamResilience:
+    """
+    组合熔断、抖动指数退避重试与对冲请求的上游调用策略。
+
+    对冲仅用于延迟敏感且无副作用的 Qwen 短调用：调用方以 latency_key 标明请求类别（如工具名），
+    首个请求超过同类请求近期 p95 仍未返回时再发一个，取先成功者并取消另一个。
+    未标明类别的调用不对冲，避免耗时差异很大的请求（长指导、多候选）以短请求的 p95 触发对冲。
+    """
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float,
+                 breaker: CircuitBreaker, hedge: bool = False, hedge_min_samples: int = 20,
+                 retry_timeouts: bool = True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.retry_timeouts = retry_timeouts
+        # 全部成功调用的耗时，用于估计被取消请求节省的耗时；对冲按类别单独统计
+        self.latency = LatencyTracker()
+        self._class_latency: Dict[str, LatencyTracker] = {}
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self, latency_key: Optional[str]) -> Optional[float]:
+        if not self.hedge or latency_key is None:
+            return None
+        tracker = self._class_latency.get(latency_key)
+        if tracker is None or len(tracker) < self.hedge_min_samples:
+            return None
+        return tracker.percentile(0.95)
+
+    async def _timed(self, attempt: Callable[[], Awaitable[T]], latency_key: Optional[str]) -> T:
+        start = time.monotonic()
+        result = await attempt()
+        elapsed = time.monotonic() - start
+        self.latency.record(elapsed)
+        if latency_key is not None:
+            self._class_latency.setdefault(latency_key, LatencyTracker()).record(elapsed)
+        return result
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[T]], latency_key: Optional[str]) -> T:
+        delay = self.hedge_delay(latency_key)
+        if delay is None:
+            return await self._timed(attempt, latency_key)
+
+        first = asyncio.ensure_future(self._timed(attempt, latency_key))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(self._timed(attempt, latency_key)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+            # 两个请求都失败时抛出最先发出的那个错误
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def before_call(self) -> None:
+        self.breaker.before_call()
+
+    def record_outcome(self, error: Optional[BaseException]) -> None:
+        if error is None:
+            self.breaker.on_success()
+        elif is_upstream_failure(error):
+            self.breaker.on_failure()
+        else:
+            self.breaker.on_neutral()
+
+    async def backoff(self, attempt_index: int) -> None:
+        self.retries += 1
+        await asyncio.sleep(backoff_delay(attempt_index, self.base_delay, self.max_delay))
+
+    def should_retry(self, e: BaseException, attempt_index: int) -> bool:
+        return attempt_index + 1 < self.max_attempts and is_retryable(e, self.retry_timeouts)
+
+    async def call(self, attempt: Callable[[], Awaitable[T]], latency_key: Optional[str] = None) -> T:
+        """
+        执行一次受保护的上游调用；可重试错误按抖动指数退避重试，熔断期间直接抛出 CircuitOpenError。
+        latency_key 为可对冲请求的类别，为空时不对冲。
+        """
+        attempt_index = 0
+        while True:
+            self.before_call()
+            try:
+                result = await self._hedged(attempt, latency_key)
+            except Exception as e:
+                self.record_outcome(e)
+                if not self.should_retry(e, attempt_index):
+                    raise
+                await self.backoff(attempt_index)
+                attempt_index += 1
+                continue
+            except BaseException:
+                # 调用被取消时不计入熔断统计，只释放探测名额
+                self.breaker.on_neutral()
+                raise
+            self.record_outcome(None)
+            return result
@@ -0,0 +1,160 @@
+import json
+import time
+from typing import Annotated, Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, Field, ValidationError
+
+from .settings import Settings, settings
+from .http_client import DashScopeClient
+from .metrics import metrics
+from .prompts import estimate_tokens
+from .output import OutputFormatError, ParsedOutput, T, complete_structured
+from .streaming import DeltaCallback, MalformedStreamError, reset_stream
+
+
+# --- 1. 路由配置 ---
+class ModelRoute(BaseModel):
+    """
+    一条模型路由。MODEL_ROUTES 中按从快到慢、从便宜到贵的顺序排列，最后一条作为兜底。
+    """
+    name: Annotated[str, Field(description="路由名，用于指标标签，如 fast / large")]
+    model: Annotated[str, Field(description="通义千问模型名")]
+    max_input_tokens: Annotated[Optional[int], Field(description="用户消息估算 token 数的上限，超出时不走该路由；为空表示不限制")] = None
+    images: Annotated[bool, Field(description="是否接受带图片的请求（模型需支持多模态输入）")] = True
+    platforms: Annotated[Optional[List[str]], Field(description="只处理这些目标平台的请求；为空表示全部平台")] = None
+    input_price: Annotated[float, Field(description="每千输入 token 的价格，用于估算各路由的费用")] = 0.0
+    output_price: Annotated[float, Field(description="每千输出 token 的价格")] = 0.0
+
+    def accepts(self, input_tokens: int, has_image: bool, platform: Optional[str]) -> bool:
+        if self.max_input_tokens is not None and input_tokens > self.max_input_tokens:
+            return False
+        if has_image and not self.images:
+            return False
+        if self.platforms and (platform or "").strip() not in self.platforms:
+            return False
+        return True
+
+    def cost(self, usage: Dict[str, int]) -> float:
+        return (usage.get("prompt_tokens", 0) * self.input_price + usage.get("completion_tokens", 0) * self.output_price) / 1000
+
+
+def load_routes(config: Settings) -> List[ModelRoute]:
+    """
+    解析 MODEL_ROUTES（JSON 列表）；未配置时只有一条使用 QWEN_MODEL_NAME 的默认路由，行为与不分路由时一致。
+    """
+    if not config.model_routes:
+        return [ModelRoute(name="default", model=config.qwen_model_name)]
+    try:
+        routes = [ModelRoute.model_validate(item) for item in json.loads(config.model_routes)]
+    except (ValueError, TypeError, ValidationError) as e:
+        raise ValueError(f"MODEL_ROUTES 格式错误，应为路由对象的 JSON 列表: {e}") from e
+    if not routes:
+        raise ValueError("MODEL_ROUTES 至少需要包含一条路由")
+    return routes
+
+
+# --- 2. 路由选择 ---
+def _request_features(payload: Dict[str, Any]) -> Tuple[int, bool]:
+    """
+    从请求体的用户消息中统计文本 token 数（本地估算）与是否带图片；系统提示词各路由相同，不计入。
+    """
+    tokens = 0
+    has_image = False
+    for message in payload.get("messages") or []:
+        if message.get("role") == "system":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                has_image = True
+            elif part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text") or "")
+    return tokens, has_image
+
+
+class ModelRouter:
+    """
+    按输入规模、是否带图片与目标平台，在配置的通义千问模型之间选择路由：
+    取第一条能处理该请求的路由，之后能处理该请求的路由作为升级链。
+
+    非兜底路由的输出在本地修复后仍不符合结构要求（含流式输出提前中止），或自评分（score 字段）低于
+    ROUTING_MIN_SCORE 时，改用升级链中的下一条路由重新生成；兜底路由沿用原有的重问逻辑。
+    每条路由的耗时、估算费用与升级次数记入指标，用于调整路由配置。
+    """
+
+    def __init__(self, routes: List[ModelRoute], min_score: float):
+        self.routes = routes
+        self.min_score = min_score
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "ModelRouter":
+        return cls(load_routes(config), config.routing_min_score)
+
+    def signature(self) -> str:
+        """
+        参与缓存键计算：路由配置变化后旧缓存自动失效。只有默认路由时即为模型名，与不分路由时的缓存键相同。
+        """
+        if len(self.routes) == 1 and self.routes[0].name == "default":
+            return self.routes[0].model
+        return "|".join(f"{r.name}={r.model}" for r in self.routes)
+
+    def chain(self, payload: Dict[str, Any], platform: Optional[str] = None) -> List[ModelRoute]:
+        """
+        返回能处理该请求的路由（按配置顺序）；都不满足时只用兜底路由。
+        """
+        tokens, has_image = _request_features(payload)
+        eligible = [route for route in self.routes if route.accepts(tokens, has_image, platform)]
+        return eligible or [self.routes[-1]]
+
+    def select(self, payload: Dict[str, Any], platform: Optional[str] = None) -> ModelRoute:
+        return self.chain(payload, platform)[0]
+
+    def _record(self, tool: str, route: ModelRoute, outcome: str, started: float, usage: Dict[str, int]) -> None:
+        metrics.route_requests.inc(tool=tool, route=route.name, outcome=outcome)
+        metrics.route_duration.observe(time.perf_counter() - started, tool=tool, route=route.name)
+        cost = route.cost(usage)
+        if cost:
+            metrics.route_cost.inc(cost, tool=tool, route=route.name)
+
+    async def complete(self, http: DashScopeClient, tool: str, payload: Dict[str, Any], schema: Type[T],
+                       timeout: float, default_max_tokens: int, platform: Optional[str] = None,
+                       on_delta: Optional[DeltaCallback] = None) -> ParsedOutput[T]:
+        """
+        按路由调用 complete_structured。流式请求在每条路由上都推送部分输出；升级时先发送重置通知
+        （STREAM_RESET_PREFIX），客户端丢弃此前的部分输出，之后的增量来自新路由。
+        """
+        chain = self.chain(payload, platform)
+        for index, route in enumerate(chain):
+            last = index == len(chain) - 1
+            usage: Dict[str, int] = {}
+            started = time.perf_counter()
+            try:
+                parsed = await complete_structured(http, tool, {**payload, "model": route.model}, schema, timeout,
+                                                   default_max_tokens, on_delta=on_delta, reask=last, usage=usage)
+            except (OutputFormatError, MalformedStreamError):
+                if last:
+                    self._record(tool, route, "failed", started, usage)
+                    raise
+                self._record(tool, route, "escalated", started, usage)
+                metrics.route_escalations.inc(tool=tool, route=route.name, reason="schema")
+                await reset_stream(on_delta, f"{route.name} 路由输出格式不合法，改用 {chain[index + 1].name} 重新生成")
+                continue
+            except BaseException:
+                self._record(tool, route, "failed", started, usage)
+                raise
+
+            score = getattr(parsed.value, "score", None)
+            if not last and score is not None and score < self.min_score:
+                self._record(tool, route, "escalated", started, usage)
+                metrics.route_escalations.inc(tool=tool, route=route.name, reason="score")
+                await reset_stream(on_delta, f"{route.name} 路由自评分 {score:g} 低于 {self.min_score:g}，改用 {chain[index + 1].name} 重新生成")
+                continue
+            self._record(tool, route, "accepted", started, usage)
+            return parsed
+        raise RuntimeError("模型路由链为空")
+
+
+model_router = ModelRouter.from_settings(settings)
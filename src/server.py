@@ -1,42 +1,182 @@
-from typing import cast
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, cast
+
+import anyio
 from fastmcp import FastMCP
 from fastmcp.server.middleware.error_handling import ErrorHandlingMiddleware
 from fastmcp.server.middleware.logging import LoggingMiddleware
-from fastmcp.server.middleware.rate_limiting import RateLimitingMiddleware
 from fastmcp.server.middleware.timing import TimingMiddleware
 from fastmcp.utilities import logging
 from fastmcp.utilities.logging import configure_logging
 from fastmcp.settings import LOG_LEVEL
+from starlette.applications import Starlette
 
 
 from .settings import settings
-from .generate_content import register_content_tools
-from .generate_img import register_image_tools
-from .generate_guide import register_guide_tools
+from .state import create_state_backend
+from .serving import DrainMiddleware, drain
+from .http_client import DashScopeClient
+from .cache import ResponseCache, register_cache_tools
+from .image_ingest import ImageIngestor
+from .image_store import GeneratedImageStore, register_image_store_routes
+from .metrics import EventLoopLagMonitor, MetricsMiddleware, register_metrics_routes
+from .admission import AdmissionMiddleware, create_admission_controller, register_admission_tools
+from .deadline import DeadlineMiddleware
+from .startup import LazyTools, StartupMiddleware, startup_timer, warm_up
+# 各工具模块在 create_mcp_server 注册工具时才导入，懒启动模式下推迟到首个请求或后台预热；
+# 生成历史与近似重复索引默认关闭，只在开启时导入
 
 logger = logging.get_logger(__name__)
 
+# register_tools 中导入的工具模块，预热时在线程中预先导入
+TOOL_MODULES = tuple(f"{__package__}.{name}" for name in (
+    "generate_content", "variants", "generate_img", "jobs", "generate_guide", "compliance", "batch", "pipeline",
+))
+
 
 def get_server_name_with_version() -> str:
     return "ecom-content-agent-server"
 def create_mcp_server() -> FastMCP:
     
     configure_logging(level=cast(LOG_LEVEL, settings.log_level))
+
+    # 所有工具共享同一个异步连接池客户端，随服务生命周期关闭
+    # 缓存、跨进程限流与任务租约通过共享状态后端在多个 worker 之间共享，未配置时只在进程内
+    state = create_state_backend(settings)
+    http = DashScopeClient(settings, state)
+    cache = ResponseCache(
+        max_entries=settings.content_cache_max_entries,
+        ttl_seconds=settings.content_cache_ttl_seconds,
+        disk_path=settings.content_cache_disk_path,
+        disk_max_entries=settings.content_cache_disk_max_entries,
+        shared=state if state.shared else None,
+        lock_seconds=settings.content_cache_lock_seconds,
+    )
+    # 近似重复索引：每个 worker 启动后从共享的 SQLite 文件加载，新条目写回同一文件
+    similar = None
+    if settings.semantic_cache_enabled:
+        from .similarity import SimilarityIndex
+        similar = SimilarityIndex(
+            path=settings.semantic_cache_path,
+            max_entries=settings.semantic_cache_max_entries,
+            ttl_seconds=settings.content_cache_ttl_seconds,
+        )
+    admission = create_admission_controller(settings)
+    images = ImageIngestor(settings)
+    store = GeneratedImageStore(settings)
+    jobs: List[Any] = []
+    loop_lag = EventLoopLagMonitor(settings.event_loop_lag_interval)
+    # 生成历史：记录在内存中排队，后台批量写入 SQLite，不阻塞工具调用
+    history = None
+    if settings.history_enabled:
+        from .history import GenerationHistory, HistoryMiddleware, register_history_tools
+        history = GenerationHistory(settings)
+
+    @asynccontextmanager
+    async def lifespan(server: FastMCP) -> AsyncIterator[None]:
+        loop_lag.start()
+        startup_timer.mark("ready")
+        warmup: Optional[asyncio.Task] = None
+        if settings.server_warmup_enabled:
+            # 预热在后台进行，不推迟开始接受请求的时间
+            warmup = asyncio.create_task(warm_up(settings, http, tools, similar, store))
+        try:
+            yield
+        finally:
+            # 内存客户端断开时 lifespan 会在已取消的作用域中退出，屏蔽取消以保证连接与后台任务被释放
+            with anyio.CancelScope(shield=True):
+                if warmup is not None and not warmup.done():
+                    warmup.cancel()
+                await loop_lag.stop()
+                for manager in jobs:
+                    await manager.aclose()
+                await http.aclose()
+                await images.aclose()
+                await store.aclose()
+                await state.aclose()
+                if history is not None:
+                    await history.aclose()
+            cache.close()
+            if similar is not None:
+                similar.close()
+
     mcp_server = FastMCP(name=get_server_name_with_version(),
-                         instructions="专为电商和社交媒体设计的AI内容策略与生成工具。可以根据商品信息，一键生成高转化文案、宣传图片URL以及专业的投放指导方案。"
+                         instructions="专为电商和社交媒体设计的AI内容策略与生成工具。可以根据商品信息，一键生成高转化文案、宣传图片URL以及专业的投放指导方案。",
+                         lifespan=lifespan,
                          )
     
 
+    def register_tools() -> None:
+        from .generate_content import register_content_tools
+        from .variants import register_variant_tools
+        from .generate_img import register_image_tools
+        from .jobs import ImageJobManager, register_job_tools
+        from .generate_guide import register_guide_tools
+        from .compliance import register_compliance_tools
+        from .batch import register_batch_tools
+        from .pipeline import register_pipeline_tools
+
+        job_manager = ImageJobManager(http, images, settings)
+        jobs.append(job_manager)
+
+        register_content_tools(mcp_server, http, cache, images, similar)
+        register_variant_tools(mcp_server, http, cache, images)
+        register_image_tools(mcp_server, http, images, store)
+        register_job_tools(mcp_server, job_manager)
+        register_guide_tools(mcp_server, http, images, similar)
+        register_compliance_tools(mcp_server)
+        register_batch_tools(mcp_server, http, cache)
+        register_pipeline_tools(mcp_server, http, cache, images)
+
+    tools = LazyTools(register_tools, TOOL_MODULES)
+
     # Add middleware in logical order
+    # 懒启动时首个请求在此触发工具注册；同时记录首个请求的完成时间
+    mcp_server.add_middleware(StartupMiddleware(tools))
     mcp_server.add_middleware(ErrorHandlingMiddleware(logger=logger))
-    mcp_server.add_middleware(RateLimitingMiddleware(max_requests_per_second=10))
+    # 统计进行中的调用，进程退出时先排空再关闭连接
+    mcp_server.add_middleware(DrainMiddleware(drain))
+    # 工具级耗时、并发与负载大小指标，放在准入控制之前以包含排队时间
+    mcp_server.add_middleware(MetricsMiddleware())
+    # 截止时间包含准入排队，并传递到各上游请求的超时
+    mcp_server.add_middleware(DeadlineMiddleware(settings))
+    if history is not None:
+        # 放在准入控制之前：复用历史结果时不占用排队名额
+        mcp_server.add_middleware(HistoryMiddleware(history))
+    # 按工具成本与客户端公平排队，替代原先不区分工具的全局 10 请求/秒限流
+    mcp_server.add_middleware(AdmissionMiddleware(admission))
     mcp_server.add_middleware(TimingMiddleware())
     mcp_server.add_middleware(LoggingMiddleware())
     
     # Register all tools
-    register_content_tools(mcp_server)
-    register_image_tools(mcp_server)
-    register_guide_tools(mcp_server)
+    if not settings.server_lazy_startup:
+        tools.load()
+    register_cache_tools(mcp_server, cache)
+    register_admission_tools(mcp_server, admission, http)
+    if history is not None:
+        register_history_tools(mcp_server, history)
+
+    # Prometheus 指标端点，与 SSE 传输共用同一个端口
+    register_metrics_routes(mcp_server)
+    # 保存到本地的生成图片，与 MCP 传输共用同一端口
+    register_image_store_routes(mcp_server, store)
 
     
-    return mcp_server
\ No newline at end of file
+    return mcp_server
+
+
+def create_app() -> Starlette:
+    """
+    uvicorn 应用工厂（见 src/serving.py）：每个 worker 进程各自创建服务实例、连接池与后台任务。
+    """
+    mcp_server = create_mcp_server()
+    drain.install(settings.shutdown_drain_seconds)
+    if settings.server_transport == "sse":
+        return mcp_server.http_app(transport="sse")
+    # 多 worker 时同一客户端的请求可能落到任一进程，使用无状态的 Streamable HTTP
+    return mcp_server.http_app(transport="http", stateless_http=settings.server_workers > 1)
+
+
+# 服务模块及其依赖（含 FastMCP）导入完成
+startup_timer.mark("import")
@@ -0,0 +1,118 @@
+import asyncio
+import signal
+import threading
+import time
+from typing import Any, Optional
+
+import uvicorn
+from mcp import McpError
+from mcp.types import ErrorData
+from sse_starlette.sse import AppStatus
+
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.utilities import logging
+
+from .settings import Settings
+
+logger = logging.get_logger(__name__)
+
+
+# --- 1. 优雅退出 ---
+class DrainController:
+    """
+    单个 worker 进程的优雅退出状态。
+
+    收到 SIGTERM / SIGINT 后立即拒绝新的工具调用，等待进行中的调用完成（最多 timeout 秒），
+    再通知 sse-starlette 关闭 SSE 长连接；连接全部关闭后 uvicorn 才执行 lifespan 清理，
+    因此已开始的生成结果仍能推送给客户端。
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def install(self, timeout: float) -> None:
+        """
+        在 uvicorn 已注册的信号处理函数之前插入排空逻辑；需在 worker 进程的事件循环内调用（应用工厂中）。
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # 默认情况下 sse-starlette 收到信号即关闭所有 SSE 流，改为排空后由本控制器关闭
+        AppStatus.disable_automatic_graceful_drain()
+
+        def begin() -> None:
+            self._task = loop.create_task(self._drain(timeout))
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            previous = signal.getsignal(sig)
+
+            def handler(signum: int, frame: Any, previous: Any = previous) -> None:
+                if not self.draining:
+                    self.draining = True
+                    loop.call_soon_threadsafe(begin)
+                if callable(previous):
+                    previous(signum, frame)
+
+            signal.signal(sig, handler)
+
+    async def _drain(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        if self.in_flight:
+            logger.info(f"Draining {self.in_flight} in-flight tool call(s) before closing streams")
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight:
+            logger.warning(f"Drain timeout exceeded, closing streams with {self.in_flight} tool call(s) still running")
+        AppStatus.should_exit = True
+
+
+drain = DrainController()
+
+
+class DrainMiddleware(Middleware):
+    """
+    统计进行中的工具调用；进程退出排空期间拒绝新的调用，客户端重连后由其他 worker 处理。
+    """
+
+    def __init__(self, controller: DrainController):
+        self.controller = controller
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        if self.controller.draining:
+            raise McpError(ErrorData(code=-32000, message="服务正在重启，请重新连接后重试"))
+        self.controller.in_flight += 1
+        try:
+            return await call_next(context)
+        finally:
+            self.controller.in_flight -= 1
+
+
+# --- 2. 启动入口 ---
+def run_server(config: Settings) -> None:
+    """
+    以 uvicorn 运行 src.server:create_app；server_workers > 1 时由 uvicorn 启动多个 worker 进程共享同一端口。
+
+    SSE 会话保存在建立连接的进程内，后续 POST 消息必须回到同一进程，
+    因此多 worker 只支持无状态的 Streamable HTTP；SSE 需多实例部署在会话保持的反向代理之后。
+    """
+    if config.server_workers > 1 and config.server_transport == "sse":
+        raise ValueError("SSE 传输不支持多 worker：请设置 SERVER_TRANSPORT=http，或按 README 部署多个实例并在反向代理上开启会话保持")
+    if config.server_workers > 1 and not config.state_backend_url:
+        logger.warning("Running multiple workers without STATE_BACKEND_URL: cache, rate limits and job leases are per process")
+
+    uvicorn.run(
+        "src.server:create_app",
+        factory=True,
+        host=config.server_host,
+        port=config.server_port,
+        workers=config.server_workers,
+        lifespan="on",
+        log_level=config.log_level.lower(),
+        # 排空阶段由 DrainController 控制，这里只作为最后的兜底
+        timeout_graceful_shutdown=int(config.shutdown_drain_seconds) + 5,
+    )
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import Field, field_validator, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -17,6 +18,22 @@ class Settings(BaseSettings):
         if v not in allowed_levels:
             raise ValueError(f"log level must be one of {allowed_levels}")
         return v
+
+    server_host: str = Field(default="0.0.0.0", description="SSE 服务监听地址")
+    server_port: int = Field(default=8080, description="SSE 服务监听端口")
+    server_transport: str = Field(default="sse", description="传输协议：sse（会话绑定单进程）或 http（Streamable HTTP，多 worker 时无状态）")
+    server_workers: int = Field(default=1, description="worker 进程数，大于 1 时需使用 http 传输")
+
+    @field_validator("server_transport")
+    @classmethod
+    def available_transport(cls, v: str) -> str:
+        """
+        server_transport字段的校验器，检查是否为支持的传输协议
+        """
+        v = v.lower()
+        if v not in ("sse", "http"):
+            raise ValueError("server transport must be 'sse' or 'http'")
+        return v
     
 
 # ----------------------------------------
@@ -55,7 +72,212 @@ class Settings(BaseSettings):
     )
 
     # ----------------------------------------
-    # III. Pydantic 配置 
+    # III. 上游 HTTP 连接池配置
+    # ----------------------------------------
+
+    http2_enabled: bool = Field(default=True, description="在上游支持时协商 HTTP/2")
+    http_keepalive_expiry: float = Field(default=30.0, description="空闲 keep-alive 连接的保留秒数")
+    http_connect_timeout: float = Field(default=10.0, description="建立上游连接的超时秒数")
+    qwen_max_connections: int = Field(default=20, description="通义千问端点的最大并发连接数")
+    wanx_max_connections: int = Field(default=10, description="通义万相端点的最大并发连接数")
+    qwen_max_concurrency: int = Field(default=10, description="通义千问的初始并发配额，遇限流按 AIMD 自动收缩与恢复")
+    wanx_max_concurrency: int = Field(default=2, description="通义万相的初始并发配额，遇限流按 AIMD 自动收缩与恢复")
+    stream_progress_interval: float = Field(default=0.1, description="流式模式下合并推送部分输出的最小间隔（秒）")
+
+    # ----------------------------------------
+    # IV. 文案响应缓存配置
+    # ----------------------------------------
+
+    content_cache_max_entries: int = Field(default=512, description="内存 LRU 层最多保留的条目数")
+    content_cache_ttl_seconds: float = Field(default=86400.0, description="缓存条目的有效期（秒）")
+    content_cache_disk_path: Optional[str] = Field(default=None, description="可选：SQLite 磁盘层文件路径，为空时仅使用内存层")
+    content_cache_disk_max_entries: int = Field(default=10000, description="磁盘层最多保留的条目数")
+    content_cache_lock_seconds: float = Field(default=60.0, description="多 worker 共享缓存时，同一键只由一个进程计算，其他进程最多等待该秒数")
+
+    # ----------------------------------------
+    # V. 批量生成配置
+    # ----------------------------------------
+
+    batch_max_concurrency: int = Field(default=8, description="批量生成时的最大并发上游请求数")
+    batch_rate_per_second: float = Field(default=5.0, description="批量生成的初始每秒请求数，遇限流时自动下调")
+    batch_checkpoint_dir: str = Field(default="./batch_checkpoints", description="批量工具断点文件目录")
+    batch_input_dir: Optional[str] = Field(default=None, description="批量工具 products_file 参数可读取的商品文件目录；为空时不允许按文件输入")
+
+    # ----------------------------------------
+    # VI. 准入控制配置
+    # ----------------------------------------
+
+    admission_capacity: float = Field(default=20.0, description="同时执行的工具调用总成本上限（一次文案生成为 1，一次图像编辑为 6）")
+    admission_max_queued_cost: float = Field(default=200.0, description="排队中的请求总成本上限，超出后立即拒绝")
+    admission_max_wait_seconds: float = Field(default=120.0, description="预计排队时间超过该值时立即拒绝")
+
+    # ----------------------------------------
+    # VII. 上游重试与熔断配置
+    # ----------------------------------------
+
+    retry_max_attempts: int = Field(default=3, description="单次上游调用的最大尝试次数（含首次）")
+    retry_base_delay: float = Field(default=0.5, description="重试退避的基础秒数，按指数增长并完全抖动")
+    retry_max_delay: float = Field(default=8.0, description="单次重试退避的最大秒数")
+    breaker_failure_threshold: int = Field(default=5, description="连续多少次上游故障后熔断")
+    breaker_reset_timeout: float = Field(default=30.0, description="熔断后多少秒放行一个探测请求")
+    qwen_hedge_enabled: bool = Field(default=False, description="通义千问短请求超过同一工具近期 p95 延迟仍未返回时发出对冲请求（会增加上游调用量）")
+    qwen_hedge_max_tokens: int = Field(default=1000, description="只对 max_tokens 不超过该值的通义千问请求对冲")
+    hedge_min_samples: int = Field(default=20, description="启用对冲前至少需要的成功调用样本数")
+
+    # ----------------------------------------
+    # VIII. 可观测性配置
+    # ----------------------------------------
+
+    tracing_enabled: bool = Field(default=False, description="安装 opentelemetry-api 后为各处理阶段创建 span；指标端点 /metrics 始终开启")
+    event_loop_lag_interval: float = Field(default=0.5, description="事件循环延迟的采样间隔（秒）")
+
+    # ----------------------------------------
+    # IX. 输入图片预取配置
+    # ----------------------------------------
+
+    image_ingest_enabled: bool = Field(default=False, description="调用上游前先由本服务下载并校验输入图片，坏链接与超限图片快速失败；关闭时由 DashScope 直接读取图片地址")
+    image_cache_dir: str = Field(default="./image_cache", description="输入图片磁盘缓存目录（按 URL 与内容哈希索引）")
+    image_cache_ttl_seconds: float = Field(default=86400.0, description="URL 到图片内容映射的有效期（秒）；超过该时间未使用的缓存文件会被删除")
+    image_cache_max_bytes: int = Field(default=1024 * 1024 * 1024, description="输入图片磁盘缓存的总字节数上限，超出时删除最久未使用的图片")
+    image_cache_memory_entries: int = Field(default=1024, description="内存中保留的图片元数据条目数")
+    image_fetch_timeout: float = Field(default=10.0, description="下载单张输入图片的超时秒数")
+    image_fetch_max_connections: int = Field(default=20, description="下载输入图片的最大并发连接数")
+    image_fetch_allow_private: bool = Field(default=False, description="是否允许下载指向回环、私有或链路本地地址的图片（含重定向目标），仅用于本地测试")
+    image_download_max_bytes: int = Field(default=30 * 1024 * 1024, description="允许下载的原图最大字节数")
+    image_max_bytes: int = Field(default=10 * 1024 * 1024, description="上送给 DashScope 的图片最大字节数")
+    image_target_bytes: int = Field(default=3 * 1024 * 1024, description="超过该大小的图片会被重新压缩（需安装 Pillow）")
+    image_max_side: int = Field(default=2048, description="最长边超过该像素数的图片会被缩放（需安装 Pillow）")
+    image_min_side: int = Field(default=10, description="多模态理解接口要求的最短边像素数")
+    wanx_image_min_side: int = Field(default=384, description="图像编辑接口要求的最短边像素数")
+    image_inline_max_bytes: int = Field(default=512 * 1024, description="不超过该大小的图片以 base64 上送，省去上游再次下载")
+
+    # ----------------------------------------
+    # X. 异步图像任务配置
+    # ----------------------------------------
+
+    image_job_store_path: str = Field(default="./image_jobs.db", description="异步图像任务的 SQLite 存储路径")
+    image_job_workers: int = Field(default=2, description="后台执行图像任务的 worker 数")
+    image_job_ttl_seconds: float = Field(default=7 * 86400.0, description="任务结果保留时间（秒），期间相同输入复用已有任务")
+    image_job_timeout: float = Field(default=600.0, description="单个异步任务的最长轮询时间（秒）")
+    image_job_poll_interval: float = Field(default=2.0, description="首次轮询间隔（秒），之后逐步拉长")
+    image_job_poll_max_interval: float = Field(default=10.0, description="最大轮询间隔（秒）")
+    wanx_async_enabled: bool = Field(default=False, description="使用 DashScope 异步任务模式（X-DashScope-Async）提交图像任务，需所用模型支持")
+    dashscope_task_endpoint: str = Field(default="https://dashscope.aliyuncs.com/api/v1/tasks", description="DashScope 异步任务查询端点")
+
+    # ----------------------------------------
+    # XI. 多进程部署与共享状态配置
+    # ----------------------------------------
+
+    state_backend_url: Optional[str] = Field(default=None, description="可选：共享状态后端，如 redis://127.0.0.1:6379/0；为空时状态只在进程内")
+    state_key_prefix: str = Field(default="ecom:", description="共享状态后端中所有键的前缀")
+    state_timeout: float = Field(default=2.0, description="单条共享状态命令的超时秒数，超时后降级为进程内行为")
+    state_max_connections: int = Field(default=20, description="每个进程到共享状态后端的最大连接数")
+    qwen_global_rps: float = Field(default=0.0, description="所有 worker 合计的通义千问每秒请求上限（需共享状态后端），0 表示不限制")
+    wanx_global_rps: float = Field(default=0.0, description="所有 worker 合计的通义万相每秒请求上限（需共享状态后端），0 表示不限制")
+    shutdown_drain_seconds: float = Field(default=30.0, description="收到退出信号后等待进行中的工具调用完成的最长秒数")
+
+    # ----------------------------------------
+    # XII. 多变体文案生成配置
+    # ----------------------------------------
+
+    variants_max_candidates: int = Field(default=8, description="多变体模式单次最多生成的候选数")
+    variants_temperature: float = Field(default=0.95, description="多变体模式的采样温度，高于单次生成以增加候选差异")
+    variants_similarity_threshold: float = Field(default=0.8, description="两条文案字符三元组相似度达到该值视为重复，只保留评分更高的一条")
+    variants_n_unsupported_ttl: float = Field(default=3600.0, description="模型被判定不支持 n 参数后，改为并发多次请求的持续时间（秒），之后重新尝试 n")
+
+    # ----------------------------------------
+    # XIII. 提示词与 token 预算配置
+    # ----------------------------------------
+
+    prompt_cache_control: bool = Field(default=False, description="为系统提示词添加显式缓存标记（cache_control），需所用模型支持显式上下文缓存")
+    prompt_max_output_tokens: int = Field(default=2048, description="单次调用 max_tokens 的上限，按工具近期输出长度自适应时不超过该值")
+    prompt_features_max_tokens: int = Field(default=400, description="商品卖点等长文本字段送入模型前的 token 上限，超出时去重并按句截断")
+    prompt_copywriting_max_tokens: int = Field(default=800, description="运营指导中已生成文案字段的 token 上限")
+    prompt_short_field_max_tokens: int = Field(default=64, description="商品名称、平台、受众等短字段的 token 上限")
+    content_default_max_tokens: int = Field(default=800, description="文案生成在样本不足时使用的 max_tokens")
+    guide_default_max_tokens: int = Field(default=1200, description="运营指导在样本不足时使用的 max_tokens")
+
+    # ----------------------------------------
+    # XIV. 合规预检配置
+    # ----------------------------------------
+
+    compliance_prescreen_enabled: bool = Field(default=True, description="运营指导返回前以本地规则扫描文案，命中结果并入 compliance_risk")
+    compliance_rules_path: Optional[str] = Field(default=None, description="可选：附加违禁词表 JSON 文件，格式为 {\"通用\" 或平台名: [[词, 类别, high|medium], ...]}")
+
+    # ----------------------------------------
+    # XV. 模型输出解析配置
+    # ----------------------------------------
+
+    output_reask_enabled: bool = Field(default=True, description="输出在本地无法修复时，以简短的修复提示重问模型一次")
+    output_reask_max_chars: int = Field(default=4000, description="重问时附带的原始输出最大字符数")
+
+    # ----------------------------------------
+    # XVI. 近似重复缓存配置
+    # ----------------------------------------
+
+    semantic_cache_enabled: bool = Field(default=False, description="对文案与运营指导请求启用近似重复检索，索引写入 SEMANTIC_CACHE_PATH（有效期沿用 CONTENT_CACHE_TTL_SECONDS）")
+    semantic_cache_path: Optional[str] = Field(default="./semantic_index.db", description="近似重复索引的 SQLite 文件路径；为空时仅保存在内存中")
+    semantic_cache_max_entries: int = Field(default=5000, description="每个进程内存中保留的索引条目上限，超出后淘汰最久未用的条目")
+    semantic_hit_threshold: float = Field(default=0.95, description="输入相似度不低于该值时直接复用历史结果")
+    semantic_warm_threshold: float = Field(default=0.7, description="文案工具：相似度不低于该值时以历史文案作为参考重新生成；<=0 时关闭")
+
+    # ----------------------------------------
+    # XVII. 启动配置
+    # ----------------------------------------
+
+    server_lazy_startup: bool = Field(default=False, description="懒启动：工具模块在首个 MCP 请求（或后台预热）时才导入并注册，缩短开始监听端口的时间")
+    server_warmup_enabled: bool = Field(default=False, description="开始接受请求后在后台预先建立到 DashScope 的连接并完成本地初始化")
+    server_warmup_connections: int = Field(default=2, description="预热时每个上游预先建立的连接数（HTTP/2 下通常复用同一连接）")
+
+    # ----------------------------------------
+    # XVIII. 生成图片存储配置
+    # ----------------------------------------
+
+    image_store_enabled: bool = Field(default=False, description="图像工具默认下载生成结果并保存到本地，返回稳定地址、尺寸与哈希（可按调用覆盖）")
+    image_store_dir: str = Field(default="./image_store", description="生成图片的内容寻址存储目录，多个 worker 可共用")
+    image_store_base_url: Optional[str] = Field(default=None, description="图片访问地址前缀，如 https://cdn.example.com；为空时按请求的 Host 推断")
+    image_store_fetch_timeout: float = Field(default=30.0, description="下载单张生成图片的超时秒数")
+    image_store_max_bytes: int = Field(default=30 * 1024 * 1024, description="允许下载的生成图片最大字节数")
+    image_store_thumbnail_side: int = Field(default=320, description="缩略图最长边像素数（需安装 Pillow）")
+    image_store_webp_quality: int = Field(default=80, description="WebP 版本与缩略图的编码质量")
+    image_store_process_workers: int = Field(default=2, description="生成 WebP 与缩略图的进程池大小")
+
+    # ----------------------------------------
+    # XIX. 多图并发生成配置
+    # ----------------------------------------
+
+    wanx_images_per_call: int = Field(default=2, description="单次通义万相调用生成的图片数（请求体中的 n），更多图片拆分为多次并发调用")
+    image_fanout_max_images: int = Field(default=12, description="单次 generate_product_image 最多生成的图片总数（图片数 × 变体数）")
+    image_request_deadline: float = Field(default=120.0, description="单次多图生成请求的截止时间（秒），到期仍未完成的调用被取消并逐项报错")
+
+    # ----------------------------------------
+    # XX. 请求截止时间配置
+    # ----------------------------------------
+
+    request_deadline_seconds: float = Field(default=300.0, description="客户端未指定时每次工具调用的截止时间（秒，含排队），0 表示不限制")
+    request_deadline_max_seconds: float = Field(default=900.0, description="客户端通过 _meta.timeout_ms 或 X-Request-Timeout 指定的截止时间上限（秒）")
+
+    # ----------------------------------------
+    # XXI. 模型路由配置
+    # ----------------------------------------
+
+    model_routes: Optional[str] = Field(default=None, description="可选：文案与运营指导的模型路由，JSON 列表，按从快到慢排列，最后一条为兜底，如 [{\"name\": \"fast\", \"model\": \"qwen-turbo\", \"max_input_tokens\": 400, \"images\": false}, {\"name\": \"large\", \"model\": \"qwen-vl-max\"}]；未配置时全部使用 QWEN_MODEL_NAME")
+    routing_min_score: float = Field(default=7.0, description="非兜底路由输出的自评分低于该值时升级到下一条路由")
+
+    # ----------------------------------------
+    # XXII. 生成历史配置
+    # ----------------------------------------
+
+    history_enabled: bool = Field(default=False, description="是否记录每次生成的输入、输出、模型、耗时与 token 用量（含完整调用参数与输出，可能包含商品数据）")
+    history_path: str = Field(default="./generation_history.db", description="生成历史的 SQLite 文件路径（WAL 模式，多个 worker 可共用）")
+    history_batch_size: int = Field(default=200, description="攒够该条数即批量写入一次")
+    history_flush_interval: float = Field(default=1.0, description="未攒满一批时的写入间隔（秒）")
+    history_max_pending: int = Field(default=10000, description="内存中等待写入的记录上限，磁盘写入跟不上时丢弃新记录")
+    history_reuse_enabled: bool = Field(default=False, description="是否以相同输入的历史成功结果直接作答文案、多变体与运营指导请求")
+    history_reuse_max_age_seconds: float = Field(default=7 * 86400, description="可复用的历史结果的最长保存时间（秒）")
+
+    # ----------------------------------------
+    # XXIII. Pydantic 配置 
     # ----------------------------------------
 
     model_config = SettingsConfigDict(
@@ -0,0 +1,316 @@
+import asyncio
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from fastmcp.utilities import logging
+
+from .cache import normalize_text
+from .metrics import metrics
+
+logger = logging.get_logger(__name__)
+
+
+# --- 1. MinHash 签名 ---
+_MERSENNE = (1 << 61) - 1
+
+
+def shingles(text: str, size: int = 3) -> FrozenSet[int]:
+    """
+    去掉标点与空白后的字符 n-gram（中文文本不分词，按字符切分效果稳定），以 CRC32 映射为整数，跨进程一致。
+    """
+    compact = re.sub(r"[\W_]+", "", normalize_text(text).lower())
+    if len(compact) <= size:
+        grams = {compact} if compact else set()
+    else:
+        grams = {compact[i:i + size] for i in range(len(compact) - size + 1)}
+    return frozenset(zlib.crc32(g.encode("utf-8")) for g in grams)
+
+
+def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """
+    num_perm 个随机线性哈希下的最小值构成签名；两个签名相同位置相等的比例是 Jaccard 相似度的无偏估计。
+    签名分成 bands 段做局部敏感哈希：任意一段完全相同的条目才作为候选，查找时间与索引规模无关。
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 20240601):
+        if num_perm % bands:
+            raise ValueError("num_perm 必须是 bands 的整数倍")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # 固定种子，保证持久化的签名在重启后仍可比较
+        rng = random.Random(seed)
+        self._params = [(rng.randrange(1, _MERSENNE), rng.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+
+    def signature(self, grams: FrozenSet[int]) -> Tuple[int, ...]:
+        if not grams:
+            return tuple([_MERSENNE] * self.num_perm)
+        return tuple(min((a * g + b) % _MERSENNE for g in grams) for a, b in self._params)
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        return [(i, signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def fingerprint(self, text: str) -> Tuple[FrozenSet[int], Tuple[int, ...]]:
+        """
+        返回 text 的字符三元组与签名。签名需对每个三元组计算 num_perm 次哈希，调用方应在线程池中执行。
+        """
+        grams = shingles(text)
+        return grams, self.signature(grams)
+
+
+# --- 2. 索引 ---
+class SimilarMatch:
+    """
+    一次近似查找的结果：score 为输入字符三元组的 Jaccard 相似度，output 为当时的生成结果。
+    """
+
+    def __init__(self, score: float, text: str, output: str):
+        self.score = score
+        self.text = text
+        self.output = output
+
+
+class _Entry:
+    __slots__ = ("row_id", "namespace", "text", "grams", "signature", "output", "created_at")
+
+    def __init__(self, row_id: int, namespace: str, text: str, grams: FrozenSet[int],
+                 signature: Tuple[int, ...], output: str, created_at: float):
+        self.row_id = row_id
+        self.namespace = namespace
+        self.text = text
+        self.grams = grams
+        self.signature = signature
+        self.output = output
+        self.created_at = created_at
+
+
+class _IndexStore:
+    """
+    SQLite 持久化：签名以二进制保存，重启时无需重新计算。所有操作在线程池中执行。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS similarity_index ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, text TEXT NOT NULL,"
+                " signature BLOB NOT NULL, output TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_similarity_accessed ON similarity_index(accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def load(self, limit: int, min_created_at: float) -> List[Tuple[int, str, str, bytes, str, float]]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM similarity_index WHERE created_at < ?", (min_created_at,))
+            conn.commit()
+            # 最近访问的条目排在最后，加载后在内存 LRU 中位于最新的一端
+            rows = conn.execute(
+                "SELECT id, namespace, text, signature, output, created_at FROM similarity_index"
+                " ORDER BY accessed_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+            return rows[::-1]
+
+    def insert(self, namespace: str, text: str, signature: bytes, output: str, created_at: float) -> int:
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "INSERT INTO similarity_index (namespace, text, signature, output, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (namespace, text, signature, output, created_at, created_at)
+            )
+            conn.commit()
+            return int(cursor.lastrowid or 0)
+
+    def touch(self, row_id: int) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("UPDATE similarity_index SET accessed_at = ? WHERE id = ?", (time.time(), row_id))
+            conn.commit()
+
+    def delete(self, row_ids: List[int]) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("DELETE FROM similarity_index WHERE id = ?", [(i,) for i in row_ids])
+            conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SimilarityIndex:
+    """
+    面向近似重复请求的本地相似度索引：按命名空间（工具 + 平台 + 受众等）隔离，
+    对输入文本的字符三元组做 MinHash + LSH 检索候选，再以精确的 Jaccard 相似度确认。
+    签名计算与加载时的三元组重建在线程池中执行，不阻塞事件循环。
+
+    内存中最多保留 max_entries 条（LRU 淘汰，超过 ttl_seconds 的条目视为失效），
+    配置 path 时同步写入 SQLite，重启后恢复。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 5000, ttl_seconds: float = 86400.0,
+                 hasher: Optional[MinHasher] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hasher = hasher or MinHasher()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[int]] = {}
+        self._store = _IndexStore(path) if path else None
+        self._loaded = self._store is None
+        self._load_lock = asyncio.Lock()
+        self._next_id = -1
+
+    # --- 内存结构 ---
+    def _insert(self, entry: _Entry) -> None:
+        self._entries[entry.row_id] = entry
+        for band in self.hasher.band_keys(entry.signature):
+            self._buckets.setdefault((entry.namespace, *band), set()).add(entry.row_id)
+
+    def _remove(self, row_id: int) -> Optional[_Entry]:
+        entry = self._entries.pop(row_id, None)
+        if entry is None:
+            return None
+        for band in self.hasher.band_keys(entry.signature):
+            key = (entry.namespace, *band)
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(row_id)
+                if not bucket:
+                    del self._buckets[key]
+        return entry
+
+    def _evict(self) -> List[int]:
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            row_id = next(iter(self._entries))
+            self._remove(row_id)
+            evicted.append(row_id)
+        return evicted
+
+    async def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded or self._store is None:
+                return
+            try:
+                rows = await asyncio.to_thread(self._store.load, self.max_entries, time.time() - self.ttl_seconds)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to load similarity index: {e}")
+                rows = []
+            for entry in await asyncio.to_thread(self._decode, rows):
+                self._insert(entry)
+            self._loaded = True
+
+    @staticmethod
+    def _decode(rows: List[Tuple[int, str, str, bytes, str, float]]) -> List[_Entry]:
+        return [_Entry(row_id, namespace, text, shingles(text), tuple(array("Q", blob)), output, created_at)
+                for row_id, namespace, text, blob, output, created_at in rows]
+
+    async def preload(self) -> None:
+        """
+        从 SQLite 加载已有条目；未调用时在首次查找或写入时加载。
+        """
+        await self._ensure_loaded()
+
+    # --- 查找与写入 ---
+    async def lookup(self, namespace: str, text: str, min_score: float) -> Optional[SimilarMatch]:
+        """
+        返回同一命名空间内与 text 最相似且相似度不低于 min_score 的历史结果。
+        """
+        await self._ensure_loaded()
+        grams, signature = await asyncio.to_thread(self.hasher.fingerprint, text)
+        candidates: Set[int] = set()
+        for band in self.hasher.band_keys(signature):
+            candidates |= self._buckets.get((namespace, *band), set())
+
+        now = time.time()
+        best: Optional[_Entry] = None
+        best_score = min_score
+        expired = []
+        for row_id in candidates:
+            entry = self._entries[row_id]
+            if now - entry.created_at > self.ttl_seconds:
+                expired.append(row_id)
+                continue
+            score = jaccard(grams, entry.grams)
+            if score >= best_score:
+                best, best_score = entry, score
+        for row_id in expired:
+            self._remove(row_id)
+        if self._store is not None and expired:
+            await asyncio.to_thread(self._store.delete, [i for i in expired if i > 0])
+
+        if best is None:
+            return None
+        self._entries.move_to_end(best.row_id)
+        if self._store is not None and best.row_id > 0:
+            await asyncio.to_thread(self._store.touch, best.row_id)
+        return SimilarMatch(best_score, best.text, best.output)
+
+    async def add(self, namespace: str, text: str, output: str) -> None:
+        await self._ensure_loaded()
+        grams, signature = await asyncio.to_thread(self.hasher.fingerprint, text)
+        created_at = time.time()
+        if self._store is not None:
+            try:
+                row_id = await asyncio.to_thread(self._store.insert, namespace, text,
+                                                 array("Q", signature).tobytes(), output, created_at)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to persist similarity entry: {e}")
+                row_id = self._next_id
+                self._next_id -= 1
+        else:
+            # 纯内存模式使用负数编号，与持久化的行号区分
+            row_id = self._next_id
+            self._next_id -= 1
+        self._insert(_Entry(row_id, namespace, text, grams, signature, output, created_at))
+        evicted = self._evict()
+        if self._store is not None and evicted:
+            await asyncio.to_thread(self._store.delete, [i for i in evicted if i > 0])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self) -> None:
+        if self._store is not None:
+            self._store.close()
+
+
+def namespace(*parts: Optional[str]) -> str:
+    """
+    由工具名与平台、受众等参数构成命名空间，不同命名空间的结果互不复用。
+    """
+    return "|".join(normalize_text(p).lower() for p in parts)
+
+
+def record_lookup(tool: str, match: Optional[SimilarMatch], hit_threshold: float) -> str:
+    """
+    记录一次查找的结果：hit 直接复用、warm 作为参考、miss 未找到。
+    """
+    outcome = "miss" if match is None else ("hit" if match.score >= hit_threshold else "warm")
+    metrics.semantic_cache.inc(tool=tool, outcome=outcome)
+    return outcome
@@ -0,0 +1,167 @@
+import asyncio
+import importlib
+import os
+import time
+from typing import TYPE_CHECKING, Any, Callable, Optional, Sequence, Set
+
+from fastmcp.server.middleware.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.utilities import logging
+
+from .settings import Settings
+from .http_client import DashScopeClient
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    # 只用于类型标注：近似重复索引与图片存储在对应功能开启时才由 server.py 导入
+    from .image_store import GeneratedImageStore
+    from .similarity import SimilarityIndex
+
+logger = logging.get_logger(__name__)
+
+_MODULE_LOADED = time.perf_counter()
+
+
+# --- 1. 冷启动计时 ---
+def process_age() -> float:
+    """
+    当前进程已运行的秒数，包含解释器启动与全部导入。
+
+    Linux 上按 /proc 中的进程启动时间计算（精度为一个时钟周期，通常 10ms）；
+    其他平台退化为从本模块导入起计时。
+    """
+    try:
+        with open("/proc/self/stat", "rb") as f:
+            # comm 字段可能包含空格，从最后一个 ')' 之后按空格切分，starttime 为第 22 个字段
+            fields = f.read().rsplit(b")", 1)[1].split()
+        with open("/proc/uptime", "rb") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _MODULE_LOADED
+
+
+class StartupTimer:
+    """
+    记录冷启动的各个里程碑（每个阶段只记录第一次）到 ecom_startup_seconds：
+    import（服务模块导入完成）、ready（开始接受请求）、tools（工具模块导入并注册完成）、
+    warmup（后台预热完成）、first_request / first_tool_call（首个请求 / 工具调用处理完成）。
+    """
+
+    def __init__(self):
+        self._marked: Set[str] = set()
+
+    def mark(self, phase: str) -> None:
+        if phase in self._marked:
+            return
+        self._marked.add(phase)
+        seconds = process_age()
+        metrics.startup.set(seconds, phase=phase)
+        logger.info(f"Startup phase {phase} reached {seconds:.3f}s after process start")
+
+
+startup_timer = StartupTimer()
+
+
+# --- 2. 延迟注册工具 ---
+class LazyTools:
+    """
+    包装工具注册函数：懒启动模式下，首个 MCP 请求到达（或后台预热）时才导入工具模块并注册，
+    进程无需等待这些导入即可开始监听端口、响应健康检查。
+
+    modules 为注册函数会导入的工具模块，预热时先在线程中导入；注册本身总在事件循环中执行，
+    不在其他线程中修改 FastMCP 的工具表。
+    """
+
+    def __init__(self, register: Callable[[], None], modules: Sequence[str] = ()):
+        self._register = register
+        self._modules = modules
+        self.loaded = False
+        self.error: Optional[BaseException] = None
+
+    def import_modules(self) -> None:
+        """
+        只导入工具模块、不注册，可在线程中执行；导入失败留给 load() 在事件循环中报告。
+        """
+        for module in self._modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                logger.warning(f"Failed to pre-import tool module {module}: {e}")
+
+    def load(self) -> None:
+        """
+        在事件循环中调用。注册失败时保留异常，之后的调用都抛出同一个错误，
+        而不是以“未知工具”的形式掩盖真实原因。
+        """
+        if self.loaded:
+            return
+        if self.error is not None:
+            raise self.error
+        try:
+            self._register()
+        except Exception as e:
+            self.error = e
+            logger.error(f"Tool registration failed: {e}")
+            raise
+        self.loaded = True
+        startup_timer.mark("tools")
+
+
+class StartupMiddleware(Middleware):
+    """
+    放在中间件链最前面：确保工具已注册后再处理请求，并记录首个请求与首个工具调用的完成时间。
+    """
+
+    def __init__(self, tools: LazyTools):
+        self.tools = tools
+
+    async def on_message(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        try:
+            self.tools.load()
+        except Exception:
+            # 注册失败不影响初始化、列表等请求，工具调用在 on_call_tool 中返回真实错误
+            pass
+        result = await call_next(context)
+        startup_timer.mark("first_request")
+        return result
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        self.tools.load()
+        result = await call_next(context)
+        startup_timer.mark("first_tool_call")
+        return result
+
+
+# --- 3. 后台预热 ---
+def _warm_local(tools: LazyTools, store: Optional["GeneratedImageStore"]) -> None:
+    """
+    在线程中执行的本地预热：导入工具模块，启动图片处理进程池，构建常用平台的合规自动机，加载分词器。
+    """
+    tools.import_modules()
+    if store is not None:
+        store.warm()
+    from .compliance import PLATFORM_RULES, rule_set
+    from .prompts import estimate_tokens
+    for platform in PLATFORM_RULES:
+        rule_set(platform)
+    estimate_tokens("预热")
+
+
+async def warm_up(config: Settings, http: DashScopeClient, tools: LazyTools,
+                  similar: Optional["SimilarityIndex"] = None, store: Optional["GeneratedImageStore"] = None) -> None:
+    """
+    服务开始接受请求后在后台执行：预先建立到 DashScope 的连接（含 TLS 握手）并留在连接池中，
+    同时完成工具导入等本地初始化。任何一步失败只记录日志，不影响正常请求。
+    """
+    async def local() -> None:
+        try:
+            await asyncio.to_thread(_warm_local, tools, store)
+            # 模块已在线程中导入，这里只在事件循环中完成注册
+            tools.load()
+            if similar is not None:
+                await similar.preload()
+        except Exception as e:
+            logger.warning(f"Local warm-up failed: {e}")
+
+    await asyncio.gather(http.warm_up(config.server_warmup_connections), local())
+    startup_timer.mark("warmup")
@@ -0,0 +1,263 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from .settings import Settings
+
+
+class StateBackendError(Exception):
+    """
+    共享状态后端不可用（连接失败、超时或协议错误）。调用方应降级为进程内行为，而不是让工具调用失败。
+    """
+
+
+# --- 1. 接口 ---
+class StateBackend:
+    """
+    多个 worker 进程之间共享的键值状态：响应缓存、跨进程限流计数与任务租约。
+
+    值均为字符串；ttl_seconds 为 None 时不过期。shared 表示状态是否真正跨进程共享，
+    进程内实现为 False，调用方据此跳过与本地缓存重复的一层。
+    """
+
+    shared = False
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def set_if_absent(self, key: str, value: str, ttl_seconds: float) -> bool:
+        """
+        键不存在时写入并返回 True，已存在时返回 False；用作带过期时间的锁或租约。
+        """
+        raise NotImplementedError
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        """
+        计数加一并返回新值；键首次创建时设置过期时间，之后的自增不会延长过期时间。
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def aclose(self) -> None:
+        return None
+
+
+# --- 2. 进程内实现（默认） ---
+class MemoryStateBackend(StateBackend):
+    """
+    单进程默认实现：带过期时间的有序字典，超出容量时优先清理过期条目，再淘汰最早写入的条目。
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Optional[float], str]]" = OrderedDict()
+
+    def _live(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._data[key]
+            return None
+        return value
+
+    def _store(self, key: str, value: str, expires_at: Optional[float]) -> None:
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_entries:
+            now = time.monotonic()
+            for stale in [k for k, (exp, _) in self._data.items() if exp is not None and now >= exp]:
+                del self._data[stale]
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    @staticmethod
+    def _expires_at(ttl_seconds: Optional[float]) -> Optional[float]:
+        return time.monotonic() + ttl_seconds if ttl_seconds is not None else None
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._live(key)
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None) -> None:
+        self._store(key, value, self._expires_at(ttl_seconds))
+
+    async def set_if_absent(self, key: str, value: str, ttl_seconds: float) -> bool:
+        if self._live(key) is not None:
+            return False
+        self._store(key, value, self._expires_at(ttl_seconds))
+        return True
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        current = self._live(key)
+        if current is None:
+            self._store(key, "1", self._expires_at(ttl_seconds))
+            return 1
+        count = int(current) + 1
+        self._data[key] = (self._data[key][0], str(count))
+        return count
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+
+# --- 3. Redis 兼容实现（内置最小 RESP 客户端） ---
+class _RespConnection:
+    """
+    单个 RESP2 连接：一次只执行一条命令，由连接池保证独占。
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    def _encode(args: Tuple[Any, ...]) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    async def _read(self) -> Any:
+        line = await self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise StateBackendError("共享状态后端连接已关闭")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise StateBackendError(body.decode("utf-8", errors="replace"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self._read() for _ in range(length)]
+        raise StateBackendError(f"无法解析的 RESP 响应: {line[:64]!r}")
+
+    async def execute(self, *args: Any) -> Any:
+        self.writer.write(self._encode(args))
+        await self.writer.drain()
+        return await self._read()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class RedisStateBackend(StateBackend):
+    """
+    通过 RESP 协议访问 Redis 或兼容服务（如 benchmarks/mock_redis.py）。
+
+    URL 形如 redis://[:password@]host:port/db；所有键带 key_prefix 前缀，便于与其他应用共用实例。
+    连接在首次使用时建立并复用；命令超时或被取消时丢弃该连接，避免响应错位。
+    """
+
+    shared = True
+
+    def __init__(self, url: str, key_prefix: str = "", timeout: float = 2.0, max_connections: int = 20):
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"不支持的共享状态后端: {url}")
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle: List[_RespConnection] = []
+
+    async def _connect(self) -> _RespConnection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        conn = _RespConnection(reader, writer)
+        try:
+            if self.password is not None:
+                await conn.execute(*(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)))
+            if self.db:
+                await conn.execute("SELECT", self.db)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def _execute(self, *args: Any) -> Any:
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else None
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(self._connect(), self.timeout)
+                result = await asyncio.wait_for(conn.execute(*args), self.timeout)
+            except StateBackendError:
+                # 命令级错误（如类型不符）不影响连接本身
+                if conn is not None:
+                    self._idle.append(conn)
+                raise
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                if conn is not None:
+                    conn.close()
+                raise StateBackendError(f"共享状态后端 {self.host}:{self.port} 不可用: {e!r}") from e
+            except BaseException:
+                if conn is not None:
+                    conn.close()
+                raise
+            self._idle.append(conn)
+            return result
+
+    def _key(self, key: str) -> str:
+        return self.key_prefix + key
+
+    @staticmethod
+    def _px(ttl_seconds: float) -> int:
+        return max(1, int(ttl_seconds * 1000))
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._execute("GET", self._key(key))
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None) -> None:
+        if ttl_seconds is None:
+            await self._execute("SET", self._key(key), value)
+        else:
+            await self._execute("SET", self._key(key), value, "PX", self._px(ttl_seconds))
+
+    async def set_if_absent(self, key: str, value: str, ttl_seconds: float) -> bool:
+        return await self._execute("SET", self._key(key), value, "PX", self._px(ttl_seconds), "NX") is not None
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        # 先以 NX 创建带过期时间的计数器，INCR 会保留已有的过期时间
+        await self._execute("SET", self._key(key), "0", "PX", self._px(ttl_seconds), "NX")
+        return await self._execute("INCR", self._key(key))
+
+    async def delete(self, key: str) -> None:
+        await self._execute("DEL", self._key(key))
+
+    async def aclose(self) -> None:
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def create_state_backend(config: Settings) -> StateBackend:
+    if not config.state_backend_url:
+        return MemoryStateBackend()
+    return RedisStateBackend(
+        config.state_backend_url,
+        key_prefix=config.state_key_prefix,
+        timeout=config.state_timeout,
+        max_connections=config.state_max_connections,
+    )
@@ -0,0 +1,157 @@
+import asyncio
+import re
+import time
+from contextlib import aclosing
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .settings import settings
+from .http_client import DashScopeClient
+
+# 导入 FastMCP 类型
+from fastmcp import Context
+
+
+# 收到部分输出时的回调，参数为自上次回调以来新增的文本
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+# --- 1. 增量 JSON 结构检查 ---
+class MalformedStreamError(ValueError):
+    """
+    流式输出在结构上已不可能构成单个 JSON 对象，提前终止上游生成。
+    """
+
+
+class IncrementalJSONChecker:
+    """
+    逐块检查模型输出是否仍可能是一个完整的 JSON 对象。
+
+    只跟踪括号栈与字符串/转义状态，不构建对象，开销与输入长度成线性。
+    发现以下情况立即抛出 MalformedStreamError：首个非空白字符不是 '{'（允许前置 Markdown 代码块标记）、
+    括号不匹配。代码块结束标记、对象闭合后的说明文字与截断的结尾由 output 模块在本地修复，这里不中断生成。
+    """
+
+    _FENCE = re.compile(r"`{1,3}|```[A-Za-z]*")
+
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self._prefix = ""
+        self.complete = False
+
+    def feed(self, chunk: str) -> None:
+        for ch in chunk:
+            if self.complete:
+                return
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if not self._started:
+                if ch.isspace():
+                    continue
+                if ch != "{":
+                    self._prefix += ch
+                    if not self._FENCE.fullmatch(self._prefix):
+                        raise MalformedStreamError(f"输出不是以 JSON 对象开头: {self._prefix[:16]!r}")
+                    continue
+                self._started = True
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append("}" if ch == "{" else "]")
+                if len(self._stack) > self.max_depth:
+                    raise MalformedStreamError("JSON 嵌套层级过深")
+            elif ch in "}]":
+                if not self._stack or self._stack.pop() != ch:
+                    raise MalformedStreamError(f"JSON 括号不匹配: {ch!r}")
+                if not self._stack:
+                    self.complete = True
+
+
+# --- 2. 流式 Chat Completion ---
+async def stream_chat_content(http: DashScopeClient, url: str, payload: Dict[str, Any], timeout: float,
+                              on_delta: DeltaCallback, final: Optional[Dict[str, Any]] = None) -> str:
+    """
+    以流式方式调用 OpenAI 兼容的 Chat 接口，返回拼接后的完整 content。
+
+    增量文本按 settings.stream_progress_interval 合并后交给 on_delta，
+    同时逐块做 JSON 结构检查，结构出错时立即断开上游连接并抛出 MalformedStreamError。
+    timeout 为整个生成过程的总时限。
+    提供 final 时，流结束后写入最后一个分片携带的 usage 与 finish_reason。
+    """
+    payload = {**payload, "stream": True, "stream_options": {"include_usage": True}}
+    checker = IncrementalJSONChecker()
+    parts: List[str] = []
+    pending: List[str] = []
+    last_flush = time.monotonic()
+
+    # aclosing 保证提前退出（结构错误、超时、取消）时立即关闭上游连接
+    async with asyncio.timeout(timeout), aclosing(http.stream_events("qwen", url, payload, timeout)) as events:
+        async for event in events:
+            choices = event.get('choices') or []
+            if final is not None:
+                if event.get('usage'):
+                    final['usage'] = event['usage']
+                if choices and choices[0].get('finish_reason'):
+                    final['finish_reason'] = choices[0]['finish_reason']
+            delta: Optional[str] = choices[0].get('delta', {}).get('content') if choices else None
+            if not delta:
+                continue
+            checker.feed(delta)
+            parts.append(delta)
+            pending.append(delta)
+            # 首个分片立即推送以降低首字节延迟，之后按间隔合并推送
+            now = time.monotonic()
+            if len(parts) == 1 or now - last_flush >= settings.stream_progress_interval:
+                await on_delta("".join(pending))
+                pending.clear()
+                last_flush = now
+
+    if pending:
+        await on_delta("".join(pending))
+    return "".join(parts)
+
+
+# 重置通知的 message 前缀：客户端收到后丢弃此前累积的部分输出，之后的增量属于新一次生成
+STREAM_RESET_PREFIX = "[reset]"
+
+
+class ProgressForwarder:
+    """
+    将增量文本转发为 MCP 进度通知，progress 为累计收到的字符数。MCP 要求每条通知的 progress 严格递增，
+    重置通知额外计 1，避免与上一条通知的 progress 相同而被客户端丢弃。
+    """
+
+    def __init__(self, ctx: Context):
+        self.ctx = ctx
+        self.received = 0
+
+    async def __call__(self, delta: str) -> None:
+        self.received += len(delta)
+        await self.ctx.report_progress(progress=self.received, message=delta)
+
+    async def reset(self, reason: str) -> None:
+        self.received += 1
+        await self.ctx.report_progress(progress=self.received, message=f"{STREAM_RESET_PREFIX} {reason}")
+
+
+def progress_forwarder(ctx: Context) -> DeltaCallback:
+    return ProgressForwarder(ctx)
+
+
+async def reset_stream(on_delta: Optional[DeltaCallback], reason: str) -> None:
+    """
+    已推送的部分输出将被另一次生成替换时（如模型路由升级、截断后重新生成）通知客户端；
+    回调不支持重置时忽略。
+    """
+    reset = getattr(on_delta, "reset", None)
+    if reset is not None:
+        await reset(reason)
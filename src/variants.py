@@ -0,0 +1,372 @@
+import asyncio
+import re
+import time
+from typing import Annotated, Any, Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel, Field
+
+from .settings import settings
+from .http_client import DashScopeClient, UpstreamError
+from .cache import ResponseCache, make_cache_key, normalize_text
+from .image_ingest import ImageIngestError, ImageIngestor
+from .generate_content import SYSTEM_PROMPT, build_content_payload
+from .metrics import metrics
+from .prompts import output_budget
+from .output import ContentPlan, OutputFormatError, parse_output
+from .routing import model_router
+
+# 导入 FastMCP 类型
+from fastmcp import FastMCP
+
+
+# --- 1. 定义输出类型 ---
+class ContentVariant(BaseModel):
+    """
+    一条入选的文案变体及其评分明细。
+    """
+    copywriting: str
+    key_elements: List[str] = []
+    image_prompt: str = ""
+    model_score: Annotated[Optional[float], Field(description="模型自评分（0-10），缺失时为空")] = None
+    heuristic_score: Annotated[float, Field(description="本地启发式评分（0-10）：篇幅、卖点覆盖与结构完整度")]
+    final_score: Annotated[float, Field(description="综合评分（0-10），按此从高到低排序")]
+
+
+class VariantsResult(BaseModel):
+    """
+    多变体文案生成结果：去重、排序后的 top-k 变体与本次生成的成本统计。
+    """
+    variants: Annotated[List[ContentVariant], Field(description="按综合评分从高到低排列的入选变体")] = []
+    candidates: Annotated[int, Field(description="上游实际返回的候选数")] = 0
+    duplicates_removed: Annotated[int, Field(description="因与更高分候选过于相似而剔除的候选数")] = 0
+    invalid: Annotated[int, Field(description="无法解析为合法文案 JSON 的候选数")] = 0
+    upstream_calls: Annotated[int, Field(description="本次调用上游的次数")] = 0
+    mode: Annotated[str, Field(description="候选生成方式：n（单次请求多候选）、fan_out（并发多次请求）或两者结合")] = ""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    tokens_per_variant: Annotated[Optional[float], Field(description="每个入选变体平均消耗的 token 数")] = None
+    cached: Annotated[bool, Field(description="是否直接返回了缓存结果")] = False
+    error: Annotated[Optional[str], Field(description="失败时的错误信息")] = None
+
+
+# --- 2. 配置 ---
+TOOL_NAME = "generate_marketing_content_variants"
+
+# 候选需要足够的多样性，采样温度高于单次生成
+VARIANT_TOP_P = 0.9
+
+# 综合评分中模型自评分与本地启发式评分的权重
+MODEL_SCORE_WEIGHT = 0.6
+HEURISTIC_WEIGHT = 0.4
+
+# 各平台文案的合适篇幅（字符数），超出范围按比例扣分
+PLATFORM_LENGTH = {
+    "小红书": (80, 400),
+    "抖音": (15, 80),
+    "淘宝": (20, 150),
+}
+DEFAULT_LENGTH = (20, 300)
+
+# 已知会忽略或拒绝 n 参数的模型及标记的过期时刻（time.monotonic()），过期前直接并发多次请求
+_N_UNSUPPORTED: Dict[str, float] = {}
+
+# 错误信息中独立出现的参数名 n（如 "Range of n should be [1, 4]"、"参数n不合法"）
+_N_PARAM = re.compile(r"(?<![A-Za-z_])n(?![A-Za-z_])")
+
+
+def _n_unsupported(model: str) -> bool:
+    expires = _N_UNSUPPORTED.get(model)
+    if expires is None:
+        return False
+    if time.monotonic() >= expires:
+        del _N_UNSUPPORTED[model]
+        return False
+    return True
+
+
+def _mark_n_unsupported(model: str) -> None:
+    _N_UNSUPPORTED[model] = time.monotonic() + settings.variants_n_unsupported_ttl
+
+
+def _rejects_n(e: UpstreamError) -> bool:
+    """
+    判断 400 错误是否由 n 参数本身引起；内容审核、输入过长等其他 400 不说明模型不支持 n。
+    """
+    if e.status_code != 400 or e.response is None:
+        return False
+    try:
+        body = e.response.json()
+    except ValueError:
+        return False
+    if not isinstance(body, dict):
+        return False
+    error = body.get("error") if isinstance(body.get("error"), dict) else body
+    if error.get("param") == "n":
+        return True
+    return bool(_N_PARAM.search(str(error.get("message") or "")))
+
+
+def candidate_count(k: int, candidates: Optional[int] = None) -> int:
+    """
+    实际请求的候选数：默认多生成一倍以便去重后仍能凑满 k 条，不超过配置上限。
+    """
+    count = candidates if candidates is not None else 2 * k
+    return max(k, min(count, settings.variants_max_candidates))
+
+
+# --- 3. 去重与评分 ---
+def _shingles(text: str, size: int = 3) -> Set[str]:
+    compact = re.sub(r"[\W_]+", "", normalize_text(text).lower())
+    if len(compact) <= size:
+        return {compact} if compact else set()
+    return {compact[i:i + size] for i in range(len(compact) - size + 1)}
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    字符三元组的 Jaccard 相似度；只替换个别词语或标点的文案相似度仍接近 1。
+    """
+    sa, sb = _shingles(a), _shingles(b)
+    if not sa or not sb:
+        return 1.0 if sa == sb else 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def heuristic_score(plan: Dict[str, Any], product_features: str, target_platform: str) -> float:
+    """
+    不调用模型的本地评分（0-1）：篇幅是否适合平台、卖点覆盖率、结构是否完整。
+    """
+    copy = str(plan.get("copywriting", ""))
+
+    low, high = PLATFORM_LENGTH.get(normalize_text(target_platform), DEFAULT_LENGTH)
+    length = len(copy)
+    if length < low:
+        length_score = length / low
+    elif length > high:
+        length_score = max(0.0, 1 - (length - high) / high)
+    else:
+        length_score = 1.0
+
+    # 按卖点短语的字符二元组在文案中的出现比例估计覆盖率
+    terms = [t for t in re.split(r"[，,、;；。\s]+", normalize_text(product_features)) if len(t) >= 2]
+    if terms:
+        coverage = sum(
+            sum(1 for i in range(len(t) - 1) if t[i:i + 2] in copy) / (len(t) - 1)
+            for t in terms
+        ) / len(terms)
+    else:
+        coverage = 1.0
+
+    image_prompt = str(plan.get("image_prompt", ""))
+    complete = 0.0
+    if isinstance(plan.get("key_elements"), list) and plan["key_elements"]:
+        complete += 0.5
+    # 图像指令要求为英文
+    if image_prompt and sum(ch.isascii() for ch in image_prompt) / len(image_prompt) > 0.9:
+        complete += 0.5
+
+    return 0.4 * length_score + 0.4 * coverage + 0.2 * complete
+
+
+def _model_score(plan: Dict[str, Any]) -> Optional[float]:
+    try:
+        return min(10.0, max(0.0, float(plan.get("score"))))
+    except (TypeError, ValueError):
+        return None
+
+
+def rank_variants(texts: List[str], k: int, product_features: str, target_platform: str,
+                  threshold: float) -> Tuple[List[ContentVariant], int, int]:
+    """
+    解析、评分并按综合评分排序，依次选取与已选变体都不相似的候选，直到凑满 k 条。
+
+    返回 (入选变体, 剔除的重复数, 无法解析的候选数)。重复候选中保留评分更高的一条。
+    """
+    scored: List[ContentVariant] = []
+    invalid = 0
+    for text in texts:
+        try:
+            plan = parse_output(text, ContentPlan, TOOL_NAME).value.model_dump()
+        except OutputFormatError:
+            invalid += 1
+            continue
+        if not plan["copywriting"].strip():
+            invalid += 1
+            continue
+        model_score = _model_score(plan)
+        heuristic = heuristic_score(plan, product_features, target_platform)
+        # 缺少模型自评分时按中间值计
+        final = MODEL_SCORE_WEIGHT * (model_score if model_score is not None else 5.0) / 10 + HEURISTIC_WEIGHT * heuristic
+        scored.append(ContentVariant(
+            copywriting=plan["copywriting"],
+            key_elements=plan["key_elements"],
+            image_prompt=plan["image_prompt"],
+            model_score=model_score,
+            heuristic_score=round(heuristic * 10, 2),
+            final_score=round(final * 10, 2),
+        ))
+
+    scored.sort(key=lambda v: v.final_score, reverse=True)
+    selected: List[ContentVariant] = []
+    duplicates = 0
+    for variant in scored:
+        if any(similarity(variant.copywriting, kept.copywriting) >= threshold for kept in selected):
+            duplicates += 1
+            continue
+        if len(selected) < k:
+            selected.append(variant)
+    return selected, duplicates, invalid
+
+
+# --- 4. 候选生成 ---
+async def _chat(http: DashScopeClient, payload: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+    # max_tokens 针对单个候选，n 个候选时按候选数均摊输出 token 后计入预算样本
+    max_tokens = output_budget.max_tokens(TOOL_NAME, settings.content_default_max_tokens)
+    response_data = await http.post_json("qwen", settings.qwen_api_endpoint, {**payload, "max_tokens": max_tokens}, timeout=60)
+    choices = response_data.get("choices") or []
+    finish_reason = next((c.get("finish_reason") for c in choices if c.get("finish_reason") == "length"), None)
+    output_budget.observe(TOOL_NAME, response_data.get("usage"), finish_reason, max_tokens, choices=len(choices))
+    texts = [(choice.get("message") or {}).get("content") for choice in choices]
+    return [t for t in texts if isinstance(t, str)], response_data.get("usage") or {}
+
+
+async def request_candidates(http: DashScopeClient, payload: Dict[str, Any], count: int,
+                             result: VariantsResult) -> List[str]:
+    """
+    生成 count 条候选：优先用一次带 n 参数的请求（共享同一份提示词的输入 token），
+    模型不支持 n 或返回数量不足时，并发补发单候选请求。调用次数与 token 用量累计到 result。
+    """
+    texts: List[str] = []
+    modes: List[str] = []
+
+    def add_usage(usage: Dict[str, Any]) -> None:
+        result.prompt_tokens += int(usage.get("prompt_tokens") or 0)
+        result.completion_tokens += int(usage.get("completion_tokens") or 0)
+        result.total_tokens += int(usage.get("total_tokens") or 0)
+
+    model = payload["model"]
+    if count > 1 and not _n_unsupported(model):
+        try:
+            got, usage = await _chat(http, {**payload, "n": count})
+        except UpstreamError as e:
+            # 只有错误信息指明 n 参数不合法时才改为并发多次请求，其余错误照常抛出
+            if not _rejects_n(e):
+                raise
+            _mark_n_unsupported(model)
+        else:
+            result.upstream_calls += 1
+            add_usage(usage)
+            texts.extend(got)
+            modes.append("n")
+            if len(got) < 2:
+                _mark_n_unsupported(model)
+
+    missing = count - len(texts)
+    if missing > 0:
+        outcomes = await asyncio.gather(*(_chat(http, payload) for _ in range(missing)), return_exceptions=True)
+        errors = []
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                errors.append(outcome)
+                continue
+            result.upstream_calls += 1
+            add_usage(outcome[1])
+            texts.extend(outcome[0][:1])
+        modes.append("fan_out")
+        # 部分失败时用已有候选继续；全部失败才报错
+        if not texts and errors:
+            raise errors[0]
+
+    result.mode = "+".join(modes)
+    return texts
+
+
+def variants_cache_key(product_name: str, product_features: str, target_platform: str, target_audience: str,
+                       product_image_url: Optional[str], k: int, count: int) -> str:
+    return make_cache_key(
+        kind="variants",
+        product_name=normalize_text(product_name),
+        product_features=normalize_text(product_features),
+        target_platform=normalize_text(target_platform),
+        target_audience=normalize_text(target_audience),
+        product_image_url=(product_image_url or "").strip(),
+        system_prompt=SYSTEM_PROMPT,
+        model=model_router.signature(),
+        sampling={"top_p": VARIANT_TOP_P, "temperature": settings.variants_temperature},
+        k=k,
+        candidates=count,
+        threshold=settings.variants_similarity_threshold,
+    )
+
+
+async def generate_content_variants(http: DashScopeClient, product_name: str, product_features: str,
+                                    target_platform: str, target_audience: str,
+                                    product_image_url: Optional[str], k: int, count: int) -> VariantsResult:
+    payload = build_content_payload(product_name, product_features, target_platform, target_audience, product_image_url)
+    payload.update(top_p=VARIANT_TOP_P, temperature=settings.variants_temperature)
+    # 候选由本地排序筛选，只按输入选择路由，不做升级
+    payload["model"] = model_router.select(payload, target_platform).model
+
+    result = VariantsResult()
+    texts = await request_candidates(http, payload, count, result)
+    result.candidates = len(texts)
+    result.variants, result.duplicates_removed, result.invalid = rank_variants(
+        texts, k, product_features, target_platform, settings.variants_similarity_threshold)
+    if result.variants:
+        result.tokens_per_variant = round(result.total_tokens / len(result.variants), 1)
+
+    metrics.content_variants.inc(len(result.variants), outcome="accepted")
+    metrics.content_variants.inc(result.duplicates_removed, outcome="duplicate")
+    metrics.content_variants.inc(result.invalid, outcome="invalid")
+    return result
+
+
+# --- 5. 工具注册函数：register_variant_tools ---
+def register_variant_tools(mcp: FastMCP, http: DashScopeClient, cache: ResponseCache, images: ImageIngestor) -> None:
+    """
+    注册多变体文案生成工具。
+    """
+
+    @mcp.tool(
+        annotations={"title": "generate_marketing_content_variants", "readOnlyHint": False}
+    )
+    async def generate_marketing_content_variants(
+        product_name: Annotated[str, Field(description="商品名称，如：极光无线降噪耳机")],
+        product_features: Annotated[str, Field(description="核心卖点或特点描述，如：轻至20g，主动降噪45dB")],
+        target_platform: Annotated[str, Field(description="目标推广平台，如：小红书, 抖音, 淘宝")],
+        target_audience: Annotated[str, Field(description="目标受众，如：都市白领, 学生党")],
+        k: Annotated[int, Field(description="需要返回的文案变体数", ge=1, le=5)] = 3,
+        candidates: Annotated[Optional[int], Field(description="可选：生成的候选数，默认为 2k，去重和排序后保留 k 条", ge=1, le=10)] = None,
+        product_image_url: Annotated[Optional[str], Field(description="可选：原始产品图片URL，用于模型分析视觉元素和生成图像指令。")] = None,
+        use_cache: Annotated[bool, Field(description="是否使用缓存结果；设为 false 时强制重新生成并刷新缓存")] = True
+    ) -> VariantsResult:
+        """
+        一次生成多条营销文案候选，剔除近似重复后按模型评分与本地启发式评分综合排序，返回最优的 k 条，
+        并报告每条入选变体平均消耗的 token。适合需要多个版本做 A/B 测试或人工挑选的场景。
+        """
+        count = candidate_count(k, candidates)
+        key = variants_cache_key(product_name, product_features, target_platform, target_audience,
+                                 product_image_url, k, count)
+
+        async def compute() -> str:
+            image_url = await images.resolve(product_image_url)
+            result = await generate_content_variants(http, product_name, product_features, target_platform,
+                                                     target_audience, image_url, k, count)
+            if not result.variants:
+                # 没有可用变体时不写入缓存
+                raise ValueError(f"{result.candidates} 条候选均无法解析为合法的文案 JSON")
+            return result.model_dump_json()
+
+        try:
+            value, cached = await cache.get_or_compute(key, compute, bypass=not use_cache)
+        except UpstreamError as e:
+            return VariantsResult(error=f"API调用失败 (HTTP/DashScope Error): {str(e)}")
+        except ImageIngestError as e:
+            return VariantsResult(error=f"输入图片校验失败: {str(e)}")
+        except Exception as e:
+            return VariantsResult(error=f"内容生成过程中发生内部错误: {str(e)}")
+
+        result = VariantsResult.model_validate_json(value)
+        result.cached = cached
+        return result